@@ -4,12 +4,23 @@ import os
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
-import ast
-from collections import deque
-import re
+from collections import deque, OrderedDict
+import time
+import asyncio
+import threading
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import re
+import uuid
+from decimal import Decimal
+import logging
+import importlib.util
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
 
-from langchain_community.tools.sql_database.tool import QuerySQLDataBaseTool
 from langchain_community.utilities import SQLDatabase
 from langchain_core.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
@@ -32,8 +43,8 @@ def getLLM(model_path = None):
         model="gpt-4o",
         temperature=0,
         max_tokens=None,
-        timeout=None,
-        max_retries=2
+        timeout=60, ## Bound each completion so one slow call can't hold the script thread forever
+        max_retries=0 ## Retried in llm_call, behind admission, so a 429 is not retried straight back into the limit
     )
     return llm
 
@@ -63,28 +74,333 @@ def get_table_definitions(table_names):
         table_definitions[table] = db.get_table_info([table]).strip().split('/*')[0]
     return table_definitions
 
-def get_cols(sql_query):
-    ## Find a SELECT then any number of any whitespace 
-    ## (.+?) is a non-greedy match for any character except newline 
-    ##   -> . is any character except newline
-    ##   -> + is one or more of the preceding character
-    ##   -> ? is a non-greedy match meaning it will match as few characters as possible
-    ## () around this means we want to capture this group. so findall will return this group
-    ## Ends with a FROM that comes after any number of any whitespace
+@st.cache_resource
+def get_llm_loop():
+    ## One background event loop for LLM calls, so a superseded run can cancel its in-flight request
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="llm-loop", daemon=True).start()
+    return loop
 
-    ## re.IGNORECASE is to ignore case sensitivity, re.DOTALL is to make . match newline characters as well.
-    ## without re.DOTALL, . will not match newline characters 
+@st.cache_resource
+def get_query_executor():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="query")
 
-    ## Essentially, we are capturing the columns between SELECT and FROM. any number of any whitespace after SELECT and before FROM will not be captured.
+@st.cache_resource
+def get_cancel_stats():
+    ## Shared by all sessions; durations of completed calls per stage estimate the time a cancellation saved
+    return {'lock': threading.Lock(), 'cancelled_runs': 0, 'cancelled_queries': 0, 'cancelled_llm_calls': 0,
+            'seconds_saved': 0.0, 'durations': {}}
 
-    select_regex = re.compile(r'SELECT\s+(.+?)\s+FROM', re.IGNORECASE | re.DOTALL)
-    all_matches = select_regex.findall(sql_query)
-    
-    if not all_matches: return []
-    final_select = all_matches[-1]
-    columns = [col.strip() for col in final_select.split(',')]
-    
-    return columns
+## Admission control for LLM calls: every session of this server shares one requests-per-minute (LLM_RPM) and
+## tokens-per-minute (LLM_TPM) budget. Calls that do not fit wait their turn instead of drawing 429s; sessions
+## take turns so one user's burst does not starve the others. All calls run on the LLM loop, so no locks.
+LLM_MAX_RETRIES = 2
+LLM_COMPLETION_ESTIMATE = 500
+
+@st.cache_resource
+def get_admission():
+    rpm, tpm = float(os.getenv('LLM_RPM', 500)), float(os.getenv('LLM_TPM', 30000))
+    return {'rpm': rpm, 'tpm': tpm, 'requests': rpm, 'tokens': tpm, 'updated_at': time.time(), 'paused_until': 0.0,
+            'queue': OrderedDict(), 'admitted': 0, 'rate_limited': 0, 'max_queue_depth': 0, 'waits': deque(maxlen=500)}
+
+def try_take(admission, tokens):
+    ## 0 if a request and `tokens` were taken from the buckets, else the seconds until they would fit
+    now = time.time()
+    elapsed = now - admission['updated_at']
+    admission['requests'] = min(admission['rpm'], admission['requests'] + elapsed * admission['rpm'] / 60)
+    admission['tokens'] = min(admission['tpm'], admission['tokens'] + elapsed * admission['tpm'] / 60)
+    admission['updated_at'] = now
+    if admission['paused_until'] > now:
+        return admission['paused_until'] - now
+    tokens = min(tokens, admission['tpm'])
+    missing_requests, missing_tokens = 1 - admission['requests'], tokens - admission['tokens']
+    if missing_requests <= 0 and missing_tokens <= 0:
+        admission['requests'] -= 1
+        admission['tokens'] -= tokens
+        return 0.0
+    return max(missing_requests * 60 / admission['rpm'], missing_tokens * 60 / admission['tpm'])
+
+async def admit(admission, session, tokens):
+    queue = admission['queue']
+    waiter = object()
+    queue.setdefault(session, deque()).append(waiter)
+    admission['max_queue_depth'] = max(admission['max_queue_depth'], sum(map(len, queue.values())))
+    start = time.perf_counter()
+    admitted = False
+    try:
+        while not admitted:
+            ## Only the first call of the session whose turn it is takes from the buckets
+            retry_in = try_take(admission, tokens) if next(iter(queue.values()))[0] is waiter else 0.05
+            admitted = retry_in == 0
+            if not admitted:
+                await asyncio.sleep(min(retry_in, 1.0))
+    finally:
+        queue[session].remove(waiter)
+        if not queue[session]: del queue[session]
+        elif admitted: queue.move_to_end(session)
+    admission['admitted'] += 1
+    admission['waits'].append(time.perf_counter() - start)
+
+async def admitted_call(chain, inputs, session):
+    admission = get_admission()
+    estimate = (len(str(inputs)) + 3) // 4 + LLM_COMPLETION_ESTIMATE
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await admit(admission, session, estimate)
+        try:
+            result = await chain.ainvoke(inputs)
+        except Exception as e:
+            if type(e).__name__ != 'RateLimitError' or attempt == LLM_MAX_RETRIES: raise
+            ## A 429 anyway (another client on the key): hold every session back, then queue again
+            admission['rate_limited'] += 1
+            admission['paused_until'] = max(admission['paused_until'], time.time() + 2 ** attempt)
+            continue
+        usage = getattr(result, 'usage_metadata', None)
+        if usage:
+            admission['tokens'] = min(admission['tpm'], admission['tokens'] + estimate - usage.get('total_tokens', estimate))
+        return result
+
+class RunToken:
+    ## Ties one pipeline to the queries / LLM calls it has in flight. They outlive the Streamlit run that started
+    ## them -- a rerun (toggling an option, paging) waits on the same call again -- and are only aborted when the
+    ## pipeline itself is replaced ("Get results" again, or the question changed).
+    def __init__(self, db, session=None):
+        self.db = db
+        self.session = session
+        self.cancelled = False
+        self.backend_pid = None
+        ## stage -> (future, start time)
+        self.inflight = {}
+        ## Set when Streamlit stopped the current run while it waited; reset at the start of each run
+        self.interrupted = False
+
+    def cancel(self):
+        if self.cancelled: return
+        self.cancelled = True
+        pending = [(stage, future, start) for stage, (future, start) in self.inflight.items() if not future.done()]
+        for _, future, _ in pending:
+            future.cancel()
+        pid = self.backend_pid
+        if pid is not None:
+            with self.db._engine.connect() as connection:
+                connection.exec_driver_sql(f"SELECT pg_cancel_backend({int(pid)})")
+        stats = get_cancel_stats()
+        with stats['lock']:
+            stats['cancelled_runs'] += bool(pending)
+            for stage, _, start in pending:
+                stats['cancelled_queries' if stage == 'Query' else 'cancelled_llm_calls'] += 1
+                durations = sorted(stats['durations'].get(stage, []))
+                typical = durations[len(durations) // 2] if durations else 0.0
+                stats['seconds_saved'] += max(0.0, typical - (time.perf_counter() - start))
+
+def wait_for(token, stage, submit, status):
+    ## Poll instead of blocking: each status update is a point where Streamlit can stop this run for a newer one.
+    ## The call stays in token.inflight when that happens, so the next run of the same pipeline waits on it
+    ## instead of submitting it again.
+    if stage not in token.inflight:
+        token.inflight[stage] = (submit(), time.perf_counter())
+    future, start = token.inflight[stage]
+    while True:
+        try:
+            result = future.result(timeout=0.2)
+            break
+        except FutureTimeoutError:
+            try:
+                status.caption(f"{stage}: {time.perf_counter() - start:.1f}s")
+            except BaseException:
+                token.interrupted = True
+                raise
+        except BaseException:
+            ## The call itself failed (or was cancelled); it is not picked up again
+            del token.inflight[stage]
+            raise
+    del token.inflight[stage]
+    stats = get_cancel_stats()
+    with stats['lock']:
+        stats['durations'].setdefault(stage, deque(maxlen=100)).append(time.perf_counter() - start)
+    status.empty()
+    return result
+
+def llm_call(token, stage, chain, inputs, status):
+    submit = lambda: asyncio.run_coroutine_threadsafe(admitted_call(chain, inputs, token.session), get_llm_loop())
+    return wait_for(token, stage, submit, status)
+
+def fetch_rows(token, db, sql_query):
+    ## Runs on its own connection so the backend pid is known and the query can be cancelled server-side
+    with db._engine.connect() as connection:
+        token.backend_pid = connection.exec_driver_sql("SELECT pg_backend_pid()").scalar()
+        try:
+            if token.cancelled: return [], []
+            result = connection.execution_options(no_parameters=True).exec_driver_sql(sql_query)
+            return [tuple(row) for row in result.fetchall()], list(result.keys())
+        finally:
+            token.backend_pid = None
+
+def decimals_to_float(df):
+    ## psycopg2 returns NUMERIC as Decimal objects, which describe(), the charts and DuckDB treat as text; use floats
+    for col in df.columns:
+        values = df[col].dropna()
+        if df[col].dtype == object and len(values) and isinstance(values.iloc[0], Decimal):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+## Follow-ups answered from recent results: the session's last few DataFrames are registered as tables of an
+## in-process DuckDB connection (previous_result_1 is the most recent), and the DBA agent may query them
+## instead of Postgres. Needs `pip install duckdb`; without it every question goes to Postgres.
+LOCAL_TABLE_PREFIX = "previous_result_"
+## Same scan as Modules/sql_ir.py: strings, quoted names and comments stay whole, so a FROM inside them is not a table
+SQL_TOKEN_REGEX = re.compile(r"""--[^\n]*|/\*.*?\*/|[EeBbXxNn]?'(?:[^']|'')*'|"(?:[^"]|"")*"|[A-Za-z_][A-Za-z0-9_$]*|\S""", re.DOTALL)
+## Functions whose arguments use FROM without referring to a table
+FROM_FUNCTIONS = {'EXTRACT', 'SUBSTRING', 'TRIM', 'OVERLAY', 'POSITION'}
+## Clauses that end a FROM list
+FROM_LIST_END = {'WHERE', 'GROUP', 'HAVING', 'ORDER', 'LIMIT', 'OFFSET', 'FETCH', 'UNION', 'INTERSECT', 'EXCEPT', 'WINDOW', 'QUALIFY', 'FOR', ';'}
+
+def get_local_engine(max_results = 3):
+    ## Per session, since results are private to the user who fetched them
+    if 'local_engine' not in st.session_state:
+        ## No file system or network access: the LLM's SQL may only read the registered results
+        conn = duckdb.connect(config={'enable_external_access': False}) if duckdb else None
+        st.session_state.local_engine = {'conn': conn, 'results': deque([], maxlen=max_results),
+                                        'local': 0, 'remote': 0}
+    return st.session_state.local_engine
+
+def register_local_result(engine, user_query, res):
+    if engine['conn'] is None: return
+    engine['results'].appendleft((user_query, res))
+    for idx, (_, df) in enumerate(engine['results']):
+        engine['conn'].register(f"{LOCAL_TABLE_PREFIX}{idx + 1}", df)
+
+def describe_local_tables(engine):
+    if engine['conn'] is None or not engine['results']: return "None"
+    lines = []
+    for idx, (question, df) in enumerate(engine['results']):
+        columns = ', '.join(f'"{col}" {dtype}' for col, dtype in df.dtypes.astype(str).items())
+        lines.append(f"{LOCAL_TABLE_PREFIX}{idx + 1} ({len(df)} rows, result of \"{question}\"): {columns}")
+    return '\n'.join(lines)
+
+def referenced_tables(sql_query):
+    ## Names after FROM/JOIN (every item of FROM a, b), leaving out CTE names and FROM inside EXTRACT(... FROM ...)
+    tokens = [tok for tok in SQL_TOKEN_REGEX.findall(sql_query) if not tok.startswith(('--', '/*'))]
+    name = lambda tok: tok[1:-1].replace('""', '"') if tok.startswith('"') else tok.lower()
+    tables, cte_names, openers = set(), set(), []
+    for idx, tok in enumerate(tokens):
+        upper = tok.upper()
+        if tok == '(':
+            openers.append(tokens[idx - 1].upper() if idx else None)
+        elif tok == ')' and openers:
+            openers.pop()
+        elif upper == 'AS' and idx + 1 < len(tokens) and tokens[idx + 1] == '(' and idx > 0:
+            ## name AS (...) -- or name (columns) AS (...) -- defines a CTE
+            prev = idx - 1
+            if tokens[prev] == ')':
+                depth = 0
+                while prev > 0:
+                    depth += {')': 1, '(': -1}.get(tokens[prev], 0)
+                    if depth == 0:
+                        break
+                    prev -= 1
+                prev -= 1
+            if prev >= 0:
+                cte_names.add(name(tokens[prev]))
+        elif upper in ('FROM', 'JOIN') and idx + 1 < len(tokens):
+            if openers and openers[-1] in FROM_FUNCTIONS:
+                continue
+            ## The first item, and the one after each comma at this depth up to the end of the FROM list
+            items, depth = [idx + 1], 0
+            for pos in range(idx + 1, len(tokens)):
+                if tokens[pos] == '(':
+                    depth += 1
+                elif tokens[pos] == ')':
+                    if depth == 0: break
+                    depth -= 1
+                elif depth == 0 and tokens[pos].upper() in FROM_LIST_END:
+                    break
+                elif depth == 0 and tokens[pos] == ',' and pos + 1 < len(tokens):
+                    items.append(pos + 1)
+            for item in items:
+                following = tokens[item]
+                if following.startswith('"') or following[0].isalpha() or following[0] == '_':
+                    tables.add(name(following))
+    return tables - cte_names
+
+def is_local_query(engine, sql_query):
+    ## Local only when every table the query reads is a registered previous result
+    tables = referenced_tables(sql_query)
+    local_names = {f"{LOCAL_TABLE_PREFIX}{idx + 1}" for idx in range(len(engine['results']))}
+    return bool(tables) and tables <= local_names
+
+def run_local_query(engine, sql_query):
+    ## DuckDB's own parser decides: exactly one SELECT, so no COPY, ATTACH, CREATE or extra statements
+    statements = engine['conn'].extract_statements(sql_query)
+    if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT: raise DDLCommandException
+    return engine['conn'].execute(sql_query).fetchdf()
+
+## Optional per-request profile (pip install pyinstrument). pyinstrument is only imported when the sidebar
+## option is on, so there is no overhead otherwise. Only the script thread is sampled; queries and LLM calls
+## show up as time spent in wait_for for their stage.
+PROFILE_DIR = "Profiles"
+
+def start_profiler(enabled):
+    ## A profiler left running by an interrupted run is discarded
+    stale = st.session_state.pop('active_profiler', None)
+    if stale is not None and stale.is_running: stale.stop()
+    if not enabled: return None
+    from pyinstrument import Profiler
+    profiler = Profiler(interval=0.001)
+    profiler.start()
+    st.session_state.active_profiler = profiler
+    return profiler
+
+def stop_profiler(profiler):
+    if profiler is None: return
+    from pyinstrument.renderers import SpeedscopeRenderer
+    st.session_state.pop('active_profiler', None)
+    session = profiler.stop()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stem = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}")
+    with open(f"{stem}.speedscope.json", 'w', encoding='utf-8') as f: f.write(profiler.output(renderer=SpeedscopeRenderer()))
+    with open(f"{stem}.html", 'w', encoding='utf-8') as f: f.write(profiler.output_html())
+    st.session_state.last_profile = {'speedscope': f"{stem}.speedscope.json", 'html': f"{stem}.html", 'seconds': session.duration}
+
+def show_last_profile(profile):
+    st.sidebar.caption(f"Last profiled request: {profile['seconds']:.2f}s")
+    with open(profile['speedscope'], 'rb') as f:
+        st.sidebar.download_button("Download speedscope profile", f.read(), file_name=os.path.basename(profile['speedscope']), mime="application/json")
+    with open(profile['html'], 'rb') as f:
+        st.sidebar.download_button("Download flame graph (HTML)", f.read(), file_name=os.path.basename(profile['html']), mime="text/html")
+    st.sidebar.markdown("Load the speedscope file at [speedscope.app](https://www.speedscope.app).")
+
+class StageFailed:
+    ## A stage that raised, stored in its place so reruns show the error instead of repeating the call
+    def __init__(self, error):
+        self.error = error
+
+    def __str__(self):
+        return f"Error: {self.error}. Please try again."
+
+def run_stage(pipeline, stages, name):
+    ## Memoized DAG node: computed once per question (its dependencies through the same function) and kept in
+    ## pipeline['nodes'], failures included. A stage interrupted by a newer run is not stored; the next run
+    ## calls it again and it picks up its in-flight query or LLM call (wait_for).
+    nodes = pipeline['nodes']
+    if name not in nodes:
+        try:
+            nodes[name] = stages[name](lambda dependency: run_stage(pipeline, stages, dependency))
+        except Exception as e:
+            if pipeline['token'].interrupted: raise
+            logger.error("Stage %s failed: %s", name, e)
+            nodes[name] = StageFailed(e)
+    return nodes[name]
+
+def show_result_page(res, page_size = 50):
+    ## Send one page of the result to the browser instead of the whole DataFrame
+    page_no = st.number_input("Page", min_value=1, step=1, key="result_page") - 1
+    start = page_no * page_size
+    page = res.iloc[start:start + page_size]
+    st.dataframe(page)
+    st.caption(f"Rows {start + 1}-{start + len(page)} of {len(res)}")
 
 def execute_viz_code(viz_code, df):
     local_env = {'df': df, 'np': np, 'pd': pd, 'go': go}
@@ -108,11 +424,12 @@ if __name__ == "__main__":
     ## Init Resources
     db = getDB()
     llm = getLLM()
-    query_runner = QuerySQLDataBaseTool(db = db)
     sample_queries = get_sample_queries()
     table_names = db.get_usable_table_names()
     table_definitions = get_table_definitions(table_names)
     hist = init_history()
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
 
     dba_agent_template = """Given an input question, just create a syntactically correct {dialect} query to run. 
     Do not include any CREATE, DELETE, UPDATE, or ALTER statements in your responses.
@@ -130,6 +447,10 @@ if __name__ == "__main__":
 
     {table_info}.
 
+    Results of the previous questions are also available as local tables. When the current question only refines one of them (filtering, sorting, top N, fewer columns, simple aggregation), query that local table on its own instead, without joining it to the tables above:
+
+    {local_tables}
+
     Previous Questions: {previous_queries}
     Current Question: {input}
     SQLQuery: 
@@ -196,118 +517,189 @@ if __name__ == "__main__":
     show_viz_code = st.sidebar.toggle("Show Python Code for visualization", False)
     show_fetched_data = st.sidebar.toggle("Show Fetched Data", True)
     show_analyst_desc = st.sidebar.toggle("Show Analyst Description", False)
-
-    if st.button("Get results"):
-
-        prev_queries = ''
-        for idx, query in enumerate(hist):
-            prev_queries += f"Question {idx+1}: {query}; "
+    profile_request = st.sidebar.toggle("Profile request", False, disabled=importlib.util.find_spec('pyinstrument') is None,
+                                        help="Record a sampling profile (needs pyinstrument)")
+    cancel_stats = get_cancel_stats()
+    st.sidebar.caption(f"Superseded runs cancelled: {cancel_stats['cancelled_runs']} "
+                       f"(queries {cancel_stats['cancelled_queries']}, LLM calls {cancel_stats['cancelled_llm_calls']}, "
+                       f"~{cancel_stats['seconds_saved']:.1f}s saved)")
+    admission = get_admission()
+    admission_waits = sorted(admission['waits'].copy()) ## copy() is atomic; the LLM loop appends concurrently
+    st.sidebar.caption(f"LLM calls admitted: {admission['admitted']} · waiting: {sum(map(len, list(admission['queue'].values())))} "
+                       f"(max {admission['max_queue_depth']}) · p95 wait {admission_waits[int(0.95 * len(admission_waits))] if admission_waits else 0:.1f}s "
+                       f"· 429s {admission['rate_limited']}")
+    if duckdb is not None:
+        routing = get_local_engine()
+        st.sidebar.caption(f"Questions answered locally: {routing['local']} · sent to Postgres: {routing['remote']}")
+
+    ## The pipeline is a DAG of stages memoized in session state:
+    ##   sql -> data -> summary
+    ##              \-> viz_desc -> viz_code -> figure
+    ## "Get results" starts a new pipeline for the question; later reruns (toggling an option, paging) reuse the
+    ## stages already computed and only run the ones that are newly needed, e.g. just the summary.
+    ## A pipeline only answers the question it was started for: a new "Get results" or an edited question
+    ## replaces it, and whatever it still has in flight is cancelled then.
+    question = selected_sample if user_query == "" else user_query
+    get_results = st.button("Get results")
+    pipeline = st.session_state.get('pipeline')
+    if pipeline is not None and (get_results or pipeline['question'] != question):
+        pipeline['token'].cancel()
+        pipeline = st.session_state.pipeline = None
+    if get_results:
+        pipeline = st.session_state.pipeline = {'question': question, 'nodes': {}, 'token': RunToken(db, st.session_state.session_id)}
+        st.session_state.result_page = 1
+
+    if pipeline is not None:
+        profiler = start_profiler(profile_request)
+        token = pipeline['token']
+        token.interrupted = False
+        status = st.empty()
+        user_query = pipeline['question']
+        local_engine = get_local_engine()
+
+        def generate_sql(stage):
+            prev_queries = ''
+            for idx, query in enumerate(hist):
+                prev_queries += f"Question {idx+1}: {query}; "
+
+            with st.spinner("Querying Database..."):
+                sql_query = llm_call(token, "SQL generation", dba_chain, {
+                    "input": user_query
+                    , "dialect": db.dialect
+                    , "table_info": table_definitions
+                    , "local_tables": describe_local_tables(local_engine)
+                    , "previous_queries": prev_queries
+                }, status).content.strip()
+
+            sql_query = sql_query.replace('`', '')
+            if sql_query.startswith('sql'): sql_query = sql_query[len('sql'):].strip()
+            if 'SQLQuery:' in sql_query: sql_query = sql_query.split('SQLQuery:')[1].strip()
+            return sql_query
+
+        def fetch_data(stage):
+            sql_query = stage('sql')
+            if isinstance(sql_query, StageFailed): return str(sql_query)
+            try:
+                if "CREATE" in sql_query or "DELETE" in sql_query or "UPDATE" in sql_query or "ALTER" in sql_query:  raise DDLCommandException
+                
+                start = time.perf_counter()
+                if is_local_query(local_engine, sql_query):
+                    local_engine['local'] += 1
+                    res = run_local_query(local_engine, sql_query)
+                    if res.empty: raise NoDataFoundException
+                    logger.info("Follow-up answered locally in %.1f ms: %s", (time.perf_counter() - start) * 1000, user_query)
+                else:
+                    local_engine['remote'] += 1
+                    rows, columns = wait_for(token, "Query", lambda: get_query_executor().submit(fetch_rows, token, db, sql_query), status)
+                    
+                    if not rows: raise NoDataFoundException
+                    
+                    res = decimals_to_float(pd.DataFrame.from_records(data = rows, columns=columns))
+                    logger.info("Question sent to Postgres (%.1f ms): %s", (time.perf_counter() - start) * 1000, user_query)
+                register_local_result(local_engine, user_query, res)
+                hist.append(user_query)
             
-        user_query = selected_sample if user_query == "" else user_query
-        with st.spinner("Querying Database..."):
-            sql_query = dba_chain.invoke({
-                "input": user_query
-                , "dialect": db.dialect
-                , "table_info": table_definitions
-                , "previous_queries": prev_queries
-            }).content.strip()
-
-        # print('---')
-        # print(sql_query)
-        # # print(prev_queries)
-
-        sql_query = sql_query.replace('`', '')
-        if sql_query.startswith('sql'): sql_query = sql_query[len('sql'):].strip()
-        if 'SQLQuery:' in sql_query: sql_query = sql_query.split('SQLQuery:')[1].strip()
-        # print('---')
-        # print(sql_query)
+            except DDLCommandException:
+                res = "Invalid SQL Query generated. DDL commands are not allowed. Please try again."
+            except SyntaxError:
+                res = "Invalid SQL Query generated. Please try again. Please try again."
+            except NoDataFoundException:
+                res = "No data found for the query. Please try refining your query."
+            except Exception as e:
+                ## Streamlit stopping this run while the query is still running is not a query error
+                if token.interrupted: raise
+                res = f"Error: {e}. Please try refining your query."
+            return res
+
+        def summarize(stage):
+            res = stage('data')
+            if isinstance(res, str):
+                return "Cannot generate summary for invalid data. Please try again."
+            with st.spinner("Summarizing data..."):
+                return llm_call(token, "Summary", summary_chain, {
+                    "dataframe": res.to_dict()
+                    , "user_query": user_query
+                    }, status).content.strip()
+
+        def describe_viz(stage):
+            res = stage('data')
+            with st.spinner("Generating Visualization..."):
+                head = res.head().to_dict()
+                buffer = StringIO()
+                res.info(buf=buffer)
+                info = buffer.getvalue()
+                data_desc = res.describe().to_string()
+
+                return llm_call(token, "Visualization description", analyst_chain, {
+                    "head": head
+                    , "info": info
+                    , "describe": data_desc
+                    , "input": user_query
+                }, status).content.strip()
+
+        def write_viz_code(stage):
+            res, viz_desc = stage('data'), stage('viz_desc')
+            if isinstance(viz_desc, StageFailed): return viz_desc
+            with st.spinner("Generating Visualization..."):
+                viz_code = llm_call(token, "Visualization code", viz_chain, {
+                    "description": viz_desc,
+                    "dataframe": res.to_dict()
+                }, status).content.strip()
+            viz_code = viz_code.replace('`', '').strip()
+            if viz_code.startswith('python'): viz_code = viz_code[len('python'):].strip()
+            return viz_code
+
+        def build_figure(stage):
+            ## (figure, error message)
+            viz_code = stage('viz_code')
+            if isinstance(viz_code, StageFailed): return None, str(viz_code)
+            try:
+                return execute_viz_code(viz_code, stage('data')), None
+            except Exception as e:
+                return None, f"Error generating visualization: {e}"
+
+        stages = {'sql': generate_sql, 'data': fetch_data, 'summary': summarize,
+                  'viz_desc': describe_viz, 'viz_code': write_viz_code, 'figure': build_figure}
 
         if show_sql:
             st.write("---")
             st.subheader("Generated SQL Query:")
-            st.write(sql_query)
+            st.write(str(run_stage(pipeline, stages, 'sql')))
 
-        try:
-            if "CREATE" in sql_query or "DELETE" in sql_query or "UPDATE" in sql_query or "ALTER" in sql_query:  raise DDLCommandException
-            
-            hist.append(user_query)
-            res = query_runner.invoke(sql_query)
-            res = res.replace('Decimal', '')
-            
-            if res == '': raise NoDataFoundException
-            
-            res = ast.literal_eval(res)
-            columns = get_cols(sql_query)
-            if columns == []: columns = range(len(res[0]))
-            res = pd.DataFrame.from_records(data = res, columns=columns)
-        
-        except DDLCommandException:
-            res = "Invalid SQL Query generated. DDL commands are not allowed. Please try again."
-        except SyntaxError:
-            res = "Invalid SQL Query generated. Please try again. Please try again."
-        except NoDataFoundException:
-            res = "No data found for the query. Please try refining your query."
-        except Exception as e:
-            res = f"Error: {e}. Please try refining your query."
-        
+        res = run_stage(pipeline, stages, 'data')
         if show_fetched_data:
             st.write("---")
             st.subheader("Fetched Results:")
-            st.write(res)
+            if isinstance(res, str): st.write(res)
+            else: show_result_page(res)
 
         if need_summary:
-            if isinstance(res, str):
-                summary = "Cannot generate summary for invalid data. Please try again."
-            else:
-                with st.spinner("Summarizing data..."):
-                    summary = summary_chain.invoke({
-                        "dataframe": res.to_dict()
-                        , "user_query": user_query
-                        }).content.strip()
+            summary = run_stage(pipeline, stages, 'summary')
             st.write("---")
             st.subheader("Summary:")
-            st.write(summary)
+            st.write(str(summary))
         
-        if need_viz:
-            if isinstance(res, str):
-                viz_code = "Cannot generate visualization for invalid data. Please try again."
-            else:
-                with st.spinner("Generating Visualization..."):
-                    head = res.head().to_dict()
-                    buffer = StringIO()
-                    res.info(buf=buffer)
-                    info = buffer.getvalue()
-                    data_desc = res.describe().to_string()
-
-                    viz_desc = analyst_chain.invoke({
-                        "head": head
-                        , "info": info
-                        , "describe": data_desc
-                        , "input": user_query
-                    }).content.strip()
-
-                    if show_analyst_desc:
-                        st.write("---")
-                        st.subheader("Analyst Description:")
-                        st.write(viz_desc)
-
-                    viz_code = viz_chain.invoke({
-                        "description": viz_desc,
-                        "dataframe": res.to_dict()
-                    }).content.strip()
-                    viz_code = viz_code.replace('`', '').strip()
-                    if viz_code.startswith('python'): viz_code = viz_code[len('python'):].strip()
-                    
-                if show_viz_code:
-                    st.write("---")
-                    st.subheader("Visualization Code:")
-                    st.code(viz_code, language='python')
+        if need_viz and not isinstance(res, str):
+            if show_analyst_desc:
+                viz_desc = run_stage(pipeline, stages, 'viz_desc')
+                st.write("---")
+                st.subheader("Analyst Description:")
+                st.write(str(viz_desc))
 
+            if show_viz_code:
+                viz_code = run_stage(pipeline, stages, 'viz_code')
                 st.write("---")
-                st.subheader("Visualization:")
-                try:
-                    fig = execute_viz_code(viz_code, res)
-                    st.plotly_chart(fig)
-                except Exception as e:
-                    st.write(f"Error generating visualization: {e}")
-                # st.button("Open in Plotly", on_click=fig.show)
\ No newline at end of file
+                st.subheader("Visualization Code:")
+                st.code(str(viz_code), language='python')
+
+            fig, viz_error = run_stage(pipeline, stages, 'figure')
+            st.write("---")
+            st.subheader("Visualization:")
+            if viz_error: st.write(viz_error)
+            else: st.plotly_chart(fig)
+            # st.button("Open in Plotly", on_click=fig.show)
+
+        stop_profiler(profiler)
+
+    if st.session_state.get('last_profile'):
+        show_last_profile(st.session_state.last_profile)
@@ -6,7 +6,17 @@ import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 import ast
-import re
+import hashlib
+import time
+import datetime
+from decimal import Decimal
+
+from compaction import compact_dataframe
+from sql_ir import ParsedSQL, parse_sql
+from cassette import cassette, CassetteDatabase
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 
@@ -42,16 +52,51 @@ def execute_viz_code(viz_code: str, df: pd.DataFrame) -> go.Figure:
     exec(viz_code, local_env)
     return local_env['fig']
 
-def clean_sql_query(sql_query: str) -> str:
+## Constructors that show up in the repr of fetched rows (NUMERIC, DATE, TIMESTAMP columns)
+RESULT_CONSTRUCTORS = {
+    'Decimal': Decimal,
+    'datetime.date': datetime.date,
+    'datetime.datetime': datetime.datetime,
+    'datetime.time': datetime.time,
+    'datetime.timedelta': datetime.timedelta,
+}
+
+def _literal_value(node):
+    if isinstance(node, ast.Call):
+        name = ast.unparse(node.func)
+        if name not in RESULT_CONSTRUCTORS or node.keywords:
+            raise ValueError(f"Unexpected value in query result: {ast.unparse(node)}")
+        return RESULT_CONSTRUCTORS[name](*[_literal_value(arg) for arg in node.args])
+    if isinstance(node, (ast.Tuple, ast.List)):
+        values = [_literal_value(elt) for elt in node.elts]
+        return tuple(values) if isinstance(node, ast.Tuple) else values
+    return ast.literal_eval(node)
+
+def parse_query_result(res: str) -> list:
+    ## Like ast.literal_eval, but keeps Decimal and date/time values instead of dropping them via string replacement
+    return _literal_value(ast.parse(res, mode='eval').body)
+
+def hash_dataframe(df: pd.DataFrame) -> str:
+    ## Content hash of a result, used to key work derived from it (summaries, charts).
+    try:
+        row_hashes = pd.util.hash_pandas_object(df, index=True).values.tobytes()
+    except TypeError:
+        ## Unhashable cells (lists, dicts) -- fall back to the JSON form
+        row_hashes = df.to_json(orient='split', date_format='iso').encode()
+    header = '|'.join(map(str, df.columns)).encode()
+    return hashlib.sha256(header + row_hashes).hexdigest()
+
+def clean_sql_query(sql_query: str) -> ParsedSQL:
+    ## Strip the markdown fence / prefixes the LLM wraps around its answer, then parse it once for every later stage
     sql_query = sql_query.replace('`', '').strip()
     if sql_query.startswith('sql'):
         sql_query = sql_query[len('sql'):].strip()
     if 'SQLQuery:' in sql_query:
         sql_query = sql_query.split('SQLQuery:')[1].strip()
-    return sql_query
+    return parse_sql(sql_query)
 
 class DDLCommandException(Exception):
-    "Raised when SQL contains DDL commands (CREATE, DELETE, UPDATE, ALTER)"
+    "Raised when SQL is not a read-only query (CREATE, DELETE, UPDATE, ALTER, ...)"
     pass
 
 class NoDataFoundException(Exception):
@@ -67,34 +112,44 @@ class DBLoader:
         self.port = os.getenv('POSTGRES_PORT')
         self.database = os.getenv('POSTGRES_DB_NAME')
         self.postgresql_uri = f"postgresql+psycopg2://{self.username}:{self.password}@{self.host}:{self.port}/{self.database}"
+        ## Same database through the asyncpg driver, for async_db.AsyncSQLCoder
+        self.async_postgresql_uri = f"postgresql+asyncpg://{self.username}:{self.password}@{self.host}:{self.port}/{self.database}"
 
     def load_db(self) -> SQLDatabase:
+        ## With a cassette active the workflow sees a CassetteDatabase; replaying never connects to Postgres
+        if cassette is not None and cassette.mode == 'replay':
+            return CassetteDatabase(None, cassette)
         db = SQLDatabase.from_uri(self.postgresql_uri)
-        return db
+        return CassetteDatabase(db, cassette) if cassette is not None else db
 
 class SQLCoder:
-    def __init__(self, db: SQLDatabase):
+    def __init__(self, db: SQLDatabase, view_manager=None):
         self.db = db
-        self.query_runner = QuerySQLDataBaseTool(db=db)
+        self.query_runner = db if isinstance(db, CassetteDatabase) else QuerySQLDataBaseTool(db=db)
+        ## Optional matviews.MaterializedViewManager: hot queries get rewritten to read from a materialized view
+        self.view_manager = view_manager
+        ## Memory before/after dtype compaction of the last fetched result
+        self.last_compaction = None
 
     def execute_query(self, query: str) -> pd.DataFrame:
         try:
-            res = self.query_runner.invoke(query)
-            res = res.replace('Decimal', '')
+            query = parse_sql(query)
+            run_query = self.view_manager.rewrite(query) if self.view_manager else query
+            start = time.perf_counter()
+            res = self.query_runner.invoke(str(run_query))
+            if self.view_manager:
+                self.view_manager.record(self.db, query, time.perf_counter() - start, used_view=run_query != query)
             if res == '':
                 raise NoDataFoundException
-            res = ast.literal_eval(res)
+            res = parse_query_result(res)
             columns = self.get_cols(query)
-            if columns == []: columns = range(len(res[0]))
+            if len(columns) != len(res[0]) or '*' in columns: columns = range(len(res[0]))
             res = pd.DataFrame.from_records(data=res, columns=columns)
+            res, self.last_compaction = compact_dataframe(res)
+            logger.info("Result memory: %d -> %d bytes after dtype compaction", self.last_compaction['bytes_before'], self.last_compaction['bytes_after'])
             return res
         except Exception as e:
             raise e
 
     def get_cols(self, sql_query: str) -> list:
-        select_regex = re.compile(r'SELECT\s+(.+?)\s+FROM', re.IGNORECASE | re.DOTALL)
-        all_matches = select_regex.findall(sql_query)
-        if not all_matches: return []
-        final_select = all_matches[-1]
-        columns = [col.strip() for col in final_select.split(',')]
-        return columns
+        return parse_sql(sql_query).output_columns
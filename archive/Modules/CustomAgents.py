@@ -3,7 +3,14 @@
 ## - But result in increased startup time as all chains will be initialized at once. Also, more memory usage.
 ## - Also difficult to manage the chains and prompts in the code.
 
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
 from langchain_core.prompts import PromptTemplate
+from llm_client import for_step
+from token_accounting import account, count_tokens
 
 ## Using CRAG idea to Correct the generated SQL query if needed. I rarely see CRAG being helpful here, there is no need for iterative refinement.
 ## only see CRAG used sometimes in Select * from table_name queries.
@@ -11,7 +18,7 @@ class SQLExpert:
     def __init__(self, llm):
         self.llm = llm
 
-    def generate_query(self, user_query: str, dialect: str, table_info: str, previous_queries: str) -> str:
+    def generate_query(self, user_query: str, dialect: str, table_info: str, previous_queries: str, examples: list = None) -> str:
         dba_agent_template = """Given an input question, just create a syntactically correct {dialect} query to run.
         Do not include any CREATE, DELETE, UPDATE, or ALTER statements in your responses.
         Use Common Table Expressions (CTEs) for data manipulation instead of subqueries.
@@ -29,17 +36,24 @@ class SQLExpert:
 
         {table_info}.
 
-        Previous Questions: {previous_queries}
+        {examples}Previous Questions: {previous_queries}
         Current Question: {user_query}
         SQLQuery:
         """
+        ## examples: (question, sql) pairs of similar questions answered before, from question_index.QuestionIndex
+        examples_text = ''
+        if examples:
+            examples_text = "Here are similar questions that were answered correctly before, with the SQL that was used:\n\n"
+            examples_text += ''.join(f"        Question: {question}\n        SQLQuery: {sql}\n\n" for question, sql in examples)
+            examples_text += "        "
         dba_agent_prompt = PromptTemplate.from_template(dba_agent_template)
-        dba_chain = dba_agent_prompt | self.llm
+        dba_chain = account(dba_agent_prompt, 'generate_query') | for_step(self.llm, 'generate_query')
         sql_query = dba_chain.invoke({
             "user_query": user_query,
             "dialect": dialect,
             "table_info": table_info,
-            "previous_queries": previous_queries
+            "previous_queries": previous_queries,
+            "examples": examples_text
         }).content.strip()
 
 
@@ -67,7 +81,7 @@ class SQLExpert:
         Correction:
         """
         corrective_prompt = PromptTemplate.from_template(corrective_template)
-        corrective_chain = corrective_prompt | self.llm
+        corrective_chain = account(corrective_prompt, 'correct_query') | for_step(self.llm, 'correct_query')
         correction_result = corrective_chain.invoke({
             "user_query": user_query,
             "sql_query": sql_query,
@@ -78,7 +92,8 @@ class SQLExpert:
 
         # print("\n--- Generated SQL Query ---\n", sql_query)
         # print("\n--- Correction ---\n", correction_result)
-        if correction_result.lower().strip() != "all good":
+        ## Smaller critique models (see DEFAULT_STEP_MODELS in workflows.py) often answer "All good." with a full stop
+        if correction_result.lower().strip().rstrip('.') != "all good":
             sql_query = self.adjust_query(sql_query, dialect, table_info, user_query, correction_result, previous_queries)
             # print("\n--- Adjusted SQL Query ---\n", sql_query)
 
@@ -97,7 +112,7 @@ class SQLExpert:
         Adjusted SQL Query:
         """
         adjustment_prompt = PromptTemplate.from_template(adjustment_template)
-        adjustment_chain = adjustment_prompt | self.llm
+        adjustment_chain = account(adjustment_prompt, 'adjust_query') | for_step(self.llm, 'adjust_query')
         adjusted_query = adjustment_chain.invoke({
             "user_query": user_query,
             "sql_query": sql_query,
@@ -114,11 +129,20 @@ class SQLExpert:
         return adjusted_query
 
 ## Using Self Refection and Iterative Refinement to improve the generated summary. Refinement Goal is to make the summary more concise and better answer the user query.
+## Results too large for one prompt are summarized map-reduce style: the DataFrame is split into partitions
+## of at most chunk_tokens (row blocks, or whole groups of group_by), the partitions are summarized
+## concurrently (at most max_parallel LLM calls at once), and the partial summaries are merged.
 class ResponseSummarizer:
-    def __init__(self, llm):
+    def __init__(self, llm, chunk_tokens: int = None, max_parallel: int = None):
         self.llm = llm
+        self.chunk_tokens = chunk_tokens or int(os.getenv('SUMMARY_CHUNK_TOKENS', '6000'))
+        self.max_parallel = max_parallel or int(os.getenv('SUMMARY_MAX_PARALLEL', '4'))
+
+    def summarize(self, user_query: str, dataframe, group_by: str = None) -> str:
+        if self.estimate_tokens(dataframe) > self.chunk_tokens:
+            summary = self.map_reduce_summarize(user_query, dataframe, group_by or self.grouping_column(dataframe))
+            return self.iterative_refinement(user_query, summary)
 
-    def summarize(self, user_query: str, dataframe) -> str:
         summary_agent_template = """You are a data analyst. Given a user query and a pandas DataFrame, summarize the data in a user-readable format.
         Describe the key insights, trends, and any notable observations from the data that answer the user query.
         Make sure to include statistics, comparisons, and any relevant details that provide a clear understanding of the data.
@@ -129,7 +153,7 @@ class ResponseSummarizer:
         Summary:
         """
         summary_agent_prompt = PromptTemplate.from_template(summary_agent_template)
-        summary_chain = summary_agent_prompt | self.llm
+        summary_chain = account(summary_agent_prompt, 'summarize') | for_step(self.llm, 'summarize')
         summary = summary_chain.invoke({"dataframe": dataframe.to_dict(), "user_query": user_query}).content.strip()
 
         summary = self.iterative_refinement(user_query, summary)
@@ -137,12 +161,124 @@ class ResponseSummarizer:
         # print("\n--- Final Summary ---\n", summary)
         return summary
 
+    @staticmethod
+    def tokens_per_row(dataframe) -> int:
+        ## From a sample, so sizing a large result does not serialize all of it
+        sample = dataframe.head(200)
+        return max(1, count_tokens(sample.to_dict()) // max(1, len(sample)))
+
+    def estimate_tokens(self, dataframe) -> int:
+        return self.tokens_per_row(dataframe) * len(dataframe)
+
+    @staticmethod
+    def grouping_column(dataframe, max_groups: int = 32) -> str:
+        ## First low-cardinality label column (region, category, status...), so each part is one meaningful group
+        for column in dataframe.columns:
+            values = dataframe[column]
+            is_label = isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(values) \
+                or pd.api.types.is_object_dtype(values) or pd.api.types.is_bool_dtype(values)
+            if is_label and 2 <= values.nunique() <= max_groups:
+                return column
+        return None
+
+    def partition(self, dataframe, group_by: str = None) -> list:
+        ## [(label, DataFrame), ...], each small enough for one prompt. A group larger than that is cut into row
+        ## blocks; consecutive smaller groups share a partition, so many small groups do not each cost a call.
+        rows_per_chunk = max(1, self.chunk_tokens // self.tokens_per_row(dataframe))
+        if group_by is None or group_by not in dataframe.columns:
+            return self._row_blocks("", dataframe, rows_per_chunk)
+        partitions, pack, pack_rows = [], [], 0
+        for key, group in dataframe.groupby(group_by, sort=False, observed=True, dropna=False):
+            if len(group) > rows_per_chunk:
+                partitions.extend(self._row_blocks(f"{group_by} = {key}", group, rows_per_chunk))
+                continue
+            if pack and pack_rows + len(group) > rows_per_chunk:
+                partitions.append(self._pack(group_by, pack))
+                pack, pack_rows = [], 0
+            pack.append((key, group))
+            pack_rows += len(group)
+        if pack:
+            partitions.append(self._pack(group_by, pack))
+        return partitions
+
+    @staticmethod
+    def _row_blocks(label: str, dataframe, rows_per_chunk: int) -> list:
+        blocks = []
+        for start in range(0, len(dataframe), rows_per_chunk):
+            block = dataframe.iloc[start:start + rows_per_chunk]
+            position = f"rows {start + 1}-{start + len(block)} of {len(dataframe)}"
+            blocks.append((f"{label}, {position}" if label else position, block))
+        return blocks
+
+    @staticmethod
+    def _pack(group_by: str, pack: list) -> tuple:
+        if len(pack) == 1:
+            return f"{group_by} = {pack[0][0]}", pack[0][1]
+        return f"{group_by} in ({', '.join(str(key) for key, _ in pack)})", pd.concat([group for _, group in pack])
+
+    def _parallel(self, fn, items: list) -> list:
+        ## Each task gets its own copy of the caller's context so token accounting stays on this request
+        with ThreadPoolExecutor(max_workers=self.max_parallel, thread_name_prefix="summary") as pool:
+            futures = [pool.submit(contextvars.copy_context().run, fn, *item) for item in items]
+            return [future.result() for future in futures]
+
+    def summarize_partition(self, user_query: str, label: str, partition) -> str:
+        partition_template = """You are a data analyst. You are given one part of a larger result of a query ({label}).
+        Summarize this part so it can be merged with summaries of the other parts: the key figures, extremes, trends and notable observations relevant to the user query.
+        Keep exact numbers. Do not speculate about the rows you cannot see.
+
+        User Query: {user_query}
+        DataFrame part:
+        {dataframe}
+        Partial Summary:
+        """
+        partition_prompt = PromptTemplate.from_template(partition_template)
+        partition_chain = account(partition_prompt, 'summarize_chunk') | for_step(self.llm, 'summarize_chunk')
+        return partition_chain.invoke({"label": label, "user_query": user_query, "dataframe": partition.to_dict()}).content.strip()
+
+    def merge_summaries(self, user_query: str, overview: str, summaries: str) -> str:
+        merge_template = """You are a data analyst. A query result was too large to read at once, so it was split into parts and each part was summarized.
+        Combine the partial summaries into one user-readable summary that answers the user query: key insights, trends, statistics and comparisons across the whole result.
+        Use the overview for totals and overall statistics rather than adding up the parts.
+
+        User Query: {user_query}
+        Overview of the whole result:
+        {overview}
+        Partial Summaries:
+        {summaries}
+        Summary:
+        """
+        merge_prompt = PromptTemplate.from_template(merge_template)
+        merge_chain = account(merge_prompt, 'reduce_summary') | for_step(self.llm, 'reduce_summary')
+        return merge_chain.invoke({"user_query": user_query, "overview": overview, "summaries": summaries}).content.strip()
+
+    def map_reduce_summarize(self, user_query: str, dataframe, group_by: str = None) -> str:
+        partitions = self.partition(dataframe, group_by)
+        partials = self._parallel(lambda label, part: f"[{label}]\n" + self.summarize_partition(user_query, label, part), partitions)
+        overview = f"{len(dataframe)} rows, columns: {', '.join(map(str, dataframe.columns))}\n{dataframe.describe(include='all').to_string()}"
+        ## Reduce in rounds: merge as many partial summaries as fit in one prompt, in parallel, until one is left
+        while len(partials) > 1:
+            batches, batch = [], []
+            for partial in partials:
+                if batch and count_tokens('\n\n'.join(batch + [partial])) > self.chunk_tokens:
+                    batches.append(batch)
+                    batch = []
+                batch.append(partial)
+            batches.append(batch)
+            if len(batches) == 1:
+                return self.merge_summaries(user_query, overview, '\n\n'.join(batches[0]))
+            ## Guarantee progress even when single partial summaries are over budget
+            if len(batches) == len(partials):
+                batches = [partials[idx:idx + 2] for idx in range(0, len(partials), 2)]
+            partials = self._parallel(lambda batch: self.merge_summaries(user_query, overview, '\n\n'.join(batch)), [(batch,) for batch in batches])
+        return partials[0]
+
     def iterative_refinement(self, user_query: str, summary: str, max_iterations = 3) -> str:
         for _ in range(max_iterations):
             reflection_result = self.self_reflect(user_query, summary)
             # print("\n--- Summary ---\n", summary)
             # print("\n--- Reflection ---\n", reflection_result)
-            if reflection_result.lower().strip() == "all good":
+            if reflection_result.lower().strip().rstrip('.') == "all good":
                 break
             summary = self.adjust_summary(user_query, summary, reflection_result)
         return summary
@@ -156,7 +292,7 @@ class ResponseSummarizer:
         Reflection:
         """
         reflection_prompt = PromptTemplate.from_template(reflection_template)
-        reflection_chain = reflection_prompt | self.llm
+        reflection_chain = account(reflection_prompt, 'summary_reflect') | for_step(self.llm, 'summary_reflect')
         reflection_result = reflection_chain.invoke({"user_query": user_query, "summary": summary}).content.strip()
 
         return reflection_result
@@ -170,7 +306,7 @@ class ResponseSummarizer:
         Adjusted Summary:
         """
         adjustment_prompt = PromptTemplate.from_template(adjustment_template)
-        adjustment_chain = adjustment_prompt | self.llm
+        adjustment_chain = account(adjustment_prompt, 'adjust_summary') | for_step(self.llm, 'adjust_summary')
         adjusted_summary = adjustment_chain.invoke({"user_query": user_query, "summary": summary, "reflection": reflection}).content.strip()
 
 
@@ -204,7 +340,7 @@ class AnalystAgent:
         Description:
         """
         analyst_agent_prompt = PromptTemplate.from_template(analyst_agent_template)
-        analyst_chain = analyst_agent_prompt | self.llm
+        analyst_chain = account(analyst_agent_prompt, 'viz_description') | for_step(self.llm, 'viz_description')
         viz_desc = analyst_chain.invoke({
             "head": head,
             "info": info,
@@ -232,14 +368,14 @@ class AnalystAgent:
         Reflection:
         """
         reflection_prompt = PromptTemplate.from_template(reflection_template)
-        reflection_chain = reflection_prompt | self.llm
+        reflection_chain = account(reflection_prompt, 'viz_reflect') | for_step(self.llm, 'viz_reflect')
         reflection_result = reflection_chain.invoke({
             "user_query": user_query,
             "viz_desc": viz_desc
         }).content.strip()
 
         # print("\n--- Reflection ---\n", reflection_result)
-        if reflection_result.lower().strip() != "all good":
+        if reflection_result.lower().strip().rstrip('.') != "all good":
             viz_desc = self.adjust_description(user_query, viz_desc, reflection_result)
             # print("\n--- Adjusted Visualization Description ---\n", viz_desc)
 
@@ -257,7 +393,7 @@ class AnalystAgent:
         Adjusted Visualization Description:
         """
         adjustment_prompt = PromptTemplate.from_template(adjustment_template)
-        adjustment_chain = adjustment_prompt | self.llm
+        adjustment_chain = account(adjustment_prompt, 'adjust_viz_description') | for_step(self.llm, 'adjust_viz_description')
         adjusted_viz_desc = adjustment_chain.invoke({
             "user_query": user_query,
             "viz_desc": viz_desc,
@@ -291,7 +427,7 @@ class VisualizationAgent:
         Visualization Code:
         """
         viz_agent_prompt = PromptTemplate.from_template(viz_agent_template)
-        viz_chain = viz_agent_prompt | self.llm
+        viz_chain = account(viz_agent_prompt, 'viz_code') | for_step(self.llm, 'viz_code')
         viz_code = viz_chain.invoke({"description": description, "dataframe": dataframe.to_dict()}).content.strip()
         viz_code = viz_code.replace('`', '').strip()
         if viz_code.startswith('python'): viz_code = viz_code[len('python'):].strip()
@@ -0,0 +1,250 @@
+## Admission control for LLM calls, shared by every chain in the process.
+## A call is only sent once it fits two token buckets: requests per minute (LLM_RPM) and tokens per minute
+## (LLM_TPM; prompt tokens plus LLM_COMPLETION_ESTIMATE for the answer). Calls that do not fit wait in line
+## here instead of going out, coming back as 429s and being retried into the same wall. The line is ordered
+## by priority (interactive before batch) and round-robin across sessions within a priority, so one session
+## with many calls in flight (a large summary, a batch) cannot starve the others.
+## Once a call returns, its estimate is replaced by the provider's reported usage. A 429 that still gets
+## through pauses admissions for the provider's retry-after.
+##
+## With ADMISSION_STORE set to a file path the buckets live in SQLite, so every process on the host (several
+## Streamlit servers, service.py workers) draws from one budget. Queueing and fair share stay per process.
+
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger(__name__)
+
+PRIORITIES = ('interactive', 'batch')
+
+_current_priority = contextvars.ContextVar('admission_priority', default='interactive')
+_current_session = contextvars.ContextVar('admission_session', default=None)
+
+
+class AdmissionTimeoutException(Exception):
+    "Raised when an LLM call waited longer than the admission timeout for its turn"
+    pass
+
+
+class TokenBuckets:
+    ## Request and token buckets that refill continuously up to one minute's budget
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._lock = threading.Lock()
+        self.state = {'requests': rpm, 'tokens': tpm, 'updated_at': time.time(), 'paused_until': 0.0}
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            yield self.state
+
+    def _refill(self, state: dict, now: float):
+        elapsed = max(0.0, now - state['updated_at'])
+        state['requests'] = min(self.rpm, state['requests'] + elapsed * self.rpm / 60)
+        state['tokens'] = min(self.tpm, state['tokens'] + elapsed * self.tpm / 60)
+        state['updated_at'] = now
+
+    def try_take(self, tokens: int) -> float:
+        ## Takes one request and `tokens` tokens and returns 0, or returns the seconds until they would fit
+        now = time.time()
+        with self._transaction() as state:
+            self._refill(state, now)
+            if state['paused_until'] > now:
+                return state['paused_until'] - now
+            ## A call larger than the whole budget waits for a full bucket rather than forever
+            tokens = min(tokens, self.tpm)
+            missing_requests = 1 - state['requests']
+            missing_tokens = tokens - state['tokens']
+            if missing_requests <= 0 and missing_tokens <= 0:
+                state['requests'] -= 1
+                state['tokens'] -= tokens
+                return 0.0
+            return max(missing_requests * 60 / self.rpm, missing_tokens * 60 / self.tpm)
+
+    def adjust(self, tokens: int):
+        ## Charges (or refunds, if negative) tokens after the fact; the bucket may go below zero
+        with self._transaction() as state:
+            state['tokens'] = min(self.tpm, state['tokens'] - tokens)
+
+    def pause(self, seconds: float):
+        with self._transaction() as state:
+            state['paused_until'] = max(state['paused_until'], time.time() + seconds)
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self._transaction() as state:
+            self._refill(state, now)
+            return {'requests_available': state['requests'], 'tokens_available': state['tokens'],
+                    'paused_for': max(0.0, state['paused_until'] - now)}
+
+
+class SQLiteTokenBuckets(TokenBuckets):
+    ## Same buckets, kept in one SQLite row that every process on the host updates under BEGIN IMMEDIATE
+    def __init__(self, path: str, rpm: float, tpm: float, name: str = 'llm'):
+        super().__init__(rpm, tpm)
+        self.name = name
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS admission_buckets (
+                name TEXT PRIMARY KEY,
+                requests REAL NOT NULL,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                paused_until REAL NOT NULL
+            )
+        """)
+        self.conn.execute("INSERT OR IGNORE INTO admission_buckets VALUES (?, ?, ?, ?, 0)", (name, rpm, tpm, time.time()))
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT requests, tokens, updated_at, paused_until FROM admission_buckets WHERE name = ?",
+                                        (self.name,)).fetchone()
+                state = dict(zip(('requests', 'tokens', 'updated_at', 'paused_until'), row))
+                yield state
+                self.conn.execute("UPDATE admission_buckets SET requests = ?, tokens = ?, updated_at = ?, paused_until = ? WHERE name = ?",
+                                  (state['requests'], state['tokens'], state['updated_at'], state['paused_until'], self.name))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+
+class AdmissionController:
+    def __init__(self, buckets: TokenBuckets, max_wait: float = 120, completion_estimate: int = 500):
+        self.buckets = buckets
+        self.max_wait = max_wait
+        self.completion_estimate = completion_estimate
+        self._cond = threading.Condition()
+        ## priority -> session -> waiting calls (FIFO); a session moves to the back once one of its calls is admitted
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.metrics = {priority: {'admitted': 0, 'timeouts': 0, 'max_queue_depth': 0} for priority in PRIORITIES}
+        self.waits = {priority: deque(maxlen=1000) for priority in PRIORITIES}
+        self.rate_limited_responses = 0
+
+    def begin(self, priority: str = None, session: str = None):
+        ## Applies to LLM calls made from here on in this thread/context (like token_accountant.begin_request)
+        if priority is not None:
+            if priority not in PRIORITIES:
+                raise ValueError(f"Unknown priority: {priority}")
+            _current_priority.set(priority)
+        if session is not None:
+            _current_session.set(session)
+
+    @contextmanager
+    def context(self, priority: str = None, session: str = None):
+        ## Applies to every LLM call made inside the block
+        priority_token, session_token = _current_priority.set(_current_priority.get()), _current_session.set(_current_session.get())
+        try:
+            self.begin(priority, session)
+            yield
+        finally:
+            _current_session.reset(session_token)
+            _current_priority.reset(priority_token)
+
+    def _head(self):
+        for priority in PRIORITIES:
+            sessions = self.queues[priority]
+            if sessions:
+                return next(iter(sessions.values()))[0]
+        return None
+
+    def _dequeue(self, waiter: dict, admitted: bool):
+        sessions = self.queues[waiter['priority']]
+        waiting = sessions[waiter['session']]
+        waiting.remove(waiter)
+        if not waiting:
+            del sessions[waiter['session']]
+        elif admitted:
+            sessions.move_to_end(waiter['session'])
+
+    def acquire(self, prompt_tokens: int) -> dict:
+        ## Blocks until it is this call's turn and the budget allows it; returns a ticket for release()
+        waiter = {'priority': _current_priority.get(), 'session': _current_session.get(),
+                  'tokens': prompt_tokens + self.completion_estimate}
+        metrics = self.metrics[waiter['priority']]
+        start = time.perf_counter()
+        with self._cond:
+            self.queues[waiter['priority']].setdefault(waiter['session'], deque()).append(waiter)
+            metrics['max_queue_depth'] = max(metrics['max_queue_depth'], self._depth(waiter['priority']))
+            admitted = False
+            try:
+                while True:
+                    ## Only the head of the line takes from the buckets; the rest wait to be notified
+                    retry_in = self.buckets.try_take(waiter['tokens']) if self._head() is waiter else None
+                    if retry_in == 0:
+                        admitted = True
+                        break
+                    remaining = self.max_wait - (time.perf_counter() - start)
+                    if remaining <= 0:
+                        metrics['timeouts'] += 1
+                        raise AdmissionTimeoutException(f"LLM call waited more than {self.max_wait}s for the rate limit")
+                    self._cond.wait(remaining if retry_in is None else min(retry_in, remaining))
+            finally:
+                self._dequeue(waiter, admitted)
+                self._cond.notify_all()
+            waited = time.perf_counter() - start
+            metrics['admitted'] += 1
+            self.waits[waiter['priority']].append(waited)
+        if waited > 1:
+            logger.info("LLM call (%s, session %s) waited %.1fs for admission", waiter['priority'], waiter['session'], waited)
+        return {'tokens': waiter['tokens'], 'waited': waited}
+
+    def try_acquire(self, prompt_tokens: int) -> dict:
+        ## Non-blocking: a ticket if nobody is waiting and the budget allows the call right now, else None
+        tokens = prompt_tokens + self.completion_estimate
+        with self._cond:
+            if self._head() is not None or self.buckets.try_take(tokens) != 0:
+                return None
+        return {'tokens': tokens, 'waited': 0.0}
+
+    def release(self, ticket: dict, used_tokens: int):
+        ## Replaces the ticket's estimate with the tokens the call actually used
+        self.buckets.adjust(used_tokens - ticket['tokens'])
+        with self._cond:
+            self._cond.notify_all()
+
+    def rate_limited(self, retry_after: float):
+        ## The provider answered 429 anyway (another client on the same key, a stale budget): hold everyone back
+        self.buckets.pause(retry_after)
+        with self._cond:
+            self.rate_limited_responses += 1
+        logger.warning("LLM provider rate limit hit; pausing admissions for %.1fs", retry_after)
+
+    def _depth(self, priority: str) -> int:
+        return sum(len(waiting) for waiting in self.queues[priority].values())
+
+    def get_metrics(self) -> dict:
+        from llm_client import percentile
+        with self._cond:
+            priorities = {}
+            for priority in PRIORITIES:
+                waits = list(self.waits[priority])
+                priorities[priority] = dict(self.metrics[priority], queue_depth=self._depth(priority),
+                                            sessions_waiting=len(self.queues[priority]),
+                                            wait_p50=percentile(waits, 0.50), wait_p95=percentile(waits, 0.95),
+                                            wait_max=max(waits, default=0.0))
+            rate_limited_responses = self.rate_limited_responses
+        return {'priorities': priorities, 'rate_limited_responses': rate_limited_responses,
+                'rpm': self.buckets.rpm, 'tpm': self.buckets.tpm, **self.buckets.snapshot()}
+
+
+def make_admission_controller() -> AdmissionController:
+    rpm, tpm = float(os.getenv('LLM_RPM', 500)), float(os.getenv('LLM_TPM', 30000))
+    store = os.getenv('ADMISSION_STORE')
+    buckets = SQLiteTokenBuckets(store, rpm, tpm) if store else TokenBuckets(rpm, tpm)
+    return AdmissionController(buckets, max_wait=float(os.getenv('ADMISSION_MAX_WAIT', 120)),
+                               completion_estimate=int(os.getenv('LLM_COMPLETION_ESTIMATE', 500)))
+
+
+admission_controller = make_admission_controller()
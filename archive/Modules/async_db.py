@@ -0,0 +1,58 @@
+## Async database execution path.
+## SQLCoder.execute_query blocks a thread for the whole Postgres round-trip. AsyncSQLCoder runs the same
+## query on an async SQLAlchemy engine (asyncpg driver) with its own connection pool, so one event loop can
+## keep many queries in flight and overlap them with LLM calls (see DataAnalyticsWorkflow.arun_batch).
+## It applies the same materialized-view rewrite and dtype compaction as SQLCoder, and takes column
+## names from the cursor instead of parsing them out of the SQL.
+##
+## Needs:  pip install "sqlalchemy[asyncio]" asyncpg
+## Pool size: ASYNC_DB_POOL_SIZE (default 10) and ASYNC_DB_MAX_OVERFLOW (default 10).
+
+import os
+import time
+
+import pandas as pd
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from Agent_Helpers import NoDataFoundException
+from compaction import compact_dataframe
+from sql_ir import parse_sql
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class AsyncSQLCoder:
+    def __init__(self, uri: str, view_manager=None, sync_db=None, pool_size: int = None, max_overflow: int = None):
+        ## The engine's connections belong to the event loop they were opened on; use one AsyncSQLCoder per loop
+        self.engine = create_async_engine(
+            uri,
+            pool_size=pool_size or int(os.getenv('ASYNC_DB_POOL_SIZE', '10')),
+            max_overflow=max_overflow if max_overflow is not None else int(os.getenv('ASYNC_DB_MAX_OVERFLOW', '10')),
+            pool_pre_ping=True,
+        )
+        ## Optional matviews.MaterializedViewManager; it creates and refreshes views through the sync SQLDatabase
+        self.view_manager = view_manager if sync_db is not None else None
+        self.sync_db = sync_db
+        self.last_compaction = None
+
+    async def execute_query(self, query: str) -> pd.DataFrame:
+        query = parse_sql(query)
+        run_query = self.view_manager.rewrite(query) if self.view_manager else query
+        start = time.perf_counter()
+        async with self.engine.connect() as connection:
+            ## Driver-level execution: the generated SQL is passed through untouched (no bind-parameter parsing)
+            result = await connection.exec_driver_sql(str(run_query))
+            rows = result.fetchall()
+            columns = list(result.keys())
+        if self.view_manager:
+            self.view_manager.record(self.sync_db, query, time.perf_counter() - start, used_view=run_query != query)
+        if not rows:
+            raise NoDataFoundException
+        res = pd.DataFrame.from_records(data=[tuple(row) for row in rows], columns=columns)
+        res, self.last_compaction = compact_dataframe(res)
+        logger.info("Result memory: %d -> %d bytes after dtype compaction", self.last_compaction['bytes_before'], self.last_compaction['bytes_after'])
+        return res
+
+    async def dispose(self):
+        await self.engine.dispose()
@@ -0,0 +1,167 @@
+## Record/replay cassettes for LLM and database calls.
+## With CASSETTE_MODE=record every chat completion and every database call made by the workflow is written,
+## together with how long it took, to CASSETTE_PATH (JSON lines). With CASSETTE_MODE=replay the same calls are
+## answered from that file without OpenAI or Postgres, so DataAnalyticsWorkflow.run_workflow can be profiled
+## and regression-tested offline. CASSETTE_REPLAY_LATENCY=true sleeps for the recorded duration of each call.
+##
+## Requests are matched on their full content (model + prompt text, SQL text). Identical requests replay
+## their recorded responses in order; a request that was never recorded raises CassetteMissException.
+##
+## python cassette.py --cassette cassettes/chinook.jsonl "Retrieve the album title and the artist name for each album."
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import Runnable
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CassetteMissException(Exception):
+    "Raised in replay mode when a call was not recorded on the cassette"
+    pass
+
+
+class Cassette:
+    def __init__(self, path: str, mode: str = 'replay', replay_latency: bool = False):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self._lock = threading.Lock()
+        ## key -> recorded entries not replayed yet; the last one is kept for any further identical requests
+        self.tape = {}
+        self.metrics = {'recorded': 0, 'replayed': 0, 'misses': 0}
+        if mode == 'replay':
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.tape.setdefault(entry['key'], deque()).append(entry)
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        mode = os.getenv('CASSETTE_MODE', 'off').lower()
+        if mode == 'off':
+            return None
+        return cls(os.getenv('CASSETTE_PATH', 'cassettes/default.jsonl'), mode,
+                   os.getenv('CASSETTE_REPLAY_LATENCY', 'false').lower() == 'true')
+
+    @staticmethod
+    def make_key(kind: str, request) -> str:
+        return hashlib.sha256(json.dumps([kind, request], sort_keys=True, default=str).encode()).hexdigest()
+
+    def call(self, kind: str, request, fn):
+        ## Record: run fn() and store its (JSON-serializable) result. Replay: return the recorded result.
+        key = self.make_key(kind, request)
+        if self.mode == 'replay':
+            with self._lock:
+                entries = self.tape.get(key)
+                if not entries:
+                    self.metrics['misses'] += 1
+                    raise CassetteMissException(f"No recorded {kind} call for: {str(request)[:200]}")
+                entry = entries.popleft() if len(entries) > 1 else entries[0]
+                self.metrics['replayed'] += 1
+            if self.replay_latency:
+                time.sleep(entry['seconds'])
+            return entry['response']
+
+        start = time.perf_counter()
+        response = fn()
+        entry = {'key': key, 'kind': kind, 'request': request, 'response': response,
+                 'seconds': time.perf_counter() - start, 'recorded_at': time.time()}
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, default=str) + '\n')
+            self.metrics['recorded'] += 1
+        return response
+
+
+class CassetteLLM(Runnable):
+    ## Wraps a chat model (None when replaying, so no API key is needed); sits under ResilientLLM
+    def __init__(self, llm, cassette: Cassette, model_name: str):
+        self.llm = llm
+        self.cassette = cassette
+        self.model_name = model_name
+
+    def invoke(self, input, config=None, **kwargs):
+        prompt = input.to_string() if hasattr(input, 'to_string') else str(input)
+
+        def complete():
+            message = self.llm.invoke(input, config, **kwargs)
+            if isinstance(message, str):
+                return {'content': message}
+            return {'content': message.content, 'usage_metadata': message.usage_metadata,
+                    'response_metadata': message.response_metadata}
+
+        response = self.cassette.call('llm', {'model': self.model_name, 'prompt': prompt}, complete)
+        return AIMessage(content=response['content'], usage_metadata=response.get('usage_metadata'),
+                         response_metadata=response.get('response_metadata') or {})
+
+
+class CassetteDatabase:
+    ## Stands in for SQLDatabase in the workflow: schema lookups and queries go through the cassette.
+    ## When replaying there is no real database (db is None) and anything not on the cassette is unavailable.
+    def __init__(self, db, cassette: Cassette):
+        self.db = db
+        self.cassette = cassette
+        self._query_tool = None
+
+    @property
+    def dialect(self) -> str:
+        return self.cassette.call('db.dialect', None, lambda: self.db.dialect)
+
+    def get_table_info(self, table_names=None) -> str:
+        return self.cassette.call('db.table_info', table_names, lambda: self.db.get_table_info(table_names))
+
+    def get_usable_table_names(self) -> list:
+        return self.cassette.call('db.table_names', None, lambda: list(self.db.get_usable_table_names()))
+
+    def invoke(self, sql_query: str) -> str:
+        ## Same contract as QuerySQLDataBaseTool.invoke: the result rows (or the error) as a string
+        def run():
+            if self._query_tool is None:
+                from langchain_community.tools.sql_database.tool import QuerySQLDataBaseTool
+                self._query_tool = QuerySQLDataBaseTool(db=self.db)
+            return self._query_tool.invoke(sql_query)
+        return self.cassette.call('db.query', str(sql_query), run)
+
+    def __getattr__(self, name):
+        if self.db is None:
+            raise CassetteMissException(f"SQLDatabase.{name} is not available while replaying a cassette")
+        return getattr(self.db, name)
+
+
+cassette = Cassette.from_env()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('questions', nargs='+')
+    parser.add_argument('--cassette', default='cassettes/default.jsonl')
+    parser.add_argument('--record', action='store_true', help="call OpenAI/Postgres and record instead of replaying")
+    parser.add_argument('--latency', action='store_true', help="replay at the recorded latency")
+    args = parser.parse_args()
+
+    os.environ.update({'CASSETTE_MODE': 'record' if args.record else 'replay', 'CASSETTE_PATH': args.cassette,
+                       'CASSETTE_REPLAY_LATENCY': 'true' if args.latency else 'false'})
+    ## Imported after the environment is set so the workflow picks the cassette up
+    import cassette as active
+    from workflows import DataAnalyticsWorkflow
+
+    workflow = DataAnalyticsWorkflow()
+    for question in args.questions:
+        start = time.perf_counter()
+        workflow.run_workflow(question)
+        print(f"{time.perf_counter() - start:8.3f}s  {question}")
+    print(active.cassette.metrics)
@@ -0,0 +1,83 @@
+## Post-fetch dtype compaction for query results.
+## DataFrame.from_records leaves strings as object columns and every number as 64-bit. This pass
+## downcasts integers (to nullable Int types when there are NULLs), turns low-cardinality strings into
+## categoricals and the rest into Arrow-backed strings, and keeps NUMERIC values as fixed-precision decimals.
+
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+## A string column becomes categorical when it has at least this many rows and at most this share of distinct values
+CATEGORY_MIN_ROWS = 50
+CATEGORY_MAX_RATIO = 0.5
+
+
+def _smallest_int_dtype(values: pd.Series, nullable: bool) -> str:
+    low, high = values.min(), values.max()
+    for bits in (8, 16, 32):
+        info = np.iinfo(f'int{bits}')
+        if info.min <= low and high <= info.max:
+            return f'Int{bits}' if nullable else f'int{bits}'
+    return 'Int64' if nullable else 'int64'
+
+
+def _decimal_dtype(values: pd.Series):
+    ## decimal128(precision, scale) wide enough for every value, or None if it cannot be represented
+    if pa is None:
+        return None
+    int_digits, scale = 1, 0
+    for value in values:
+        if not value.is_finite():
+            return None
+        sign, digits, exponent = value.as_tuple()
+        scale = max(scale, -exponent)
+        int_digits = max(int_digits, len(digits) + exponent)
+    precision = int_digits + scale
+    if precision > 38:
+        return None
+    return pd.ArrowDtype(pa.decimal128(precision, scale))
+
+
+def _compact_column(col: pd.Series) -> pd.Series:
+    non_null = col.dropna()
+    if len(non_null) == 0:
+        return col
+
+    if col.dtype.kind in 'iu':
+        return col.astype(_smallest_int_dtype(col, nullable=False))
+
+    if col.dtype != object:
+        return col
+
+    kinds = {type(value) for value in non_null}
+    if kinds == {Decimal}:
+        dtype = _decimal_dtype(non_null)
+        return col.astype(dtype) if dtype is not None else col
+    if kinds == {int}:
+        return col.astype(_smallest_int_dtype(non_null, nullable=True))
+    if kinds == {bool}:
+        return col.astype('boolean')
+    if kinds == {str}:
+        if len(col) >= CATEGORY_MIN_ROWS and non_null.nunique() <= CATEGORY_MAX_RATIO * len(col):
+            return col.astype('category')
+        return col.astype('string[pyarrow]' if pa is not None else 'string')
+    return col
+
+
+def compact_dataframe(df: pd.DataFrame) -> tuple:
+    ## Returns (compacted DataFrame, {'bytes_before', 'bytes_after', 'dtypes'})
+    bytes_before = int(df.memory_usage(deep=True).sum())
+    compacted = pd.DataFrame({idx: _compact_column(df.iloc[:, idx]) for idx in range(df.shape[1])}, index=df.index)
+    compacted.columns = df.columns
+    bytes_after = int(compacted.memory_usage(deep=True).sum())
+    return compacted, {
+        'bytes_before': bytes_before,
+        'bytes_after': bytes_after,
+        'dtypes': {str(col): str(dtype) for col, dtype in compacted.dtypes.items()},
+    }
@@ -0,0 +1,65 @@
+## Throughput benchmark: sync SQLCoder on a thread pool vs AsyncSQLCoder on one event loop.
+## Both run the same queries against the database from .env with the same concurrency. The default query
+## sleeps in Postgres to stand in for a slow round-trip; pass --sql to benchmark real queries instead.
+##
+## python db_bench.py --queries 200 --concurrency 1 8 32
+
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from Agent_Helpers import DBLoader, SQLCoder
+from async_db import AsyncSQLCoder
+from llm_client import percentile
+
+
+def run_sync(coder: SQLCoder, sql_queries: list, concurrency: int) -> list:
+    def timed(sql_query):
+        start = time.perf_counter()
+        coder.execute_query(sql_query)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(timed, sql_queries))
+
+
+async def run_async(uri: str, sql_queries: list, concurrency: int) -> list:
+    coder = AsyncSQLCoder(uri, pool_size=concurrency, max_overflow=0)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(sql_query):
+        async with semaphore:
+            start = time.perf_counter()
+            await coder.execute_query(sql_query)
+            return time.perf_counter() - start
+
+    try:
+        return await asyncio.gather(*(timed(sql_query) for sql_query in sql_queries))
+    finally:
+        await coder.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--sql', action='append', help="query to run (repeatable); default simulates a 50 ms round-trip")
+    args = parser.parse_args()
+
+    loader = DBLoader()
+    db = loader.load_db()
+    sql_queries = args.sql or ["SELECT pg_sleep(0.05) IS NULL AS slept, 1 AS one"]
+    sql_queries = [sql_queries[idx % len(sql_queries)] for idx in range(args.queries)]
+
+    ## The sync path shares SQLDatabase's engine pool (SQLAlchemy default: 5 + 10 overflow connections)
+    print(f"{'mode':>6} {'conc':>5} {'queries/s':>10} {'p50':>8} {'p95':>8}")
+    for concurrency in args.concurrency:
+        for mode in ('sync', 'async'):
+            start = time.perf_counter()
+            if mode == 'sync':
+                latencies = run_sync(SQLCoder(db), sql_queries, concurrency)
+            else:
+                latencies = asyncio.run(run_async(loader.async_postgresql_uri, sql_queries, concurrency))
+            throughput = len(sql_queries) / (time.perf_counter() - start)
+            print(f"{mode:>6} {concurrency:>5} {throughput:>10.1f} {percentile(latencies, 0.5):>8.3f} {percentile(latencies, 0.95):>8.3f}")
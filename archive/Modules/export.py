@@ -0,0 +1,137 @@
+## Streaming export of a full query result to a compressed file.
+## The query runs again through a server-side cursor (stream_results) and is written batch by batch:
+## gzipped CSV with the csv module, or Parquet with one zstd row group per batch through pyarrow. No DataFrame
+## is built and at most one batch of rows is held, so memory stays flat however large the result is.
+## progress(rows_written, bytes_written) is called after every batch.
+##
+## Parquet column types come from the first batch. Columns that are all NULL there are written as strings.
+## NUMERIC columns are written as decimal(38, s): s is the column's declared scale from the cursor description,
+## or 18 for NUMERIC without one. Values are rounded to that scale, since unconstrained NUMERIC results (e.g.
+## a division) can carry more decimal places than any fixed scale.
+
+import csv
+import gzip
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from decimal import Context, Decimal
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from Agent_Helpers import DDLCommandException
+from sql_ir import parse_sql
+
+import logging
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {'csv': '.csv.gz', 'parquet': '.parquet'}
+## Enough digits for any decimal128(38, s) value, so rounding to the scale never loses integer digits
+DECIMAL_CONTEXT = Context(prec=38)
+
+
+def export_path(fmt: str, name: str = 'result') -> str:
+    directory = os.getenv('EXPORT_DIR', 'Exports')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}{EXPORT_FORMATS[fmt]}")
+
+
+def _decimal_scales(result) -> list:
+    ## Declared scale per column (DB-API description: name, type_code, display_size, internal_size, precision, scale, null_ok)
+    description = result.cursor.description if result.cursor is not None else None
+    return [column[5] for column in description] if description else []
+
+
+def _arrow_schema(columns: list, rows: list, scales: list = ()) -> pa.Schema:
+    fields = []
+    for idx, name in enumerate(columns):
+        values = [row[idx] for row in rows]
+        arrow_type = pa.array(values).type
+        if pa.types.is_null(arrow_type):
+            arrow_type = pa.string()
+        elif pa.types.is_decimal(arrow_type):
+            scale = scales[idx] if idx < len(scales) and scales[idx] is not None and 0 <= scales[idx] <= 38 else 18
+            arrow_type = pa.decimal128(38, scale)
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+
+def _record_batch(schema: pa.Schema, rows: list) -> pa.RecordBatch:
+    arrays = []
+    for idx, field in enumerate(schema):
+        values = [row[idx] for row in rows]
+        if pa.types.is_string(field.type):
+            values = [None if value is None else str(value) for value in values]
+        elif pa.types.is_decimal(field.type):
+            step = Decimal(1).scaleb(-field.type.scale)
+            values = [None if value is None else Decimal(value).quantize(step, context=DECIMAL_CONTEXT) for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _write_csv(result, path: str, batch_rows: int, progress) -> int:
+    rows_written = 0
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(result.keys()))
+        for batch in result.partitions(batch_rows):
+            writer.writerows(batch)
+            rows_written += len(batch)
+            if progress:
+                progress(rows_written, os.path.getsize(path))
+    return rows_written
+
+
+def _write_parquet(result, path: str, batch_rows: int, progress) -> int:
+    columns = list(result.keys())
+    rows_written = 0
+    writer = None
+    try:
+        for batch in result.partitions(batch_rows):
+            if writer is None:
+                ## A named cursor has its description once the first rows are fetched
+                writer = pq.ParquetWriter(path, _arrow_schema(columns, batch, _decimal_scales(result)), compression='zstd')
+            writer.write_batch(_record_batch(writer.schema_arrow, batch))
+            rows_written += len(batch)
+            if progress:
+                progress(rows_written, os.path.getsize(path))
+        if writer is None:
+            ## Empty result: still a valid file with the column names
+            writer = pq.ParquetWriter(path, pa.schema([pa.field(name, pa.string()) for name in columns]), compression='zstd')
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows_written
+
+
+@contextmanager
+def stream_query(db, sql_query: str, batch_rows: int = 10000):
+    ## Result of a read-only query on a psycopg2 named cursor: Postgres hands rows over max_row_buffer at a time
+    parsed = parse_sql(sql_query)
+    if not parsed.is_read_only:
+        raise DDLCommandException
+    with db._engine.connect() as connection:
+        yield connection.execution_options(stream_results=True, max_row_buffer=batch_rows, no_parameters=True) \
+                        .exec_driver_sql(parsed.canonical)
+
+
+def export_query(db, sql_query: str, fmt: str = 'csv', path: str = None, batch_rows: int = 10000, progress=None) -> dict:
+    ## Writes the full result of sql_query to path (default: a new file in EXPORT_DIR) and returns what was written
+    ## stream_query rejects anything but a read-only query before a file is created
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    path = path or export_path(fmt)
+    start = time.perf_counter()
+    try:
+        with stream_query(db, sql_query, batch_rows) as result:
+            write = _write_csv if fmt == 'csv' else _write_parquet
+            rows_written = write(result, path, batch_rows, progress)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    export = {'path': path, 'format': fmt, 'rows': rows_written, 'bytes': os.path.getsize(path),
+              'seconds': time.perf_counter() - start}
+    logger.info("Exported %d rows (%d bytes) to %s in %.1fs", export['rows'], export['bytes'], path, export['seconds'])
+    return export
@@ -0,0 +1,98 @@
+## Process-wide cache of rendered figures.
+## A figure is keyed by a hash of the visualization code plus the content hash of the data it ran on, and
+## stored as its plotly JSON. Showing the same chart again (a repeated question, a sample answer, another
+## session asking the same thing) skips exec'ing the generated code and serializing the figure; the JSON is
+## also what the history store and the memory accounting use, so it is produced once per chart.
+## figure_from_json() turns a cached figure back into a Figure without validating it again: it was valid when
+## plotly serialized it, and validation is most of the cost of a cache hit.
+## Bounded by entry count and bytes (FIGURE_CACHE_MAX_ENTRIES, FIGURE_CACHE_MAX_BYTES), least recently used
+## first, and registered with memory_accounting so the global budget can evict entries too.
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import plotly.graph_objects as go
+
+from Agent_Helpers import execute_viz_code, hash_dataframe
+from memory_accounting import memory_accountant
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def figure_from_json(figure_json: str) -> go.Figure:
+    return go.Figure(json.loads(figure_json), _validate=False)
+
+
+class FigureCache:
+    def __init__(self, max_entries: int = 128, max_bytes: int = 128 * 2 ** 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        ## key -> figure JSON; least recently used first
+        self.figures = OrderedDict()
+        self.metrics = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+    @staticmethod
+    def make_key(viz_code: str, data_hash: str) -> str:
+        return hashlib.sha256(f"{data_hash}\n{viz_code.strip()}".encode()).hexdigest()
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            figure_json = self.figures.get(key)
+            if figure_json is None:
+                self.metrics['misses'] += 1
+                return None
+            self.metrics['hits'] += 1
+            self.figures.move_to_end(key)
+        memory_accountant.touch('figure_cache', key)
+        return figure_json
+
+    def put(self, key: str, figure_json: str):
+        evicted = []
+        with self._lock:
+            old = self.figures.pop(key, None)
+            if old is not None:
+                self.metrics['bytes'] -= len(old)
+            self.figures[key] = figure_json
+            self.metrics['bytes'] += len(figure_json)
+            while len(self.figures) > 1 and (len(self.figures) > self.max_entries or self.metrics['bytes'] > self.max_bytes):
+                evicted_key, evicted_json = self.figures.popitem(last=False)
+                self.metrics['bytes'] -= len(evicted_json)
+                self.metrics['evictions'] += 1
+                evicted.append(evicted_key)
+        ## Outside the lock, like result_store: the accountant may call back into _evict
+        for evicted_key in evicted:
+            memory_accountant.release('figure_cache', evicted_key)
+        memory_accountant.track('figure_cache', key, len(figure_json), evict=lambda: self._evict(key))
+
+    def _evict(self, key: str):
+        with self._lock:
+            figure_json = self.figures.pop(key, None)
+            if figure_json is not None:
+                self.metrics['bytes'] -= len(figure_json)
+                self.metrics['evictions'] += 1
+
+    def render(self, viz_code: str, df: pd.DataFrame, data_hash: str = None) -> str:
+        ## Figure JSON for viz_code run on df; the code is only exec'd on a miss. Errors are not cached.
+        key = self.make_key(viz_code, data_hash or hash_dataframe(df))
+        figure_json = self.get(key)
+        if figure_json is None:
+            figure_json = execute_viz_code(viz_code, df).to_json()
+            self.put(key, figure_json)
+        return figure_json
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            lookups = self.metrics['hits'] + self.metrics['misses']
+            return dict(self.metrics, entries=len(self.figures), hit_rate=self.metrics['hits'] / lookups if lookups else None)
+
+
+figure_cache = FigureCache(
+    max_entries=int(os.getenv('FIGURE_CACHE_MAX_ENTRIES', 128)),
+    max_bytes=int(os.getenv('FIGURE_CACHE_MAX_BYTES', 128 * 2 ** 20)),
+)
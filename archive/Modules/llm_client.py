@@ -0,0 +1,281 @@
+## Resilient wrapper around the chat model used by every chain.
+## ChatOpenAI was built with timeout=None, so one slow completion could hang a request forever. ResilientLLM
+## bounds each attempt with a per-step timeout, retries with jittered exponential backoff, can hedge (fire a
+## second identical request once the first has taken longer than that step's p95 and keep whichever finishes
+## first), and trips a circuit breaker after repeated failures so calls fail fast while the provider is down.
+##
+## The step timeout is also passed to the chat model as its request timeout, so a call that runs out of time
+## is aborted at the HTTP level rather than left holding a worker thread and a connection until it finishes.
+##
+## Agents pick the step with for_step(llm, 'step_name'); a plain ChatOpenAI passes through untouched.
+## step_models routes individual steps to a different (e.g. smaller or local) model; every other step uses llm.
+## Every attempt (and hedge) to a provider model first waits for admission (admission.py), so retries and
+## hedges count against the same requests/tokens-per-minute budget as everything else.
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from langchain_core.language_models import BaseLLM
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import Runnable
+
+from admission import admission_controller, AdmissionTimeoutException
+from token_accounting import token_accountant, count_tokens
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_STEP_TIMEOUTS = {
+    'default': 60,
+    'generate_query': 60,
+    'correct_query': 30,
+    'adjust_query': 60,
+    'summarize': 90,
+    'summarize_chunk': 60,
+    'reduce_summary': 90,
+    'summary_reflect': 30,
+    'adjust_summary': 60,
+    'viz_description': 60,
+    'viz_reflect': 30,
+    'adjust_viz_description': 60,
+    'viz_code': 90,
+}
+
+
+class LLMTimeoutException(Exception):
+    "Raised when an LLM call does not finish within its step timeout"
+    pass
+
+
+class CircuitOpenException(Exception):
+    "Raised when the LLM circuit breaker is open and calls are being rejected"
+    pass
+
+
+def model_name(llm) -> str:
+    return getattr(llm, 'model_name', None) or getattr(llm, 'model', None) or type(llm).__name__
+
+
+def percentile(samples, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def retry_after(error, default: float) -> float:
+    ## Seconds from the Retry-After header of a provider error, if it has one
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after', default))
+    except (TypeError, ValueError):
+        return default
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        ## A trial call is in flight after the cooldown; everything else is still rejected until it settles
+        self.half_open = False
+        self.trips = 0
+
+    def before_call(self) -> bool:
+        ## Raises while open; returns True if this call is the half-open trial (pass it back to record())
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            if self.half_open or time.time() - self.opened_at < self.cooldown:
+                raise CircuitOpenException("LLM provider is failing; calls are paused. Please try again shortly.")
+            self.half_open = True
+            return True
+
+    def abandon(self):
+        ## The trial ended without an answer from the provider (e.g. it timed out waiting for admission)
+        with self._lock:
+            self.half_open = False
+
+    def record(self, success: bool, trial: bool = False):
+        with self._lock:
+            if trial:
+                ## The trial decides: closed again, or open for another cooldown
+                self.half_open = False
+                if success:
+                    self.opened_at = None
+                    self.failures = 0
+                else:
+                    self.opened_at = time.time()
+                    self.trips += 1
+                    logger.warning("LLM circuit breaker trial call failed; staying open")
+                return
+            if success:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold and self.opened_at is None:
+                self.opened_at = time.time()
+                self.trips += 1
+                logger.warning("LLM circuit breaker opened after %d consecutive failures", self.failures)
+
+
+class ResilientLLM(Runnable):
+    def __init__(self, llm, step_timeouts: dict = None, max_retries: int = 2, backoff_base: float = 0.5,
+                 backoff_max: float = 8, hedge: bool = False, hedge_min_samples: int = 20,
+                 breaker: CircuitBreaker = None, step_models: dict = None, step: str = 'default', shared=None,
+                 admission=admission_controller):
+        self.llm = llm
+        self.step = step
+        if shared is None:
+            shared = {
+                'step_timeouts': dict(DEFAULT_STEP_TIMEOUTS, **(step_timeouts or {})),
+                'max_retries': max_retries,
+                'backoff_base': backoff_base,
+                'backoff_max': backoff_max,
+                'hedge': hedge,
+                'hedge_min_samples': hedge_min_samples,
+                'breaker': breaker or CircuitBreaker(),
+                'step_models': step_models or {},
+                'admission': admission,
+                'executor': ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm"),
+                'lock': threading.Lock(),
+                'latencies': {},
+                'metrics': {},
+            }
+        self.shared = shared
+
+    def for_step(self, step: str) -> 'ResilientLLM':
+        ## Same breaker and metrics; the step name picks the timeout, latency history and (if tiered) the model
+        return ResilientLLM(self.shared['step_models'].get(step, self.llm), step=step, shared=self.shared)
+
+    def _count(self, name: str, amount: int = 1):
+        with self.shared['lock']:
+            step_metrics = self.shared['metrics'].setdefault(self.step, {
+                'model': model_name(self.llm), 'calls': 0, 'retries': 0, 'timeouts': 0, 'errors': 0,
+                'hedges': 0, 'hedge_wins': 0, 'input_tokens': 0, 'output_tokens': 0, 'rate_limited': 0,
+            })
+            step_metrics[name] += amount
+
+    def _latency_samples(self) -> list:
+        with self.shared['lock']:
+            return list(self.shared['latencies'].setdefault(self.step, deque(maxlen=500)))
+
+    def _record_latency(self, seconds: float):
+        with self.shared['lock']:
+            self.shared['latencies'].setdefault(self.step, deque(maxlen=500)).append(seconds)
+
+    def _admission(self):
+        ## Local completion models (GPT4All) have no provider limits to respect
+        return None if isinstance(self.llm, BaseLLM) else self.shared['admission']
+
+    def _attempt(self, input, config, **kwargs):
+        executor = self.shared['executor']
+        timeout = self.shared['step_timeouts'].get(self.step, self.shared['step_timeouts']['default'])
+        if not isinstance(self.llm, BaseLLM):
+            ## Chat models pass invoke kwargs through to the provider request (CassetteLLM hands them on)
+            kwargs = dict(kwargs, timeout=timeout)
+        latencies = self._latency_samples()
+        admission = self._admission()
+        prompt_tokens = count_tokens(input.to_string() if hasattr(input, 'to_string') else input)
+        ## Waiting for admission is not part of the step timeout; it is bounded by ADMISSION_MAX_WAIT
+        tickets = {}
+        ticket = admission.acquire(prompt_tokens) if admission is not None else None
+        start = time.perf_counter()
+        primary = executor.submit(self.llm.invoke, input, config, **kwargs)
+        tickets[primary] = ticket
+        pending = {primary}
+
+        if self.shared['hedge'] and len(latencies) >= self.shared['hedge_min_samples']:
+            hedge_after = min(percentile(latencies, 0.95), timeout)
+            done, _ = wait(pending, timeout=hedge_after)
+            ## A hedge is only sent if the budget has room right now; it never queues behind other calls
+            hedge_ticket = admission.try_acquire(prompt_tokens) if admission is not None and not done else None
+            if not done and (admission is None or hedge_ticket is not None):
+                self._count('hedges')
+                hedge = executor.submit(self.llm.invoke, input, config, **kwargs)
+                tickets[hedge] = hedge_ticket
+                pending.add(hedge)
+
+        remaining = timeout - (time.perf_counter() - start)
+        done, not_done = wait(pending, timeout=max(0.0, remaining), return_when=FIRST_COMPLETED)
+        for future in not_done:
+            future.cancel()
+        if not done:
+            self._count('timeouts')
+            raise LLMTimeoutException(f"LLM step '{self.step}' did not finish within {timeout}s")
+
+        winner = done.pop()
+        result = winner.result()
+        if winner is not primary:
+            self._count('hedge_wins')
+        self._record_latency(time.perf_counter() - start)
+        ## Completion models (e.g. a local GPT4All) return plain strings; the agents expect a message
+        if isinstance(result, str):
+            result = AIMessage(content=result)
+        usage = getattr(result, 'usage_metadata', None)
+        if usage:
+            input_tokens, output_tokens = usage.get('input_tokens', 0), usage.get('output_tokens', 0)
+        else:
+            ## Local models report no usage; estimate from the text
+            input_tokens = count_tokens(input.to_string() if hasattr(input, 'to_string') else input)
+            output_tokens = count_tokens(result.content)
+        self._count('input_tokens', input_tokens)
+        self._count('output_tokens', output_tokens)
+        token_accountant.record_usage(self.step, input_tokens, output_tokens)
+        ## The losing hedge keeps its estimate: it may still run to completion at the provider
+        if tickets[winner] is not None:
+            admission.release(tickets[winner], input_tokens + output_tokens)
+        return result
+
+    def invoke(self, input, config=None, **kwargs):
+        breaker = self.shared['breaker']
+        self._count('calls')
+        for attempt in range(self.shared['max_retries'] + 1):
+            trial = breaker.before_call()
+            try:
+                result = self._attempt(input, config, **kwargs)
+                breaker.record(True, trial)
+                return result
+            except AdmissionTimeoutException:
+                ## Congestion on our side, not a provider failure: no breaker count and no retry into the same line
+                if trial:
+                    breaker.abandon()
+                raise
+            except Exception as e:
+                breaker.record(False, trial)
+                self._count('errors')
+                ## Full jitter: spread retries out so a burst of failures does not retry in lockstep
+                delay = random.uniform(0, min(self.shared['backoff_max'], self.shared['backoff_base'] * 2 ** attempt))
+                if type(e).__name__ == 'RateLimitError' and self._admission() is not None:
+                    ## 429: hold back every caller, not just this retry
+                    self._count('rate_limited')
+                    self._admission().rate_limited(retry_after(e, delay))
+                if attempt == self.shared['max_retries']:
+                    raise
+                logger.warning("LLM step '%s' failed (%s); retrying in %.2fs", self.step, e, delay)
+                self._count('retries')
+                time.sleep(delay)
+
+    def get_metrics(self) -> dict:
+        with self.shared['lock']:
+            steps = {step: dict(values) for step, values in self.shared['metrics'].items()}
+            latencies = {step: list(values) for step, values in self.shared['latencies'].items()}
+        for step, values in steps.items():
+            samples = latencies.get(step, [])
+            values.update({
+                'p50': percentile(samples, 0.50),
+                'p95': percentile(samples, 0.95),
+                'p99': percentile(samples, 0.99),
+            })
+        admission = self.shared['admission']
+        return {'steps': steps, 'breaker_trips': self.shared['breaker'].trips,
+                'admission': admission.get_metrics() if admission is not None else None}
+
+
+def for_step(llm, step: str):
+    return llm.for_step(step) if hasattr(llm, 'for_step') else llm
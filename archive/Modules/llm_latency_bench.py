@@ -0,0 +1,76 @@
+## Tail-latency benchmark for ResilientLLM against a local fake OpenAI-compatible chat server.
+## The fake server answers most requests in `--base-latency` seconds but injects `--spike-latency` second
+## spikes with probability `--spike-rate`, which is what hedging is meant to absorb.
+##
+## python llm_latency_bench.py --calls 200
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_openai import ChatOpenAI
+
+from llm_client import ResilientLLM, percentile
+
+
+def make_handler(base_latency: float, spike_latency: float, spike_rate: float):
+    class FakeChatHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(spike_latency if random.random() < spike_rate else base_latency)
+            body = json.dumps({
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': 'fake',
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'All good'}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': 2, 'total_tokens': 12},
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return FakeChatHandler
+
+
+def start_fake_server(port: int, base_latency: float, spike_latency: float, spike_rate: float) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(base_latency, spike_latency, spike_rate))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(port: int, calls: int, hedge: bool) -> tuple:
+    chat = ChatOpenAI(model='fake', api_key='fake', base_url=f'http://127.0.0.1:{port}/v1', timeout=30, max_retries=0)
+    llm = ResilientLLM(chat, hedge=hedge).for_step('bench')
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        llm.invoke("Say 'All good'")
+        latencies.append(time.perf_counter() - start)
+    return latencies, llm.get_metrics()['steps']['bench']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--base-latency', type=float, default=0.05)
+    parser.add_argument('--spike-latency', type=float, default=2.0)
+    parser.add_argument('--spike-rate', type=float, default=0.03)
+    args = parser.parse_args()
+
+    server = start_fake_server(args.port, args.base_latency, args.spike_latency, args.spike_rate)
+    print(f"{'mode':>10} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'hedges':>7} {'wins':>5}")
+    for hedge in (False, True):
+        latencies, metrics = run(args.port, args.calls, hedge)
+        print(f"{'hedged' if hedge else 'plain':>10} {percentile(latencies, 0.5):>8.3f} {percentile(latencies, 0.95):>8.3f} "
+              f"{percentile(latencies, 0.99):>8.3f} {max(latencies):>8.3f} {metrics['hedges']:>7} {metrics['hedge_wins']:>5}")
+    server.shutdown()
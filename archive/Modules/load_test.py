@@ -0,0 +1,74 @@
+## Local load test for service.py: runs the service against a simulated workflow (sleeps instead of
+## calling OpenAI/Postgres) and reports job throughput for different worker pool sizes.
+##
+## python load_test.py --jobs 64 --workers 1 2 4 8
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import uvicorn
+
+from service import create_app
+from service_client import AnalyticsServiceClient
+
+
+class SimulatedWorkflow:
+    ## Stand-in for DataAnalyticsWorkflow with fixed per-stage latencies (seconds).
+    def __init__(self, llm_latency: float = 0.2, db_latency: float = 0.05):
+        self.llm_latency = llm_latency
+        self.db_latency = db_latency
+
+    def generate_sql_query(self, user_query, hist=None):
+        time.sleep(self.llm_latency)
+        return "SELECT 1 AS one FROM dual"
+
+    def execute_sql_query(self, sql_query):
+        time.sleep(self.db_latency)
+        return pd.DataFrame({'one': [1]})
+
+    def summarize_results(self, user_query, res):
+        time.sleep(self.llm_latency)
+        return "One row."
+
+    def generate_visualization(self, user_query, res):
+        time.sleep(self.llm_latency)
+        return "fig = go.Figure()"
+
+
+def run_load(num_workers: int, num_jobs: int, port: int, llm_latency: float, db_latency: float) -> float:
+    api = create_app(SimulatedWorkflow(llm_latency, db_latency), num_workers=num_workers, max_queue_size=num_jobs)
+    server = uvicorn.Server(uvicorn.Config(api, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    client = AnalyticsServiceClient(f"http://127.0.0.1:{port}", poll_interval=0.05)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_jobs) as pool:
+        list(pool.map(lambda idx: client.run(f"question {idx}", [], need_summary=True), range(num_jobs)))
+    elapsed = time.perf_counter() - start
+
+    server.should_exit = True
+    thread.join()
+    return num_jobs / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=64)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--llm-latency', type=float, default=0.2)
+    parser.add_argument('--db-latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    baseline = None
+    print(f"{'workers':>8} {'jobs/s':>10} {'speedup':>8}")
+    for num_workers in args.workers:
+        throughput = run_load(num_workers, args.jobs, args.port, args.llm_latency, args.db_latency)
+        baseline = baseline or throughput
+        print(f"{num_workers:>8} {throughput:>10.2f} {throughput / baseline:>8.2f}x")
@@ -10,7 +10,63 @@ import re
 from io import StringIO
 
 from workflows import DataAnalyticsWorkflow
-from Agent_Helpers import get_sample_queries
+from Agent_Helpers import get_sample_queries, init_history, hash_dataframe
+from service_client import AnalyticsServiceClient, RemoteWorkflow
+from warmup import SampleQueryWarmer, sample_cache
+from pagination import StoredResultPager
+from result_store import result_store
+from viz_store import get_viz_store
+from figure_cache import figure_cache, figure_from_json
+from export import EXPORT_FORMATS
+from token_accounting import token_accountant
+from memory_accounting import memory_accountant
+from admission import admission_controller
+import uuid
+
+@st.cache_resource
+def start_sample_warmup():
+    ## Runs once per process; answers the sample questions in the background so picking one is instant.
+    interval = float(os.getenv('SAMPLE_WARMUP_INTERVAL', 3600))
+    with_summary = os.getenv('SAMPLE_WARMUP_SUMMARY', 'false').lower() == 'true'
+    return SampleQueryWarmer(DataAnalyticsWorkflow(), sample_cache, interval=interval, with_summary=with_summary).start()
+
+def render_result_pager(pager):
+    ## Only the current page goes to the browser
+    st.write("---")
+    st.subheader("Fetched Results:")
+    page_no = st.number_input("Page", min_value=1, step=1, key="result_page") - 1
+    try:
+        page = pager.page(page_no)
+    except Exception as e:
+        st.write(f"Error fetching page: {e}")
+        return
+    st.dataframe(page)
+    start = page_no * pager.page_size
+    st.caption(f"Rows {start + 1}-{start + len(page)} of {pager.total_rows()} ({pager.mode})")
+
+def render_export(workflow, sql_query):
+    ## The full result goes from Postgres straight to a file; only files up to EXPORT_DOWNLOAD_MAX_BYTES are
+    ## handed to the browser (Streamlit holds a download in memory), larger ones stay on the server.
+    with st.expander("Export full result"):
+        fmt = st.radio("Format", list(EXPORT_FORMATS), horizontal=True, key="export_format")
+        if st.button("Export", key="export"):
+            status = st.empty()
+            def progress(rows, nbytes):
+                status.caption(f"{f'{rows} rows, ' if rows is not None else ''}{nbytes / 2 ** 20:.1f} MiB written")
+            try:
+                st.session_state.last_export = workflow.export_results(sql_query, fmt, progress=progress)
+            except Exception as e:
+                st.write(f"Error exporting results: {e}")
+                return
+        export = st.session_state.get('last_export')
+        if export:
+            st.caption(f"{export['rows'] if export['rows'] is not None else 'All'} rows, {export['bytes'] / 2 ** 20:.1f} MiB "
+                       f"in {export['seconds']:.1f}s")
+            if export['bytes'] <= int(os.getenv('EXPORT_DOWNLOAD_MAX_BYTES', 200 * 2 ** 20)):
+                with open(export['path'], 'rb') as f:
+                    st.download_button("Download", f, file_name=os.path.basename(export['path']), key="export_download")
+            else:
+                st.caption(f"Too large to download through the app; saved on the server at {export['path']}")
 
 if __name__ == "__main__":
     load_dotenv()
@@ -19,7 +75,19 @@ if __name__ == "__main__":
     st.header("Some cool description here...")
 
     ## Init Resources
-    workflow = DataAnalyticsWorkflow()
+    ## Identifies this browser session in memory accounting and, in service mode, in the service's admission control
+    session_id = st.session_state.setdefault('session_id', uuid.uuid4().hex)
+    ## With ANALYTICS_SERVICE_URL set, the heavy lifting happens in service.py and this script is just a client.
+    service_url = os.getenv('ANALYTICS_SERVICE_URL')
+    if service_url:
+        if 'remote_workflow' not in st.session_state:
+            st.session_state.remote_workflow = RemoteWorkflow(AnalyticsServiceClient(service_url), init_history(), session_id)
+        workflow = st.session_state.remote_workflow
+    else:
+        workflow = DataAnalyticsWorkflow()
+        start_sample_warmup()
+    ## LLM calls from this session take turns with other sessions for the shared rate limit
+    admission_controller.begin(priority='interactive', session=session_id)
     sample_queries = get_sample_queries()
 
     ## Streamlit UI
@@ -33,9 +101,70 @@ if __name__ == "__main__":
     show_viz_code = st.sidebar.toggle("Show Python Code for visualization", False)
     show_fetched_data = st.sidebar.toggle("Show Fetched Data", True)
     show_analyst_desc = st.sidebar.toggle("Show Analyst Description", False)
+    if service_url:
+        workflow.set_options(need_summary, need_viz)
+    else:
+        metrics = workflow.single_flight.get_metrics()
+        st.sidebar.caption(f"Coalesced requests: {metrics['coalesced']} of {metrics['calls']} ({metrics['coalesce_rate']:.0%})")
+        if workflow.sql_coder.view_manager:
+            mv_metrics = workflow.sql_coder.view_manager.get_metrics()
+            st.sidebar.caption(f"Materialized views: {mv_metrics['views']}, hit rate {mv_metrics['hit_rate']:.0%}, {mv_metrics['seconds_saved']:.1f}s scan time saved")
+        qi_metrics = workflow.question_index.get_metrics()
+        st.sidebar.caption(f"Question index: {qi_metrics['entries']} pairs, hit rate {qi_metrics['hit_rate']:.0%}, {qi_metrics['avg_query_ms']:.1f} ms/lookup")
+        with st.sidebar.expander("LLM Step Metrics"):
+            ## Latency and tokens per pipeline step, labelled with the model serving it, to compare model tiers
+            step_metrics = workflow.llm.get_metrics()['steps']
+            if step_metrics:
+                st.dataframe(pd.DataFrame(step_metrics).T[['model', 'calls', 'p50', 'p95', 'input_tokens', 'output_tokens', 'timeouts', 'errors']])
+        with st.sidebar.expander("Prompt Token Report"):
+            ## Which templates and template inputs dominate token spend
+            token_rows = token_accountant.report()
+            if token_rows:
+                st.dataframe(pd.DataFrame(token_rows))
+            if 'request_id' in st.session_state:
+                st.caption("Last request")
+                st.dataframe(pd.DataFrame(token_accountant.request_report(st.session_state.request_id)).T)
+
+    with st.sidebar.expander("Memory"):
+        ## Bytes held per cache and per session against the global budget; stage allocations with MEMORY_TRACE=true
+        memory_report = memory_accountant.report()
+        memory_metrics = memory_report['metrics']
+        st.caption(f"Tracked {memory_metrics['tracked_bytes'] / 2 ** 20:.1f} MiB of {memory_metrics['budget_bytes'] / 2 ** 20:.0f} MiB budget, "
+                   f"{memory_metrics['evictions']} evictions ({memory_metrics['evicted_bytes'] / 2 ** 20:.1f} MiB)")
+        st.dataframe(pd.DataFrame(memory_report['caches']).T)
+        if memory_report['sessions']:
+            st.dataframe(pd.Series(memory_report['sessions'], name='bytes'))
+        if memory_report['stages']:
+            st.dataframe(pd.DataFrame(memory_report['stages']).T)
+
+    with st.sidebar.expander("LLM Admission"):
+        ## Shared requests/tokens-per-minute budget: who is waiting for it and for how long
+        admission_metrics = admission_controller.get_metrics()
+        st.caption(f"{admission_metrics['requests_available']:.0f}/{admission_metrics['rpm']:.0f} requests and "
+                   f"{admission_metrics['tokens_available']:.0f}/{admission_metrics['tpm']:.0f} tokens available, "
+                   f"{admission_metrics['rate_limited_responses']} rate-limited responses")
+        st.dataframe(pd.DataFrame(admission_metrics['priorities']).T)
+
+    ## Past charts come straight from the history catalog; no LLM or database calls
+    with st.sidebar.expander("Visualization History"):
+        figure_metrics = figure_cache.get_metrics()
+        if figure_metrics['hit_rate'] is not None:
+            st.caption(f"Figure cache: {figure_metrics['hit_rate']:.0%} hit rate, {figure_metrics['entries']} figures "
+                       f"({figure_metrics['bytes'] / 2 ** 20:.1f} MiB), {figure_metrics['evictions']} evictions")
+        past_charts = get_viz_store().list_charts(limit=20)
+        chart_labels = {f"#{chart['id']} {chart['question'] or 'Untitled'}": chart for chart in past_charts}
+        selected_chart = st.selectbox("Past charts", [""] + list(chart_labels), key="past_chart")
+    if selected_chart:
+        chart = chart_labels[selected_chart]
+        st.write("---")
+        st.subheader(f"Saved Visualization: {chart['question'] or 'Untitled'}")
+        st.plotly_chart(get_viz_store().load_figure(chart['figure_hash']))
+        if show_sql and chart['sql_query']:
+            st.write(chart['sql_query'])
 
     if st.button("Get results"):
         user_query = selected_sample if user_query == "" else user_query
+        st.session_state.request_id = token_accountant.begin_request()
 
         with st.spinner("Querying Database..."):
             sql_query = workflow.generate_sql_query(user_query)
@@ -47,15 +176,30 @@ if __name__ == "__main__":
 
         try:
             res = workflow.execute_sql_query(sql_query)
+            ## Every result goes through the store: the viewer pages from the handle and the agents read through
+            ## it, so a spilled result is memory-mapped back instead of kept as the fetched DataFrame
+            result_handle = result_store.put(res, session_id)
+            res = result_handle.to_pandas()
             workflow.hist.append(user_query)
 
         except Exception as e:
             res = f"Error: {e}. Please try refining your query."
 
+        st.session_state.pop('result_pager', None)
+        st.session_state.pop('last_export', None)
+        st.session_state.pop('last_figure', None)
+        st.session_state.export_sql = None if isinstance(res, str) else sql_query
+        if not isinstance(res, str):
+            st.session_state.result_pager = StoredResultPager(result_handle)
+            st.session_state.result_page = 1
+
         if show_fetched_data:
-            st.write("---")
-            st.subheader("Fetched Results:")
-            st.write(res)
+            if isinstance(res, str):
+                st.write("---")
+                st.subheader("Fetched Results:")
+                st.write(res)
+            else:
+                render_result_pager(st.session_state.result_pager)
 
         if need_summary:
             if isinstance(res, str):
@@ -82,7 +226,25 @@ if __name__ == "__main__":
                 st.write("---")
                 st.subheader("Visualization:")
                 try:
-                    fig = workflow.execute_viz_code(viz_code, res)
-                    st.plotly_chart(fig)
+                    ## Same code on the same data is not exec'd or serialized again (figure_cache)
+                    data_hash = hash_dataframe(res)
+                    figure_json = figure_cache.render(viz_code, res, data_hash)
+                    st.plotly_chart(figure_from_json(figure_json))
+                    st.session_state.last_figure = figure_json
+                    ## Streamlit keeps the sent figure for the session; only the latest per session is counted
+                    memory_accountant.track('figures', session_id, len(figure_json), session=session_id)
+                    get_viz_store().save(figure_json, user_query, sql_query, data_hash, viz_code)
                 except Exception as e:
                     st.write(f"Error generating visualization: {e}")
+
+    else:
+        ## Paging and exporting rerun the script without the button press; keep showing the last result and chart
+        if show_fetched_data and 'result_pager' in st.session_state:
+            render_result_pager(st.session_state.result_pager)
+        if need_viz and st.session_state.get('last_figure'):
+            st.write("---")
+            st.subheader("Visualization:")
+            st.plotly_chart(figure_from_json(st.session_state.last_figure))
+
+    if st.session_state.get('export_sql'):
+        render_export(workflow, st.session_state.export_sql)
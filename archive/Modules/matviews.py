@@ -0,0 +1,144 @@
+## Automatic materialized views for hot generated queries.
+## SQLCoder reports every query it runs here. Once the same canonical SELECT has been executed
+## `threshold` times, a Postgres materialized view is created for it in the background, and later
+## executions of that query are rewritten to read from the view instead of scanning the base tables.
+## Views are refreshed every `refresh_interval` seconds and dropped if they can no longer be refreshed.
+##
+## Enabled with AUTO_MATVIEWS=true. The DB user needs CREATE privileges on the default schema.
+
+import hashlib
+import threading
+import time
+
+from sql_ir import parse_sql
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def canonical_sql(sql_query: str) -> str:
+    return parse_sql(sql_query).canonical
+
+
+class MaterializedViewManager:
+    def __init__(self, threshold: int = 3, max_views: int = 20, refresh_interval: float = 900, prefix: str = 'mv_auto_'):
+        self.threshold = threshold
+        self.max_views = max_views
+        self.refresh_interval = refresh_interval
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        ## canonical sql -> {'count', 'total_seconds'} for queries that ran against the base tables
+        self.query_log = {}
+        ## canonical sql -> {'name', 'rewritten', 'base_seconds', 'refreshed_at'}
+        self.views = {}
+        self._pending = set()
+        ## queries Postgres refused to materialize (e.g. duplicate output column names)
+        self._rejected = set()
+        self.metrics = {'executions': 0, 'view_hits': 0, 'seconds_saved': 0.0, 'views_created': 0, 'views_dropped': 0}
+        self._refresher = None
+
+    def rewrite(self, sql_query: str) -> str:
+        with self._lock:
+            view = self.views.get(canonical_sql(sql_query))
+        return view['rewritten'] if view else sql_query
+
+    def record(self, db, sql_query: str, elapsed: float, used_view: bool):
+        canonical = canonical_sql(sql_query)
+        with self._lock:
+            self.metrics['executions'] += 1
+            if used_view:
+                self.metrics['view_hits'] += 1
+                view = self.views.get(canonical)
+                if view is not None:
+                    self.metrics['seconds_saved'] += max(0.0, view['base_seconds'] - elapsed)
+                return
+
+            entry = self.query_log.setdefault(canonical, {'count': 0, 'total_seconds': 0.0})
+            entry['count'] += 1
+            entry['total_seconds'] += elapsed
+            create = (
+                entry['count'] >= self.threshold
+                and canonical not in self._pending
+                and canonical not in self._rejected
+                and len(self.views) + len(self._pending) < self.max_views
+                and parse_sql(sql_query).is_read_only
+            )
+            if create:
+                self._pending.add(canonical)
+        if create:
+            threading.Thread(target=self._create_view, args=(db, canonical), daemon=True).start()
+            self._start_refresher(db)
+
+    def _create_view(self, db, canonical: str):
+        name = self.prefix + hashlib.sha256(canonical.encode()).hexdigest()[:12]
+        try:
+            ## row_number() keeps the generated query's ORDER BY, which a plain view scan would lose
+            db.run(f"DROP MATERIALIZED VIEW IF EXISTS {name}")
+            db.run(f"CREATE MATERIALIZED VIEW {name} AS SELECT row_number() OVER () AS mv_row_id, q.* FROM ({canonical}) AS q")
+            columns = self._view_columns(db, name)
+            select_list = ', '.join(f'"{col}"' for col in columns if col != 'mv_row_id')
+            with self._lock:
+                log = self.query_log.pop(canonical)
+                self.views[canonical] = {
+                    'name': name,
+                    'rewritten': f"SELECT {select_list} FROM {name} ORDER BY mv_row_id",
+                    'base_seconds': log['total_seconds'] / log['count'],
+                    'refreshed_at': time.time(),
+                }
+                self.metrics['views_created'] += 1
+            logger.info("Created materialized view %s for hot query: %s", name, canonical)
+        except Exception as e:
+            logger.warning("Could not create materialized view for %s: %s", canonical, e)
+            with self._lock:
+                self.query_log.pop(canonical, None)
+                self._rejected.add(canonical)
+        finally:
+            with self._lock:
+                self._pending.discard(canonical)
+
+    def _view_columns(self, db, name: str) -> list:
+        with db._engine.connect() as connection:
+            rows = connection.exec_driver_sql(
+                "SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum",
+                (name,),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def refresh_all(self, db):
+        with self._lock:
+            views = list(self.views.items())
+        for canonical, view in views:
+            try:
+                db.run(f"REFRESH MATERIALIZED VIEW {view['name']}")
+                view['refreshed_at'] = time.time()
+            except Exception as e:
+                logger.warning("Dropping materialized view %s after failed refresh: %s", view['name'], e)
+                with self._lock:
+                    self.views.pop(canonical, None)
+                    self.metrics['views_dropped'] += 1
+                try:
+                    db.run(f"DROP MATERIALIZED VIEW IF EXISTS {view['name']}")
+                except Exception:
+                    pass
+
+    def _start_refresher(self, db):
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, args=(db,), name="matview-refresh", daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self, db):
+        while True:
+            time.sleep(self.refresh_interval)
+            self.refresh_all(db)
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self.metrics, views=len(self.views))
+        metrics['hit_rate'] = metrics['view_hits'] / metrics['executions'] if metrics['executions'] else 0.0
+        return metrics
+
+
+## Process-wide instance: the query log has to outlive the per-rerun workflow objects in main.py.
+view_manager = MaterializedViewManager()
@@ -0,0 +1,171 @@
+## Memory accounting across the process-wide caches.
+## Caches report what they hold with track(cache, key, nbytes, session, evict). Each entry has a size in bytes
+## (deep DataFrame memory usage, figure JSON length, ...), an optional owning session and an optional evict
+## callback that frees it. When the tracked total goes over the global budget (MEMORY_BUDGET_BYTES, default
+## 1 GiB), the least recently used evictable entries are evicted, whichever cache they belong to.
+## Structures that are not worth evicting entry by entry (token reports, the question index, latency history)
+## are registered with observe(name, fn) and only sized when a report is made.
+##
+## stage(name) wraps a pipeline stage. With MEMORY_TRACE=true it samples tracemalloc around the stage and
+## records the net and peak allocations. tracemalloc counts the whole process, so stages that overlap in
+## other threads are included.
+
+import functools
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def deep_sizeof(obj, _seen: set = None) -> int:
+    ## Approximate bytes held by obj, including DataFrame contents and figure JSON
+    seen = _seen if _seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if hasattr(obj, 'memory_usage') and hasattr(obj, 'columns'):
+        return int(obj.memory_usage(deep=True).sum())
+    if hasattr(obj, 'to_plotly_json'):
+        return len(obj.to_json())
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)) or type(obj).__name__ == 'deque':
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+
+class MemoryAccountant:
+    def __init__(self, budget_bytes: int = 2 ** 30, trace: bool = False):
+        self.budget_bytes = budget_bytes
+        self.trace = trace
+        self._lock = threading.Lock()
+        ## (cache, key) -> {'nbytes', 'session', 'evict', 'last_access'}; least recently used first
+        self.entries = OrderedDict()
+        self.tracked_bytes = 0
+        self.observers = {}
+        ## stage -> {'calls', 'net_bytes', 'peak_bytes', 'max_peak_bytes'}
+        self.stages = {}
+        self.metrics = {'evictions': 0, 'evicted_bytes': 0}
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def track(self, cache: str, key, nbytes: int = None, obj=None, session: str = None, evict=None):
+        ## Adds or replaces an entry; evict() is called (without arguments) if the entry has to go
+        nbytes = deep_sizeof(obj) if nbytes is None else int(nbytes)
+        with self._lock:
+            old = self.entries.pop((cache, key), None)
+            if old is not None:
+                self.tracked_bytes -= old['nbytes']
+            self.entries[(cache, key)] = {'nbytes': nbytes, 'session': session, 'evict': evict, 'last_access': time.time()}
+            self.tracked_bytes += nbytes
+        self._enforce_budget()
+
+    def touch(self, cache: str, key):
+        with self._lock:
+            entry = self.entries.get((cache, key))
+            if entry is not None:
+                entry['last_access'] = time.time()
+                self.entries.move_to_end((cache, key))
+
+    def release(self, cache: str, key):
+        ## The owner dropped the entry itself
+        with self._lock:
+            entry = self.entries.pop((cache, key), None)
+            if entry is not None:
+                self.tracked_bytes -= entry['nbytes']
+
+    def _enforce_budget(self):
+        while True:
+            with self._lock:
+                if self.tracked_bytes <= self.budget_bytes:
+                    return
+                victim = next(((cache_key, entry) for cache_key, entry in self.entries.items() if entry['evict'] is not None), None)
+                if victim is None:
+                    return
+                cache_key, entry = victim
+                del self.entries[cache_key]
+                self.tracked_bytes -= entry['nbytes']
+                self.metrics['evictions'] += 1
+                self.metrics['evicted_bytes'] += entry['nbytes']
+            ## Outside the lock: the callback takes the owning cache's lock and may call release()
+            try:
+                entry['evict']()
+                logger.info("Evicted %s/%s (%d bytes) to stay within the memory budget", cache_key[0], cache_key[1], entry['nbytes'])
+            except Exception as e:
+                logger.warning("Could not evict %s/%s: %s", cache_key[0], cache_key[1], e)
+
+    def observe(self, name: str, fn):
+        ## fn() returns the object to size (or an int of bytes) when a report is made
+        with self._lock:
+            self.observers[name] = fn
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.trace:
+            yield
+            return
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            with self._lock:
+                stats = self.stages.setdefault(name, {'calls': 0, 'net_bytes': 0, 'peak_bytes': 0, 'max_peak_bytes': 0})
+                stats['calls'] += 1
+                stats['net_bytes'] += current - before
+                stats['peak_bytes'] += peak - before
+                stats['max_peak_bytes'] = max(stats['max_peak_bytes'], peak - before)
+
+    def tracked_stage(self, name: str):
+        ## Decorator form of stage()
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def report(self, largest: int = 20) -> dict:
+        with self._lock:
+            entries = [(cache, key, dict(entry)) for (cache, key), entry in self.entries.items()]
+            observers = dict(self.observers)
+            stages = {name: dict(stats) for name, stats in self.stages.items()}
+            metrics = dict(self.metrics, tracked_bytes=self.tracked_bytes, budget_bytes=self.budget_bytes)
+        caches, sessions = {}, {}
+        for cache, _, entry in entries:
+            totals = caches.setdefault(cache, {'bytes': 0, 'entries': 0})
+            totals['bytes'] += entry['nbytes']
+            totals['entries'] += 1
+            if entry['session'] is not None:
+                sessions[entry['session']] = sessions.get(entry['session'], 0) + entry['nbytes']
+        for name, fn in observers.items():
+            try:
+                value = fn()
+                caches[name] = {'bytes': value if isinstance(value, int) else deep_sizeof(value), 'entries': None}
+            except Exception as e:
+                logger.warning("Could not size %s: %s", name, e)
+        top = sorted(entries, key=lambda item: item[2]['nbytes'], reverse=True)[:largest]
+        return {
+            'metrics': metrics,
+            'caches': caches,
+            'sessions': sessions,
+            'largest': [{'cache': cache, 'key': str(key), 'bytes': entry['nbytes'], 'session': entry['session']} for cache, key, entry in top],
+            'stages': stages,
+        }
+
+
+memory_accountant = MemoryAccountant(
+    budget_bytes=int(os.getenv('MEMORY_BUDGET_BYTES', 2 ** 30)),
+    trace=os.getenv('MEMORY_TRACE', 'false').lower() == 'true',
+)
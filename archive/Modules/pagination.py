@@ -0,0 +1,21 @@
+## Page-at-a-time result browsing, so the UI never ships a whole result to the browser.
+## StoredResultPager pages over a result_store handle: the result has already been fetched, and a page is a
+## slice of it (memory-mapped if spilled), so every page costs the same however far in it is.
+
+import pandas as pd
+
+
+class StoredResultPager:
+    def __init__(self, handle, page_size: int = 50):
+        self.handle = handle
+        self.page_size = page_size
+
+    @property
+    def mode(self) -> str:
+        return self.handle.location
+
+    def page(self, page_no: int) -> pd.DataFrame:
+        return self.handle.slice(page_no * self.page_size, self.page_size)
+
+    def total_rows(self) -> int:
+        return self.handle.num_rows
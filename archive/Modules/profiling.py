@@ -0,0 +1,39 @@
+## On-demand sampling profiles of a single request.
+## profile_block(True) runs the block under pyinstrument and writes a speedscope JSON (open it at
+## https://www.speedscope.app) and a standalone HTML flame view to PROFILE_DIR (default "Profiles").
+## profile_block(False) does nothing: pyinstrument is not even imported, so there is no overhead when off.
+##
+## Only the calling thread is sampled. Work handed to other threads (hedged LLM calls, parallel chunk
+## summaries) shows up as the time the calling thread spent waiting for it.
+## Needs:  pip install pyinstrument
+
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+
+@contextmanager
+def profile_block(enabled: bool, name: str = "request", interval: float = 0.001):
+    ## Yields a dict that is filled with {'speedscope', 'html', 'seconds'} paths once the block exits
+    if not enabled:
+        yield None
+        return
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+
+    capture = {}
+    profiler = Profiler(interval=interval)
+    profiler.start()
+    try:
+        yield capture
+    finally:
+        session = profiler.stop()
+        directory = os.getenv('PROFILE_DIR', 'Profiles')
+        os.makedirs(directory, exist_ok=True)
+        stem = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}")
+        with open(f"{stem}.speedscope.json", 'w', encoding='utf-8') as f:
+            f.write(profiler.output(renderer=SpeedscopeRenderer()))
+        with open(f"{stem}.html", 'w', encoding='utf-8') as f:
+            f.write(profiler.output_html())
+        capture.update({'speedscope': f"{stem}.speedscope.json", 'html': f"{stem}.html", 'seconds': session.duration})
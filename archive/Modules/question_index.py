@@ -0,0 +1,148 @@
+## Approximate-match index over previously successful (question, SQL) pairs.
+## Questions are embedded locally with hashed TF-IDF over words and character trigrams (no network calls),
+## so paraphrases like "top 5 customers by spend" / "5 biggest spending customers" share features even when word forms differ.
+## Stored SQL is only reused as-is for a near-identical question: above `hit_threshold`, and with the same
+## numbers and the same comparison / direction / negation words ("more" vs "less", "ascending" vs "descending",
+## "top 5" vs "top 10" score high but need different SQL). Anything else above `example_threshold`, looser
+## paraphrases included, is passed to SQLExpert as few-shot examples.
+
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+
+import logging
+logger = logging.getLogger(__name__)
+
+WORD_REGEX = re.compile(r"[a-z0-9$]+")
+NUMBER_REGEX = re.compile(r"\d+(?:\.\d+)?")
+## Words that change what the SQL must do when everything else in the question stays the same
+CONSTRAINT_WORDS = {
+    'more', 'less', 'fewer', 'greater', 'smaller', 'larger', 'bigger', 'higher', 'lower', 'above', 'below', 'over',
+    'under', 'exceeds', 'exceeding', 'least', 'most', 'top', 'bottom', 'highest', 'lowest', 'largest', 'smallest',
+    'biggest', 'min', 'max', 'minimum', 'maximum', 'ascending', 'descending', 'asc', 'desc', 'increasing',
+    'decreasing', 'before', 'after', 'between', 'first', 'last', 'equal', 'not', 'no', 'without', 'except',
+    'excluding', 'only', 'average', 'total', 'sum', 'count', 'number', 'distinct', 'unique',
+    'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'ten', 'twenty', 'hundred',
+}
+
+
+def featurize(question: str, dim: int = 2 ** 18) -> Counter:
+    words = WORD_REGEX.findall(question.lower())
+    features = Counter()
+    for word in words:
+        features[zlib.crc32(b'w:' + word.encode()) % dim] += 1
+        padded = f"#{word}#"
+        for idx in range(len(padded) - 2):
+            features[zlib.crc32(b'c:' + padded[idx:idx + 3].encode()) % dim] += 1
+    return features
+
+
+def constraints(question: str) -> tuple:
+    ## Numbers and constraint words of a question; reuse needs these to match exactly
+    text = question.lower()
+    numbers = sorted(float(number) for number in NUMBER_REGEX.findall(text))
+    words = sorted({word for word in WORD_REGEX.findall(text) if word in CONSTRAINT_WORDS})
+    return tuple(numbers), tuple(words)
+
+
+class QuestionIndex:
+    def __init__(self, path: str = None, hit_threshold: float = 0.85, example_threshold: float = 0.15, max_entries: int = 5000):
+        self.path = path
+        self.hit_threshold = hit_threshold
+        self.example_threshold = example_threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.entries = []
+        self.doc_freq = Counter()
+        self.metrics = {'lookups': 0, 'hits': 0, 'few_shot': 0, 'misses': 0, 'query_seconds': 0.0, 'build_seconds': 0.0}
+        if path and os.path.exists(path):
+            self.load()
+
+    def _idf(self, feature: int) -> float:
+        return math.log((1 + len(self.entries)) / (1 + self.doc_freq[feature])) + 1
+
+    def _weigh(self, features: Counter) -> tuple:
+        weights = {feature: count * self._idf(feature) for feature, count in features.items()}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+        return weights, norm
+
+    def add(self, question: str, sql_query: str):
+        start = time.perf_counter()
+        features = featurize(question)
+        with self._lock:
+            for entry in self.entries:
+                if entry['question'] == question:
+                    entry['sql_query'] = sql_query
+                    return
+            if len(self.entries) >= self.max_entries:
+                oldest = self.entries.pop(0)
+                self.doc_freq.subtract(oldest['features'].keys())
+            self.entries.append({'question': question, 'sql_query': sql_query, 'features': features})
+            self.doc_freq.update(features.keys())
+            self.metrics['build_seconds'] += time.perf_counter() - start
+        if self.path:
+            self.save()
+
+    def nearest(self, question: str, k: int = 3) -> list:
+        ## Returns up to k (similarity, entry) pairs, most similar first.
+        start = time.perf_counter()
+        with self._lock:
+            query_weights, query_norm = self._weigh(featurize(question))
+            scored = []
+            for entry in self.entries:
+                weights, norm = self._weigh(entry['features'])
+                dot = sum(weight * weights.get(feature, 0.0) for feature, weight in query_weights.items())
+                scored.append((dot / (query_norm * norm), entry))
+            self.metrics['query_seconds'] += time.perf_counter() - start
+        scored.sort(key=lambda pair: pair[0], reverse=True)
+        return scored[:k]
+
+    def lookup(self, question: str, k: int = 3, reuse: bool = True) -> tuple:
+        ## Returns (sql_query, []) on a hit, otherwise (None, few-shot examples above example_threshold).
+        ## reuse=False (e.g. history could change the meaning) never hits; a near match becomes an example instead.
+        neighbours = self.nearest(question, k)
+        with self._lock:
+            self.metrics['lookups'] += 1
+            if reuse and neighbours and neighbours[0][0] >= self.hit_threshold \
+                    and constraints(neighbours[0][1]['question']) == constraints(question):
+                self.metrics['hits'] += 1
+                return neighbours[0][1]['sql_query'], []
+            examples = [(entry['question'], entry['sql_query']) for score, entry in neighbours if score >= self.example_threshold]
+            self.metrics['few_shot' if examples else 'misses'] += 1
+        return None, examples
+
+    def save(self):
+        with self._lock:
+            data = [{'question': entry['question'], 'sql_query': entry['sql_query']} for entry in self.entries]
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        start = time.perf_counter()
+        with open(self.path) as f:
+            data = json.load(f)
+        with self._lock:
+            self.entries = [{'question': item['question'], 'sql_query': item['sql_query'], 'features': featurize(item['question'])} for item in data]
+            self.doc_freq = Counter()
+            for entry in self.entries:
+                self.doc_freq.update(entry['features'].keys())
+            self.metrics['build_seconds'] += time.perf_counter() - start
+        logger.info("Loaded %d indexed questions in %.3fs", len(self.entries), time.perf_counter() - start)
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self.metrics, entries=len(self.entries))
+        metrics['hit_rate'] = metrics['hits'] / metrics['lookups'] if metrics['lookups'] else 0.0
+        metrics['avg_query_ms'] = 1000 * metrics['query_seconds'] / metrics['lookups'] if metrics['lookups'] else 0.0
+        return metrics
+
+
+## Process-wide index, persisted next to the app so it survives restarts.
+question_index = QuestionIndex(path=os.getenv('QUESTION_INDEX_PATH', 'question_index.json'))
@@ -0,0 +1,168 @@
+## Process-wide store for fetched results.
+## Small results stay in memory. Results above `spill_threshold` bytes (or pushed out once the in-memory
+## budget is full) are written to uncompressed Arrow IPC files and memory-mapped back on access, so a few
+## big queries from different users do not all have to live in the Streamlit process at once.
+## Spilled files share a disk quota; the least recently used ones are deleted when it is exceeded.
+## Callers hold a ResultHandle and read through it whether the data is in memory or on disk.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+import pyarrow as pa
+
+from Agent_Helpers import hash_dataframe
+from memory_accounting import memory_accountant
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ResultEvictedException(Exception):
+    "Raised when a stored result was evicted to stay within the disk quota"
+    pass
+
+
+class ResultHandle:
+    def __init__(self, store, key: str, num_rows: int, columns: list):
+        self.store = store
+        self.key = key
+        self.num_rows = num_rows
+        self.columns = columns
+
+    def to_pandas(self) -> pd.DataFrame:
+        return self.store._read(self.key)
+
+    def slice(self, start: int, length: int) -> pd.DataFrame:
+        return self.store._read(self.key, start, length)
+
+    @property
+    def location(self) -> str:
+        return self.store.location(self.key)
+
+
+class ResultStore:
+    def __init__(self, directory: str = "Result Store", spill_threshold: int = 32 * 2 ** 20,
+                 memory_budget: int = 256 * 2 ** 20, disk_quota: int = 2 * 2 ** 30):
+        self.directory = directory
+        self.spill_threshold = spill_threshold
+        self.memory_budget = memory_budget
+        self.disk_quota = disk_quota
+        self._lock = threading.RLock()
+        ## key -> {'df' or 'path', 'nbytes', 'last_access'}; ordered least recently used first
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()
+        self.metrics = {'puts': 0, 'spilled': 0, 'evicted': 0, 'memory_bytes': 0, 'disk_bytes': 0}
+
+    def put(self, df: pd.DataFrame, session: str = None) -> ResultHandle:
+        ## session attributes the in-memory bytes to whoever fetched the result last (memory_accounting)
+        key = hash_dataframe(df)
+        nbytes = int(df.memory_usage(deep=True).sum())
+        with self._lock:
+            self.metrics['puts'] += 1
+            if key not in self.memory and key not in self.disk:
+                if not (nbytes > self.spill_threshold and self._spill(key, df)):
+                    self.memory[key] = {'df': df, 'nbytes': nbytes, 'last_access': time.time()}
+                    self.metrics['memory_bytes'] += nbytes
+                    self._enforce_memory_budget()
+            in_memory_bytes = self.memory[key]['nbytes'] if key in self.memory else None
+            self._touch(key)
+        if in_memory_bytes is not None:
+            ## Under the global budget an in-memory result is freed by spilling it, like under the local one
+            memory_accountant.track('result_store', key, in_memory_bytes, session=session,
+                                    evict=lambda: self._evict_from_memory(key))
+        return ResultHandle(self, key, len(df), list(df.columns))
+
+    def location(self, key: str) -> str:
+        with self._lock:
+            if key in self.memory:
+                return 'memory'
+            return 'disk' if key in self.disk else 'evicted'
+
+    def _touch(self, key: str):
+        for entries in (self.memory, self.disk):
+            if key in entries:
+                entries[key]['last_access'] = time.time()
+                entries.move_to_end(key)
+
+    def _spill(self, key: str, df: pd.DataFrame) -> bool:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{key}.arrow")
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        except (pa.ArrowException, TypeError, ValueError) as e:
+            ## Mixed-type object columns cannot be converted; keep those in memory
+            logger.warning("Could not spill result %s to disk: %s", key, e)
+            return False
+        nbytes = os.path.getsize(path)
+        self.disk[key] = {'path': path, 'nbytes': nbytes, 'last_access': time.time()}
+        self.metrics['spilled'] += 1
+        self.metrics['disk_bytes'] += nbytes
+        self._enforce_disk_quota()
+        return True
+
+    def _enforce_memory_budget(self):
+        while self.metrics['memory_bytes'] > self.memory_budget and len(self.memory) > 1:
+            key, entry = self.memory.popitem(last=False)
+            self.metrics['memory_bytes'] -= entry['nbytes']
+            memory_accountant.release('result_store', key)
+            if not self._spill(key, entry['df']):
+                self.metrics['evicted'] += 1
+
+    def _evict_from_memory(self, key: str):
+        with self._lock:
+            entry = self.memory.pop(key, None)
+            if entry is None:
+                return
+            self.metrics['memory_bytes'] -= entry['nbytes']
+            if not self._spill(key, entry['df']):
+                self.metrics['evicted'] += 1
+
+    def _enforce_disk_quota(self):
+        while self.metrics['disk_bytes'] > self.disk_quota and len(self.disk) > 1:
+            key, entry = self.disk.popitem(last=False)
+            self.metrics['disk_bytes'] -= entry['nbytes']
+            self.metrics['evicted'] += 1
+            try:
+                os.remove(entry['path'])
+            except OSError:
+                pass
+
+    def _read(self, key: str, start: int = 0, length: int = None) -> pd.DataFrame:
+        with self._lock:
+            self._touch(key)
+            if key in self.memory:
+                memory_accountant.touch('result_store', key)
+                ## A copy: the stored frame is shared by every holder of this content hash (other sessions, the
+                ## sample cache), and callers such as generated chart code may modify what they get
+                df = self.memory[key]['df']
+                return (df if length is None and start == 0 else df.iloc[start:start + length if length else None]).copy()
+            if key not in self.disk:
+                raise ResultEvictedException(f"Result {key} is no longer available. Please run the query again.")
+            path = self.disk[key]['path']
+        ## Memory-mapped: only the pages of the file that are actually sliced get read
+        try:
+            with pa.memory_map(path, 'r') as source:
+                table = pa.ipc.open_file(source).read_all()
+                if length is not None or start:
+                    table = table.slice(start, length)
+                return table.to_pandas()
+        except FileNotFoundError:
+            ## Evicted by another thread between the lookup and the read
+            raise ResultEvictedException(f"Result {key} is no longer available. Please run the query again.")
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            return dict(self.metrics, memory_entries=len(self.memory), disk_entries=len(self.disk))
+
+
+result_store = ResultStore(
+    directory=os.getenv('RESULT_STORE_DIR', 'Result Store'),
+    spill_threshold=int(os.getenv('RESULT_SPILL_BYTES', 32 * 2 ** 20)),
+    memory_budget=int(os.getenv('RESULT_MEMORY_BUDGET_BYTES', 256 * 2 ** 20)),
+    disk_quota=int(os.getenv('RESULT_DISK_QUOTA_BYTES', 2 * 2 ** 30)),
+)
@@ -0,0 +1,240 @@
+## Headless HTTP/JSON backend for DataAnalyticsWorkflow.
+## Jobs are pushed to a bounded queue and picked up by a pool of async workers. Each worker runs the
+## (blocking) workflow stages in the queue's own thread pool so the event loop stays free to accept and report on jobs.
+## The Streamlit front end (main.py) submits a job and polls for its status through service_client.py.
+##
+## Run with:  uvicorn service:app --port 8000
+## Pool size and queue bound come from ANALYTICS_WORKERS and ANALYTICS_MAX_QUEUE.
+
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import FileResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel
+
+from token_accounting import token_accountant
+from admission import admission_controller
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class QueueFullException(Exception):
+    "Raised when the job queue is at capacity and cannot accept new jobs"
+    pass
+
+
+class ExportRequest(BaseModel):
+    ## Only the format: the SQL is always the one this service generated for the job
+    format: str = 'csv'
+
+
+class JobRequest(BaseModel):
+    question: str
+    history: list = []
+    need_summary: bool = False
+    need_viz: bool = False
+    ## Admission control: 'interactive' or 'batch', and who to share the rate limit fairly with
+    priority: str = 'interactive'
+    session: str = None
+
+
+def run_job(workflow, request: JobRequest) -> dict:
+    ## Same stage order as main.py, but history comes from the request so one workflow can serve everyone.
+    result = {'sql_query': None, 'data': None, 'error': None, 'summary': None, 'viz_code': None}
+    result['request_id'] = token_accountant.begin_request()
+    admission_controller.begin(priority=request.priority, session=request.session or result['request_id'])
+    result['sql_query'] = workflow.generate_sql_query(request.question, hist=request.history)
+    try:
+        res = workflow.execute_sql_query(result['sql_query'])
+    except Exception as e:
+        result['error'] = str(e)
+        return result
+
+    ## to_json handles numpy scalars and timestamps, which FastAPI's encoder does not
+    result['data'] = json.loads(res.to_json(orient='split', date_format='iso'))
+    if request.need_summary:
+        result['summary'] = workflow.summarize_results(request.question, res)
+    if request.need_viz:
+        result['viz_code'] = workflow.generate_visualization(request.question, res)
+    return result
+
+
+class JobQueue:
+    def __init__(self, workflow, num_workers: int = 4, max_queue_size: int = 64, max_finished_jobs: int = 1000):
+        self.workflow = workflow
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = OrderedDict()
+        self.queue = None
+        self.workers = []
+        ## One thread per worker; the loop's default executor is capped at min(32, cpu + 4) threads
+        self.executor = None
+        self.completed = 0
+        self.failed = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix='analytics-job')
+        self.workers = [asyncio.create_task(self._worker(idx)) for idx in range(self.num_workers)]
+        logger.info("Started %d workers (queue size %d)", self.num_workers, self.max_queue_size)
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def submit(self, request: JobRequest) -> str:
+        job_id = uuid.uuid4().hex
+        job = {'id': job_id, 'status': 'queued', 'request': request, 'result': None, 'error': None,
+               'submitted_at': time.time(), 'started_at': None, 'finished_at': None}
+        try:
+            self.queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            raise QueueFullException
+        self.jobs[job_id] = job
+        return job_id
+
+    def get(self, job_id: str) -> dict:
+        return self.jobs.get(job_id)
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.num_workers,
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'max_queue_size': self.max_queue_size,
+            'running': sum(1 for job in self.jobs.values() if job['status'] == 'running'),
+            'completed': self.completed,
+            'failed': self.failed,
+        }
+
+    async def _worker(self, idx: int):
+        while True:
+            job_id = await self.queue.get()
+            job = self.jobs[job_id]
+            job['status'] = 'running'
+            job['started_at'] = time.time()
+            try:
+                job['result'] = await asyncio.get_running_loop().run_in_executor(self.executor, run_job, self.workflow, job['request'])
+                job['status'] = 'done'
+                self.completed += 1
+            except Exception as e:
+                logger.error("Job %s failed on worker %d: %s", job_id, idx, e)
+                job['error'] = str(e)
+                job['status'] = 'failed'
+                self.failed += 1
+            finally:
+                job['finished_at'] = time.time()
+                self.queue.task_done()
+                self._evict_finished()
+
+    def _evict_finished(self):
+        ## Oldest finished jobs go first once we hold more than max_finished_jobs of them.
+        finished = [job_id for job_id, job in self.jobs.items() if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
+
+
+def job_to_dict(job: dict) -> dict:
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'result': job['result'],
+        'error': job['error'],
+        'queued_seconds': (job['started_at'] or time.time()) - job['submitted_at'],
+        'run_seconds': (job['finished_at'] or time.time()) - job['started_at'] if job['started_at'] else None,
+    }
+
+
+def create_app(workflow=None, num_workers: int = None, max_queue_size: int = None) -> FastAPI:
+    num_workers = num_workers or int(os.getenv('ANALYTICS_WORKERS', 4))
+    max_queue_size = max_queue_size or int(os.getenv('ANALYTICS_MAX_QUEUE', 64))
+    api = FastAPI(title="Data Analyst Assistant Service")
+    state = {}
+
+    @api.on_event("startup")
+    async def startup():
+        wf = workflow
+        if wf is None:
+            from workflows import DataAnalyticsWorkflow
+            from warmup import SampleQueryWarmer, sample_cache
+            wf = DataAnalyticsWorkflow()
+            state['warmer'] = SampleQueryWarmer(
+                wf, sample_cache,
+                interval=float(os.getenv('SAMPLE_WARMUP_INTERVAL', 3600)),
+                with_summary=os.getenv('SAMPLE_WARMUP_SUMMARY', 'false').lower() == 'true',
+            ).start()
+        state['jobs'] = JobQueue(wf, num_workers=num_workers, max_queue_size=max_queue_size)
+        await state['jobs'].start()
+
+    @api.on_event("shutdown")
+    async def shutdown():
+        if 'warmer' in state:
+            state['warmer'].stop()
+        await state['jobs'].stop()
+
+    @api.post("/jobs", status_code=202)
+    async def submit_job(request: JobRequest):
+        try:
+            job_id = state['jobs'].submit(request)
+        except QueueFullException:
+            raise HTTPException(status_code=503, detail="Job queue is full. Please retry later.")
+        return {'id': job_id, 'status': 'queued'}
+
+    @api.get("/jobs/{job_id}")
+    async def get_job(job_id: str):
+        job = state['jobs'].get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Unknown job id")
+        return job_to_dict(job)
+
+    @api.get("/tokens")
+    async def get_token_report():
+        return token_accountant.report()
+
+    @api.post("/jobs/{job_id}/export")
+    async def export_results(job_id: str, request: ExportRequest):
+        ## Full result of a finished job's query, written to a file in a thread, then streamed from disk and
+        ## deleted once sent. SQL is never taken from the client.
+        from export import EXPORT_FORMATS
+        if request.format not in EXPORT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unknown export format: {request.format}")
+        job = state['jobs'].get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Unknown job id")
+        if job['status'] != 'done' or job['result']['error'] is not None:
+            raise HTTPException(status_code=409, detail="Only a job that finished with a result can be exported")
+        try:
+            export = await asyncio.to_thread(state['jobs'].workflow.export_results, job['result']['sql_query'], request.format)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return FileResponse(export['path'], filename=os.path.basename(export['path']),
+                            headers={'X-Export-Rows': str(export['rows'])},
+                            background=BackgroundTask(os.remove, export['path']))
+
+    @api.get("/admission")
+    async def get_admission():
+        return admission_controller.get_metrics()
+
+    @api.get("/stats")
+    async def get_stats():
+        return state['jobs'].stats()
+
+    return api
+
+
+## The workflow itself is only built on startup, so importing this module never touches the DB or OpenAI.
+app = create_app()
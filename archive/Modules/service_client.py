@@ -0,0 +1,129 @@
+## Thin client for service.py, used by main.py when ANALYTICS_SERVICE_URL is set.
+## Talks HTTP through urllib, so the UI process does not need FastAPI or an HTTP client library installed; the
+## rest (pandas, the chart helper, export paths) is what the UI imports anyway.
+
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+
+import pandas as pd
+
+from Agent_Helpers import execute_viz_code
+from export import export_path
+
+
+class ServiceBusyException(Exception):
+    "Raised when the analytics service rejects a job because its queue is full"
+    pass
+
+
+class JobFailedException(Exception):
+    "Raised when the analytics service reports that a job failed"
+    pass
+
+
+class AnalyticsServiceClient:
+    def __init__(self, base_url: str, poll_interval: float = 0.5, timeout: float = 600):
+        self.base_url = base_url.rstrip('/')
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def _request(self, method: str, path: str, payload: dict = None) -> dict:
+        data = json.dumps(payload).encode() if payload is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(req) as resp:
+                return json.loads(resp.read())
+        except urllib.error.HTTPError as e:
+            if e.code == 503:
+                raise ServiceBusyException
+            raise
+
+    def submit(self, question: str, history: list, need_summary: bool = False, need_viz: bool = False,
+               session: str = None) -> str:
+        ## session lets the service's admission control take turns between browser sessions, not between jobs
+        return self._request('POST', '/jobs', {
+            'question': question,
+            'history': list(history),
+            'need_summary': need_summary,
+            'need_viz': need_viz,
+            'session': session,
+        })['id']
+
+    def status(self, job_id: str) -> dict:
+        return self._request('GET', f'/jobs/{job_id}')
+
+    def wait(self, job_id: str) -> dict:
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            job = self.status(job_id)
+            if job['status'] == 'done':
+                return job['result']
+            if job['status'] == 'failed':
+                raise JobFailedException(job['error'])
+            time.sleep(self.poll_interval)
+        raise TimeoutError(f"Job {job_id} did not finish within {self.timeout} seconds")
+
+    def export(self, job_id: str, fmt: str = 'csv', path: str = None, progress=None, chunk_size: int = 2 ** 20) -> dict:
+        ## Full result of a finished job's query. The service streams the file; it is copied to disk chunk by
+        ## chunk, never held whole
+        path = path or export_path(fmt)
+        start = time.perf_counter()
+        req = urllib.request.Request(f"{self.base_url}/jobs/{job_id}/export", data=json.dumps({'format': fmt}).encode(),
+                                     method='POST', headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req) as resp, open(path, 'wb') as f:
+            rows = int(resp.headers['X-Export-Rows']) if resp.headers.get('X-Export-Rows') else None
+            while chunk := resp.read(chunk_size):
+                f.write(chunk)
+                if progress:
+                    progress(None, f.tell())
+        return {'path': path, 'format': fmt, 'rows': rows, 'bytes': os.path.getsize(path), 'seconds': time.perf_counter() - start}
+
+    def run(self, question: str, history: list, need_summary: bool = False, need_viz: bool = False,
+            session: str = None) -> dict:
+        job_id = self.submit(question, history, need_summary, need_viz, session)
+        result = dict(self.wait(job_id), job_id=job_id)
+        if result['data'] is not None:
+            data = result['data']
+            result['data'] = pd.DataFrame(data['data'], columns=data['columns'], index=data['index'])
+        return result
+
+
+class RemoteWorkflow:
+    ## Mirrors the DataAnalyticsWorkflow methods main.py calls, backed by one service job per question.
+    ## The job runs every requested stage at once, so the later calls just hand back its pieces.
+    def __init__(self, client: AnalyticsServiceClient, hist, session: str = None):
+        self.client = client
+        self.hist = hist
+        self.session = session
+        self.need_summary = False
+        self.need_viz = False
+        self.result = None
+
+    def set_options(self, need_summary: bool, need_viz: bool):
+        self.need_summary = need_summary
+        self.need_viz = need_viz
+
+    def generate_sql_query(self, user_query: str) -> str:
+        self.result = self.client.run(user_query, self.hist, self.need_summary, self.need_viz, self.session)
+        return self.result['sql_query']
+
+    def execute_sql_query(self, sql_query: str) -> pd.DataFrame:
+        if self.result['error'] is not None:
+            raise JobFailedException(self.result['error'])
+        return self.result['data']
+
+    def summarize_results(self, user_query: str, res) -> str:
+        return self.result['summary']
+
+    def generate_visualization(self, user_query: str, res) -> str:
+        return self.result['viz_code']
+
+    def execute_viz_code(self, viz_code: str, res: pd.DataFrame):
+        return execute_viz_code(viz_code, res)
+
+    def export_results(self, sql_query: str, fmt: str = 'csv', path: str = None, progress=None) -> dict:
+        ## The service only exports SQL it generated itself, so this exports the last job's query (which is sql_query)
+        return self.client.export(self.result['job_id'], fmt, path, progress)
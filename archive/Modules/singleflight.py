@@ -0,0 +1,72 @@
+## Single-flight coalescing: concurrent calls with the same key share one in-flight computation.
+## When a shared dashboard makes many analysts press "Get results" on the same question at once,
+## only the first call reaches OpenAI/Postgres; the rest wait for it and reuse its result.
+## Nothing is cached after the call finishes -- this only dedupes work that is running right now.
+
+import hashlib
+import json
+import threading
+
+
+def normalize_question(question: str) -> str:
+    return ' '.join(question.lower().split())
+
+
+def make_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.metrics = {'calls': 0, 'executions': 0, 'coalesced': 0}
+
+    def do(self, key: str, fn, *args, **kwargs):
+        with self._lock:
+            self.metrics['calls'] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.metrics['executions'] += 1
+            else:
+                self.metrics['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self.metrics)
+        metrics['coalesce_rate'] = metrics['coalesced'] / metrics['calls'] if metrics['calls'] else 0.0
+        return metrics
+
+
+## Process-wide instance so every Streamlit session / service worker coalesces against the same calls.
+single_flight = SingleFlight()
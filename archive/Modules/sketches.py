@@ -0,0 +1,266 @@
+## Single-pass, mergeable profiles of query results, for results too large to describe() comfortably.
+## ResultProfiler.update(chunk) takes one DataFrame chunk at a time (from_dataframe walks a fetched result in
+## chunks) and keeps a fixed-size summary per column. Two profilers of disjoint row sets can be merged, so
+## chunks can also be profiled in parallel. Per column:
+##
+##   count, nulls, min, max, mean, std   exact, up to float64 rounding (Chan et al. pairwise update)
+##   quantiles     merging t-digest with compression C (default 200, at most ~C/2 centroids). The rank error
+##                 at quantile q is at most about pi * sqrt(q * (1 - q)) / C: ~0.8% at the median and ~0.16% at
+##                 p1/p99 for C = 200. The reported min and max are exact.
+##   distinct      HyperLogLog with 2^p registers (default p = 14, 16 KiB). The standard error is 1.04 / sqrt(2^p),
+##                 ~0.8%. It is exact in practice for small counts (linear counting).
+##   top values    SpaceSaving with `capacity` counters (default 100). Every value seen more than rows / capacity
+##                 times is listed. Each reported count is at most rows / capacity too high, and its 'error'
+##                 field is a tighter per-value bound.
+##
+## Memory per column stays at ~20 KiB however many rows there are. Quantiles and moments cover numeric
+## columns only (not bool), like describe().
+
+import math
+
+import numpy as np
+import pandas as pd
+
+
+class Moments:
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values: np.ndarray):
+        if len(values):
+            other = Moments()
+            other.n, other.mean = len(values), float(values.mean())
+            other.m2 = float(((values - other.mean) ** 2).sum())
+            other.min, other.max = float(values.min()), float(values.max())
+            self.merge(other)
+
+    def merge(self, other: 'Moments'):
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta ** 2 * self.n * other.n / n
+        self.n = n
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+
+    @property
+    def std(self) -> float:
+        ## Sample standard deviation, like describe()
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else math.nan
+
+
+class TDigest:
+    def __init__(self, compression: float = 200):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = math.inf
+        self.max = -math.inf
+
+    @property
+    def n(self) -> float:
+        return float(self.weights.sum())
+
+    def update(self, values: np.ndarray):
+        if len(values):
+            self.min, self.max = min(self.min, float(values.min())), max(self.max, float(values.max()))
+            self._compress(np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))]))
+
+    def merge(self, other: 'TDigest'):
+        if len(other.means):
+            self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+            self._compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+
+    def _compress(self, means: np.ndarray, weights: np.ndarray):
+        ## Sorted points and centroids are grouped by the unit interval of the k1 scale function
+        ## k(q) = C / (2 pi) * asin(2q - 1) at their left edge, so clusters are small near the tails
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        q_left = (np.cumsum(weights) - weights) / weights.sum()
+        groups = np.floor(self.compression / (2 * math.pi) * np.arcsin(np.clip(2 * q_left - 1, -1, 1)))
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantile(self, q: float) -> float:
+        if not len(self.means):
+            return math.nan
+        ## Interpolate between centroid centres; the ends are pinned to the exact min and max
+        centres = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(q * self.n, np.r_[0.0, centres, self.n], np.r_[self.min, self.means, self.max]))
+
+
+class HyperLogLog:
+    def __init__(self, precision: int = 14):
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+    def update(self, values: np.ndarray):
+        if not len(values):
+            return
+        hashes = pd.util.hash_array(values)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest = hashes & np.uint64(2 ** (64 - self.precision) - 1)
+        ## Position of the leftmost 1 bit in the remaining 64 - p bits (64 - p + 1 if they are all 0)
+        rank = (64 - self.precision) - _bit_length(rest) + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def merge(self, other: 'HyperLogLog'):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int((self.registers == 0).sum())
+        if raw <= 2.5 * m and zeros:
+            return int(round(m * math.log(m / zeros)))
+        return int(round(raw))
+
+
+def _bit_length(values: np.ndarray) -> np.ndarray:
+    ## Exact bit length of uint64 values (a float log2 rounds near powers of two)
+    values = values.copy()
+    length = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = values >= np.uint64(1 << shift)
+        length[high] += shift
+        values[high] >>= np.uint64(shift)
+    return length + (values > 0)
+
+
+class SpaceSaving:
+    def __init__(self, capacity: int = 100):
+        self.capacity = capacity
+        ## value -> [count, error]; count - error <= true count <= count
+        self.counters = {}
+        ## Upper bound on the count of any value that is not tracked
+        self.floor = 0
+
+    def update(self, values: pd.Series):
+        counts = values.value_counts()
+        ## Categorical columns also count the categories that do not occur in this chunk
+        counts = counts[counts > 0]
+        chunk = SpaceSaving(self.capacity)
+        chunk.counters = {value: [int(count), 0] for value, count in counts.iloc[:self.capacity].items()}
+        chunk.floor = int(counts.iloc[self.capacity]) if len(counts) > self.capacity else 0
+        self.merge(chunk)
+
+    def merge(self, other: 'SpaceSaving'):
+        combined = {}
+        for value in self.counters.keys() | other.counters.keys():
+            count, error = self.counters.get(value, [self.floor, self.floor])
+            other_count, other_error = other.counters.get(value, [other.floor, other.floor])
+            combined[value] = [count + other_count, error + other_error]
+        ranked = sorted(combined.items(), key=lambda item: item[1][0], reverse=True)
+        dropped = ranked[self.capacity][1][0] if len(ranked) > self.capacity else 0
+        self.counters = dict(ranked[:self.capacity])
+        self.floor = max(self.floor + other.floor, dropped)
+
+    def top(self, k: int = 10) -> list:
+        ranked = sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)[:k]
+        return [{'value': value, 'count': count, 'error': error} for value, (count, error) in ranked]
+
+
+class ColumnSketch:
+    def __init__(self, name, compression: float = 200, precision: int = 14, capacity: int = 100):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.dtypes = []
+        self.moments = Moments()
+        self.digest = TDigest(compression)
+        self.distinct = HyperLogLog(precision)
+        self.top = SpaceSaving(capacity)
+
+    @property
+    def numeric(self) -> bool:
+        return self.moments.n > 0
+
+    def update(self, col: pd.Series):
+        if str(col.dtype) not in self.dtypes:
+            self.dtypes.append(str(col.dtype))
+        values = col.dropna()
+        self.count += len(values)
+        self.nulls += len(col) - len(values)
+        if not len(values):
+            return
+        if pd.api.types.is_numeric_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype):
+            numbers = values.to_numpy(dtype='float64')
+            self.moments.update(numbers)
+            self.digest.update(numbers)
+        self.distinct.update(values.to_numpy())
+        self.top.update(values)
+
+    def merge(self, other: 'ColumnSketch'):
+        self.dtypes += [dtype for dtype in other.dtypes if dtype not in self.dtypes]
+        self.count += other.count
+        self.nulls += other.nulls
+        self.moments.merge(other.moments)
+        self.digest.merge(other.digest)
+        self.distinct.merge(other.distinct)
+        self.top.merge(other.top)
+
+    def report(self, top_k: int = 10) -> dict:
+        report = {'column': self.name, 'dtype': ' / '.join(self.dtypes), 'count': self.count, 'nulls': self.nulls,
+                  'distinct': self.distinct.estimate(), 'top': self.top.top(top_k)}
+        if self.numeric:
+            report.update({'mean': self.moments.mean, 'std': self.moments.std, 'min': self.moments.min,
+                           'max': self.moments.max, **{f"{int(q * 100)}%": self.digest.quantile(q) for q in (0.25, 0.5, 0.75)}})
+        return report
+
+
+class ResultProfiler:
+    def __init__(self, compression: float = 200, precision: int = 14, capacity: int = 100):
+        self.settings = {'compression': compression, 'precision': precision, 'capacity': capacity}
+        self.rows = 0
+        ## One sketch per column position, so duplicate column names stay apart
+        self.columns = []
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, chunk_rows: int = 100000, **settings) -> 'ResultProfiler':
+        profiler = cls(**settings)
+        for start in range(0, len(df), chunk_rows):
+            profiler.update(df.iloc[start:start + chunk_rows])
+        return profiler
+
+    def update(self, chunk: pd.DataFrame) -> 'ResultProfiler':
+        if not self.columns:
+            self.columns = [ColumnSketch(name, **self.settings) for name in chunk.columns]
+        for idx, sketch in enumerate(self.columns):
+            sketch.update(chunk.iloc[:, idx])
+        self.rows += len(chunk)
+        return self
+
+    def merge(self, other: 'ResultProfiler') -> 'ResultProfiler':
+        if not self.columns:
+            self.columns = [ColumnSketch(sketch.name, **self.settings) for sketch in other.columns]
+        for sketch, other_sketch in zip(self.columns, other.columns):
+            sketch.merge(other_sketch)
+        self.rows += other.rows
+        return self
+
+    def report(self, top_k: int = 10) -> dict:
+        return {'rows': self.rows, 'columns': [sketch.report(top_k) for sketch in self.columns]}
+
+    def describe(self) -> pd.DataFrame:
+        ## Same rows as df.describe() for the numeric columns, from the sketches
+        stats = ('count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max')
+        reports = [sketch.report() for sketch in self.columns if sketch.numeric]
+        return pd.DataFrame({report['column']: [report[stat] for stat in stats] for report in reports}, index=list(stats))
+
+    def info(self, top_k: int = 3) -> str:
+        ## Like df.info(), plus approximate distinct counts and the most frequent values
+        lines = [f"{self.rows} entries (profiled in one pass; distinct counts and quantiles are approximate)",
+                 f"Data columns (total {len(self.columns)} columns):"]
+        for idx, sketch in enumerate(self.columns):
+            ## Only values that are certainly frequent; below rows / capacity the counters are mostly error
+            frequent = [item for item in sketch.top.top(top_k) if item['count'] - item['error'] > self.rows / sketch.top.capacity]
+            top = ', '.join(f"{item['value']!r} ({item['count']})" for item in frequent) or 'no frequent values'
+            lines.append(f" {idx}  {sketch.name}  {sketch.count} non-null  {' / '.join(sketch.dtypes)}  "
+                         f"~{sketch.distinct.estimate()} distinct  top: {top}")
+        return '\n'.join(lines)
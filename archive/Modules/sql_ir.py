@@ -0,0 +1,216 @@
+## Parse-once representation of a generated SQL query.
+## The generated SQL used to be re-scanned as a raw string by every stage: a substring DDL check (which also
+## rejected harmless names like CreatedAt), a regex for the output column names, ad-hoc whitespace
+## canonicalization for cache keys and another scanner for ORDER BY when paging. parse_sql() tokenizes the
+## query once -- string literals, quoted identifiers and comments are kept intact -- and returns a ParsedSQL.
+## ParsedSQL is still a str, so it can be displayed, logged, cached and executed as before, but it also
+## carries the statement type, output columns, referenced tables and canonical text.
+
+import re
+
+TOKEN_REGEX = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>[Ee]'(?:[^'\\]|''|\\.)*'|[BbXxNn]?'(?:[^']|'')*'|\$(?P<tag>[A-Za-z_]*)\$.*?\$(?P=tag)\$)
+  | (?P<quoted>"(?:[^"]|"")*")
+  | (?P<number>(?:\d+(?:\.\d*)?|\.\d+)(?:[Ee][+-]?\d+)?)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<cast>::)
+  | (?P<operator>->>|\#>>|!~~\*|~~\*|!~~|!~\*|<>|<=|>=|!=|\|\||->|\#>|@>|<@|\?\||\?&|~~|!~|~\*|&&|<<|>>)
+  | (?P<space>\s+)
+  | (?P<punct>.)
+""", re.VERBOSE | re.DOTALL)
+
+## Keywords that write to or change the database, wherever they appear as a token (e.g. inside a CTE)
+WRITE_KEYWORDS = {'CREATE', 'DELETE', 'UPDATE', 'ALTER', 'INSERT', 'DROP', 'TRUNCATE', 'GRANT', 'REVOKE', 'MERGE', 'COPY', 'VACUUM', 'REINDEX', 'CLUSTER'}
+READ_STATEMENTS = {'SELECT', 'VALUES', 'TABLE'}
+## Clauses that end the SELECT list
+SELECT_LIST_END = {'FROM', 'WHERE', 'GROUP', 'HAVING', 'ORDER', 'LIMIT', 'OFFSET', 'FETCH', 'UNION', 'INTERSECT', 'EXCEPT', 'WINDOW', 'FOR', 'INTO'}
+## Clauses that end a FROM list
+FROM_LIST_END = {'WHERE', 'GROUP', 'HAVING', 'ORDER', 'LIMIT', 'OFFSET', 'FETCH', 'UNION', 'INTERSECT', 'EXCEPT', 'WINDOW', 'FOR', ';'}
+## Functions whose arguments use FROM without referring to a table
+FROM_FUNCTIONS = {'EXTRACT', 'SUBSTRING', 'TRIM', 'OVERLAY', 'POSITION'}
+## Words that end an expression rather than alias it
+NON_ALIAS_WORDS = {'END', 'NULL', 'TRUE', 'FALSE', 'ASC', 'DESC'}
+
+
+class Token:
+    __slots__ = ('kind', 'text', 'depth')
+
+    def __init__(self, kind: str, text: str, depth: int):
+        self.kind = kind
+        self.text = text
+        self.depth = depth
+
+    @property
+    def upper(self) -> str:
+        return self.text.upper() if self.kind == 'word' else self.text
+
+
+def tokenize(sql_query: str) -> list:
+    ## Tokens without whitespace and comments; depth is the parenthesis nesting level of each token
+    tokens, depth = [], 0
+    for match in TOKEN_REGEX.finditer(sql_query):
+        kind, text = match.lastgroup, match.group()
+        if kind in ('space', 'comment'):
+            continue
+        if text == ')':
+            depth -= 1
+        tokens.append(Token(kind, text, depth))
+        if text == '(':
+            depth += 1
+    return tokens
+
+
+def _identifier(token: Token) -> str:
+    ## Postgres folds unquoted identifiers to lower case
+    return token.text[1:-1].replace('""', '"') if token.kind == 'quoted' else token.text.lower()
+
+
+def _join(tokens: list, fold_case: bool = False) -> str:
+    text = ''
+    for previous, token in zip([None] + tokens, tokens):
+        if previous is not None and token.text not in (',', ')', '.', '::') and previous.text not in ('(', '.', '::') \
+                and not (token.text == '(' and previous.kind == 'word'):
+            text += ' '
+        text += token.upper if fold_case else token.text
+    return text
+
+
+def _split_commas(tokens: list, depth: int = 0) -> list:
+    parts, current = [], []
+    for token in tokens:
+        if token.text == ',' and token.depth == depth:
+            parts.append(current)
+            current = []
+        else:
+            current.append(token)
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _column_label(item: list) -> str:
+    ## The name Postgres gives a SELECT item: its alias, the column name of "t.col" / "col", else the expression
+    if len(item) >= 3 and item[-2].upper == 'AS':
+        return _identifier(item[-1])
+    last, previous = item[-1], item[-2] if len(item) >= 2 else None
+    if previous is not None and last.kind in ('word', 'quoted') and last.upper not in NON_ALIAS_WORDS \
+            and (previous.kind in ('word', 'quoted', 'number', 'string') or previous.text == ')') \
+            and previous.upper not in ('DISTINCT', 'ALL'):
+        return _identifier(last)
+    if last.kind in ('word', 'quoted') and (len(item) == 1 or previous.text == '.'):
+        return _identifier(last)
+    return _join(item)
+
+
+class ParsedSQL(str):
+    def __new__(cls, sql_query: str):
+        obj = super().__new__(cls, sql_query)
+        obj._parse()
+        return obj
+
+    def _parse(self):
+        tokens = tokenize(self)
+        while tokens and tokens[-1].text == ';':
+            tokens.pop()
+        self.tokens = tokens
+        ## Whitespace, comment, keyword-case and trailing-semicolon differences do not change the canonical text
+        self.canonical = _join(tokens, fold_case=True)
+        self.write_keywords = sorted({token.upper for token in tokens if token.kind == 'word'} & WRITE_KEYWORDS)
+
+        ## WITH name [(columns)] AS [NOT] [MATERIALIZED] (body), ... -- then the main statement
+        self.cte_names = []
+        idx = 0
+        if tokens and tokens[0].upper == 'WITH':
+            idx = 2 if len(tokens) > 1 and tokens[1].upper == 'RECURSIVE' else 1
+            while idx < len(tokens):
+                self.cte_names.append(_identifier(tokens[idx]))
+                while idx < len(tokens) and not (tokens[idx].upper == 'AS' and tokens[idx].depth == 0):
+                    idx += 1
+                while idx < len(tokens) and tokens[idx].text != '(':
+                    idx += 1
+                idx += 1
+                while idx < len(tokens) and tokens[idx].depth > 0:
+                    idx += 1
+                idx += 1
+                if idx < len(tokens) and tokens[idx].text == ',':
+                    idx += 1
+                    continue
+                break
+        self.main_tokens = tokens[idx:]
+        self.statement_type = self.main_tokens[0].upper if self.main_tokens else ''
+        ## SELECT ... INTO new_table creates a table
+        if any(token.depth == 0 and token.upper == 'INTO' for token in self.main_tokens):
+            self.write_keywords = sorted(set(self.write_keywords) | {'INTO'})
+
+        self.output_columns = self._output_columns()
+        self.referenced_tables = self._referenced_tables()
+
+    @property
+    def is_read_only(self) -> bool:
+        return self.statement_type in READ_STATEMENTS and not self.write_keywords
+
+    def _clause_end(self, start: int, keywords: set) -> int:
+        for idx in range(start, len(self.main_tokens)):
+            token = self.main_tokens[idx]
+            if token.depth == 0 and token.upper in keywords:
+                return idx
+        return len(self.main_tokens)
+
+    def _output_columns(self) -> list:
+        if self.statement_type != 'SELECT':
+            return []
+        tokens = self.main_tokens
+        start = 1
+        if start < len(tokens) and tokens[start].upper in ('DISTINCT', 'ALL'):
+            start += 1
+            if start < len(tokens) and tokens[start - 1].upper == 'DISTINCT' and tokens[start].upper == 'ON':
+                ## DISTINCT ON (...) -- skip the parenthesised expressions
+                start += 2
+                while start < len(tokens) and tokens[start].depth > 0:
+                    start += 1
+                start += 1
+        items = _split_commas(tokens[start:self._clause_end(start, SELECT_LIST_END)])
+        columns = []
+        for item in items:
+            label = _column_label(item)
+            ## Duplicate names (a.id, b.id) would make DataFrame columns ambiguous; keep the expression instead
+            columns.append(_join(item) if label in columns else label)
+        return columns
+
+    def _referenced_tables(self) -> list:
+        tables, openers = [], []
+        for idx, token in enumerate(self.tokens):
+            if token.text == '(':
+                openers.append(self.tokens[idx - 1].upper if idx else None)
+            elif token.text == ')' and openers:
+                openers.pop()
+            elif token.upper in ('FROM', 'JOIN') and idx + 1 < len(self.tokens):
+                if openers and openers[-1] in FROM_FUNCTIONS:
+                    continue
+                for start in self._from_items(idx + 1, token.depth):
+                    following = self.tokens[start]
+                    if following.kind not in ('word', 'quoted'):
+                        continue
+                    name = _identifier(following)
+                    if start + 2 < len(self.tokens) and self.tokens[start + 1].text == '.':
+                        name = f"{name}.{_identifier(self.tokens[start + 2])}"
+                    if name not in self.cte_names and name not in tables:
+                        tables.append(name)
+        return tables
+
+    def _from_items(self, start: int, depth: int) -> list:
+        ## Positions where the items of a FROM list start: `start` and after each comma at the same depth
+        items = [start]
+        for idx in range(start, len(self.tokens) - 1):
+            token = self.tokens[idx]
+            if token.depth < depth or (token.depth == depth and token.upper in FROM_LIST_END):
+                break
+            if token.depth == depth and token.text == ',':
+                items.append(idx + 1)
+        return items
+
+
+def parse_sql(sql_query: str) -> ParsedSQL:
+    ## Parse once: an already parsed query is returned as is
+    return sql_query if isinstance(sql_query, ParsedSQL) else ParsedSQL(sql_query)
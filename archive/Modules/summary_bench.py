@@ -0,0 +1,98 @@
+## Scaling benchmark for ResponseSummarizer's map-reduce mode against a local fake chat server.
+## The fake server takes `--base-latency` seconds per call plus `--token-latency` seconds per prompt token,
+## roughly how provider latency grows with input. For each result size it reports the wall-clock time next to
+## the time the same calls would take one after another; with partitions summarized in parallel, wall-clock
+## time should grow more slowly than the row count.
+##
+## python summary_bench.py --rows 2000 8000 32000 --max-parallel 4
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+from langchain_openai import ChatOpenAI
+
+from CustomAgents import ResponseSummarizer
+from llm_client import ResilientLLM
+from token_accounting import count_tokens
+
+
+def make_handler(base_latency: float, token_latency: float):
+    class FakeChatHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            prompt_tokens = sum(count_tokens(message.get('content') or '') for message in request.get('messages', []))
+            time.sleep(base_latency + prompt_tokens * token_latency)
+            body = json.dumps({
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': 'fake',
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'All good'}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': 2, 'total_tokens': prompt_tokens + 2},
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return FakeChatHandler
+
+
+def start_fake_server(port: int, base_latency: float, token_latency: float) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(base_latency, token_latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_result(rows: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'region': rng.choice(['North', 'South', 'East', 'West', 'Central', 'Overseas'], rows),
+        'order_date': pd.date_range('2020-01-01', periods=rows, freq='h').strftime('%Y-%m-%d %H:00'),
+        'units': rng.integers(1, 50, rows),
+        'revenue': rng.gamma(2.0, 150.0, rows).round(2),
+    })
+
+
+def run(port: int, rows: int, max_parallel: int) -> dict:
+    chat = ChatOpenAI(model='fake', api_key='fake', base_url=f'http://127.0.0.1:{port}/v1', timeout=60, max_retries=0)
+    ## A fresh client per size so the latency history only holds this run's calls; the fake server has no rate limit
+    llm = ResilientLLM(chat, admission=None)
+    summarizer = ResponseSummarizer(llm, max_parallel=max_parallel)
+    df = make_result(rows)
+    start = time.perf_counter()
+    summarizer.summarize("How does revenue develop per region?", df)
+    wall = time.perf_counter() - start
+    serial = sum(sum(latencies) for latencies in llm.shared['latencies'].values())
+    calls = sum(step['calls'] for step in llm.get_metrics()['steps'].values())
+    return {'rows': rows, 'partitions': len(summarizer.partition(df, summarizer.grouping_column(df))),
+            'calls': calls, 'wall': wall, 'serial': serial}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[2000, 8000, 32000])
+    parser.add_argument('--max-parallel', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8767)
+    parser.add_argument('--base-latency', type=float, default=0.5)
+    parser.add_argument('--token-latency', type=float, default=0.0001)
+    args = parser.parse_args()
+
+    server = start_fake_server(args.port, args.base_latency, args.token_latency)
+    print(f"{'rows':>8} {'parts':>6} {'calls':>6} {'wall s':>8} {'serial s':>9} {'wall x':>7} {'rows x':>7}")
+    first = None
+    for rows in args.rows:
+        result = run(args.port, rows, args.max_parallel)
+        first = first or result
+        print(f"{rows:>8} {result['partitions']:>6} {result['calls']:>6} {result['wall']:>8.2f} {result['serial']:>9.2f} "
+              f"{result['wall'] / first['wall']:>7.1f} {rows / first['rows']:>7.1f}")
+    server.shutdown()
@@ -0,0 +1,126 @@
+## Token and prompt-size accounting per prompt template, per template variable and per request.
+## account(prompt, step) goes in front of a PromptTemplate in a chain and counts how many tokens each input
+## variable (table_info, dataframe, previous_queries, ...) adds to the prompt; ResilientLLM reports the
+## provider's prompt/completion token usage for the same step. report() ranks the inputs by total tokens so
+## it is obvious which ones are worth shrinking.
+##
+## Token counts use tiktoken when it is installed and fall back to a ~4 characters per token estimate.
+
+import contextvars
+import threading
+import uuid
+from contextlib import contextmanager
+
+from langchain_core.runnables import RunnableLambda
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('o200k_base')
+except ImportError:
+    _encoding = None
+
+
+def count_tokens(text) -> int:
+    text = text if isinstance(text, str) else str(text)
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+_current_request = contextvars.ContextVar('token_accounting_request', default=None)
+
+
+class TokenAccountant:
+    def __init__(self, max_requests: int = 500):
+        self._lock = threading.Lock()
+        self.max_requests = max_requests
+        ## template -> {'calls', 'template_tokens', 'variables': {name: tokens}, 'prompt_tokens', 'completion_tokens'}
+        self.templates = {}
+        ## request id -> {template: {'prompt_tokens', 'completion_tokens'}}
+        self.requests = {}
+
+    def begin_request(self, request_id: str = None) -> str:
+        ## Attributes LLM calls from here on (in this thread/context) to a new request
+        request_id = request_id or uuid.uuid4().hex
+        _current_request.set(request_id)
+        return request_id
+
+    @contextmanager
+    def request(self, request_id: str = None):
+        ## Attributes every LLM call made inside the block to one request
+        token = _current_request.set(request_id or uuid.uuid4().hex)
+        try:
+            yield _current_request.get()
+        finally:
+            _current_request.reset(token)
+
+    def _template_entry(self, template: str) -> dict:
+        return self.templates.setdefault(template, {
+            'calls': 0, 'template_tokens': 0, 'variables': {}, 'prompt_tokens': 0, 'completion_tokens': 0,
+        })
+
+    def _request_entry(self, template: str) -> dict:
+        request_id = _current_request.get()
+        if request_id is None:
+            return None
+        if request_id not in self.requests and len(self.requests) >= self.max_requests:
+            del self.requests[next(iter(self.requests))]
+        return self.requests.setdefault(request_id, {}).setdefault(template, {'prompt_tokens': 0, 'completion_tokens': 0})
+
+    def record_inputs(self, template: str, prompt, variables: dict):
+        variable_tokens = {name: count_tokens(value) for name, value in variables.items()}
+        ## Fixed instruction text: the template with every placeholder removed
+        fixed_text = prompt.template
+        for name in prompt.input_variables:
+            fixed_text = fixed_text.replace('{' + name + '}', '')
+        fixed_tokens = count_tokens(fixed_text)
+        with self._lock:
+            entry = self._template_entry(template)
+            entry['calls'] += 1
+            entry['template_tokens'] += fixed_tokens
+            for name, tokens in variable_tokens.items():
+                entry['variables'][name] = entry['variables'].get(name, 0) + tokens
+
+    def record_usage(self, template: str, prompt_tokens: int, completion_tokens: int):
+        with self._lock:
+            entry = self._template_entry(template)
+            entry['prompt_tokens'] += prompt_tokens
+            entry['completion_tokens'] += completion_tokens
+            request_entry = self._request_entry(template)
+            if request_entry is not None:
+                request_entry['prompt_tokens'] += prompt_tokens
+                request_entry['completion_tokens'] += completion_tokens
+
+    def report(self) -> list:
+        ## One row per (template, input): the fixed instructions, each variable, and the completion. Largest first.
+        rows = []
+        with self._lock:
+            for template, entry in self.templates.items():
+                calls = entry['calls'] or 1
+                inputs = [('<instructions>', entry['template_tokens'])] + list(entry['variables'].items())
+                measured_prompt = sum(tokens for _, tokens in inputs) or 1
+                for name, tokens in inputs:
+                    rows.append({
+                        'template': template, 'input': name, 'total_tokens': tokens,
+                        'avg_tokens': tokens / calls, 'share_of_prompt': tokens / measured_prompt,
+                    })
+                rows.append({
+                    'template': template, 'input': '<completion>', 'total_tokens': entry['completion_tokens'],
+                    'avg_tokens': entry['completion_tokens'] / calls, 'share_of_prompt': None,
+                })
+        return sorted(rows, key=lambda row: row['total_tokens'], reverse=True)
+
+    def request_report(self, request_id: str) -> dict:
+        with self._lock:
+            return {template: dict(values) for template, values in self.requests.get(request_id, {}).items()}
+
+
+token_accountant = TokenAccountant()
+
+
+def account(prompt, template: str):
+    ## Pass-through step that records per-variable prompt sizes before the prompt is formatted
+    def record(variables: dict) -> dict:
+        token_accountant.record_inputs(template, prompt, variables)
+        return variables
+    return RunnableLambda(record) | prompt
@@ -0,0 +1,147 @@
+## Visualization history.
+## Charts used to be written as standalone HTML files with the full plotly.js bundle embedded (~3.5 MB each).
+## Now each figure is stored once as gzipped JSON named by its content hash, and a SQLite catalog records
+## which question, SQL, data and code produced it. Identical figures are only written once, and old
+## entries are evicted by age and count. HTML is exported on demand and shares one local plotly.min.js.
+
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import plotly.graph_objects as go
+import plotly.offline
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class VizHistoryStore:
+    def __init__(self, directory: str = "Viz History", max_figures: int = 5000, max_age_days: float = 90, evict_every: int = 100):
+        self.directory = directory
+        self.figures_dir = os.path.join(directory, "figures")
+        self.html_dir = os.path.join(directory, "html")
+        self.max_figures = max_figures
+        self.max_age_days = max_age_days
+        self.evict_every = evict_every
+        self._saves = 0
+        self._lock = threading.RLock()
+        os.makedirs(self.figures_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(directory, "catalog.sqlite"), check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS charts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                question TEXT,
+                normalized_question TEXT,
+                sql_query TEXT,
+                data_hash TEXT,
+                figure_hash TEXT NOT NULL,
+                viz_code TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS charts_lookup ON charts (normalized_question, data_hash);
+            CREATE INDEX IF NOT EXISTS charts_created_at ON charts (created_at);
+            CREATE INDEX IF NOT EXISTS charts_figure_hash ON charts (figure_hash);
+        """)
+
+    def _figure_path(self, figure_hash: str) -> str:
+        return os.path.join(self.figures_dir, f"{figure_hash}.json.gz")
+
+    def save(self, fig, question: str = None, sql_query: str = None, data_hash: str = None, viz_code: str = None) -> int:
+        ## fig is a figure or its JSON (as kept by figure_cache)
+        figure_json = fig if isinstance(fig, str) else fig.to_json()
+        figure_hash = hashlib.sha256(figure_json.encode()).hexdigest()
+        path = self._figure_path(figure_hash)
+        normalized = ' '.join(question.lower().split()) if question else None
+        with self._lock:
+            if not os.path.exists(path):
+                with gzip.open(path, 'wt', encoding='utf-8') as f:
+                    f.write(figure_json)
+            cursor = self.conn.execute(
+                "INSERT INTO charts (question, normalized_question, sql_query, data_hash, figure_hash, viz_code, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (question, normalized, sql_query, data_hash, figure_hash, viz_code, time.time()),
+            )
+            self.conn.commit()
+            self._saves += 1
+            if self._saves % self.evict_every == 0:
+                self.evict()
+        return cursor.lastrowid
+
+    def find(self, question: str, data_hash: str) -> dict:
+        ## Most recent chart for the same question over the same data, if any
+        normalized = ' '.join(question.lower().split())
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT id, question, sql_query, data_hash, figure_hash, viz_code, created_at FROM charts "
+                "WHERE normalized_question = ? AND data_hash = ? ORDER BY created_at DESC LIMIT 1",
+                (normalized, data_hash),
+            ).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def list_charts(self, limit: int = 50) -> list:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id, question, sql_query, data_hash, figure_hash, viz_code, created_at FROM charts ORDER BY created_at DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def _row_to_dict(self, row) -> dict:
+        keys = ('id', 'question', 'sql_query', 'data_hash', 'figure_hash', 'viz_code', 'created_at')
+        return dict(zip(keys, row))
+
+    def load_figure(self, figure_hash: str):
+        with gzip.open(self._figure_path(figure_hash), 'rt', encoding='utf-8') as f:
+            ## Stored figures were valid when saved; skip plotly's property validation on every load
+            return go.Figure(json.loads(f.read()), _validate=False)
+
+    def export_html(self, figure_hash: str) -> str:
+        ## Small HTML page that loads the shared plotly.min.js next to it instead of embedding it
+        os.makedirs(self.html_dir, exist_ok=True)
+        asset = os.path.join(self.html_dir, "plotly.min.js")
+        if not os.path.exists(asset):
+            with open(asset, 'w', encoding='utf-8') as f:
+                f.write(plotly.offline.get_plotlyjs())
+        path = os.path.join(self.html_dir, f"{figure_hash}.html")
+        if not os.path.exists(path):
+            self.load_figure(figure_hash).write_html(path, include_plotlyjs='plotly.min.js')
+        return path
+
+    def evict(self):
+        cutoff = time.time() - self.max_age_days * 86400
+        with self._lock:
+            self.conn.execute("DELETE FROM charts WHERE created_at < ?", (cutoff,))
+            self.conn.execute(
+                "DELETE FROM charts WHERE id NOT IN (SELECT id FROM charts ORDER BY created_at DESC LIMIT ?)",
+                (self.max_figures,),
+            )
+            self.conn.commit()
+            referenced = {row[0] for row in self.conn.execute("SELECT DISTINCT figure_hash FROM charts")}
+            for filename in os.listdir(self.figures_dir):
+                figure_hash = filename.split('.')[0]
+                if figure_hash not in referenced:
+                    os.remove(os.path.join(self.figures_dir, filename))
+                    html_path = os.path.join(self.html_dir, f"{figure_hash}.html")
+                    if os.path.exists(html_path):
+                        os.remove(html_path)
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            charts, figures = self.conn.execute("SELECT COUNT(*), COUNT(DISTINCT figure_hash) FROM charts").fetchone()
+        disk_bytes = sum(os.path.getsize(os.path.join(self.figures_dir, name)) for name in os.listdir(self.figures_dir))
+        return {'charts': charts, 'unique_figures': figures, 'disk_bytes': disk_bytes}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_viz_store() -> VizHistoryStore:
+    ## One store per process, created on first use so importing this module has no side effects
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = VizHistoryStore(directory=os.getenv('VIZ_HISTORY_DIR', 'Viz History'))
+    return _store
@@ -0,0 +1,128 @@
+## Background pre-computation of the sample questions from get_sample_queries().
+## Most first-time users click a sample first, so a warm-up thread generates, runs and caches their SQL,
+## result DataFrame and (optionally) summary at process start and again on a schedule.
+## Every scheduled pass recomputes every question, since the data under an unchanged schema moves too. Entries
+## are also tied to a fingerprint of the schema, which only invalidates them early when the schema changes, and
+## are not served once older than max_age (SAMPLE_CACHE_MAX_AGE), in case the passes stop succeeding.
+
+import hashlib
+import os
+import threading
+import time
+
+from Agent_Helpers import get_table_definitions, get_sample_queries, hash_dataframe
+from singleflight import normalize_question
+from result_store import result_store
+from sql_ir import parse_sql
+from memory_accounting import memory_accountant
+from admission import admission_controller
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def schema_fingerprint(db) -> str:
+    return hashlib.sha256(get_table_definitions(db).encode()).hexdigest()
+
+
+class SampleQueryCache:
+    def __init__(self, max_age: float = 7200):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.entries = {}
+        self.fingerprint = None
+        self.metrics = {'hits': 0, 'misses': 0, 'refreshes': 0}
+
+    def put(self, question: str, entry: dict):
+        key = normalize_question(question)
+        with self._lock:
+            self.entries[key] = entry
+        ## The result itself is accounted by the result store; this covers the SQL and summary text
+        memory_accountant.track('sample_cache', key, len(entry['sql_query']) + len(entry['summary'] or ''),
+                                evict=lambda: self.evict(key))
+
+    def evict(self, key: str):
+        with self._lock:
+            self.entries.pop(key, None)
+
+    def _is_fresh(self, entry: dict) -> bool:
+        return entry['fingerprint'] == self.fingerprint and time.time() - entry['computed_at'] <= self.max_age
+
+    def get(self, question: str) -> dict:
+        with self._lock:
+            entry = self.entries.get(normalize_question(question))
+            if entry is None or not self._is_fresh(entry):
+                self.metrics['misses'] += 1
+                return None
+            self.metrics['hits'] += 1
+        memory_accountant.touch('sample_cache', normalize_question(question))
+        return entry
+
+    def get_by_sql(self, sql_query: str) -> dict:
+        canonical = parse_sql(sql_query).canonical
+        with self._lock:
+            for entry in self.entries.values():
+                if self._is_fresh(entry) and entry['canonical_sql'] == canonical:
+                    return entry
+        return None
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            fresh = sum(1 for entry in self.entries.values() if self._is_fresh(entry))
+            return dict(self.metrics, entries=len(self.entries), fresh=fresh)
+
+
+class SampleQueryWarmer:
+    def __init__(self, workflow, cache: SampleQueryCache, queries: list = None, interval: float = 3600, with_summary: bool = False):
+        self.workflow = workflow
+        self.cache = cache
+        self.queries = queries or get_sample_queries()
+        self.interval = interval
+        self.with_summary = with_summary
+        self._stop = threading.Event()
+        self._thread = None
+
+    def warm_once(self):
+        self.cache.fingerprint = schema_fingerprint(self.workflow.db)
+        ## The previous entry keeps being served until its replacement is ready
+        for question in self.queries:
+            try:
+                start = time.perf_counter()
+                ## refresh: the workflow would otherwise answer from this very cache (and the question index)
+                sql_query = self.workflow.generate_sql_query(question, hist=[], refresh=True)
+                res = self.workflow.execute_sql_query(sql_query, refresh=True)
+                summary = self.workflow.summarize_results(question, res, refresh=True) if self.with_summary else None
+                self.cache.put(question, {
+                    'sql_query': sql_query,
+                    'canonical_sql': parse_sql(sql_query).canonical,
+                    ## Held through the result store so warm results can spill to disk like any other
+                    'data': result_store.put(res),
+                    'data_hash': hash_dataframe(res),
+                    'summary': summary,
+                    'fingerprint': self.cache.fingerprint,
+                    'computed_at': time.time(),
+                })
+                self.cache.metrics['refreshes'] += 1
+                logger.info("Warmed sample query in %.2fs: %s", time.perf_counter() - start, question)
+            except Exception as e:
+                logger.error("Could not warm sample query %r: %s", question, e)
+
+    def _run(self):
+        ## Warm-up LLM calls only use the rate limit left over by interactive ones
+        admission_controller.begin(priority='batch', session='sample-warmup')
+        while not self._stop.is_set():
+            self.warm_once()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sample-query-warmup", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+
+## Process-wide cache so every session and worker benefits from one warm-up.
+sample_cache = SampleQueryCache(max_age=float(os.getenv('SAMPLE_CACHE_MAX_AGE', 7200)))
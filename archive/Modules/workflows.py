@@ -1,79 +1,287 @@
 from CustomAgents import ResponseSummarizer, VisualizationAgent, AnalystAgent, SQLExpert
-from Agent_Helpers import DBLoader, SQLCoder, init_history, execute_viz_code, DDLCommandException, NoDataFoundException, get_table_definitions, clean_sql_query
+from Agent_Helpers import DBLoader, SQLCoder, init_history, DDLCommandException, NoDataFoundException, get_table_definitions, clean_sql_query, hash_dataframe
+from sql_ir import parse_sql
+from async_db import AsyncSQLCoder
+from cassette import cassette, CassetteLLM
+from profiling import profile_block
+from memory_accounting import memory_accountant
+from admission import admission_controller
+from singleflight import single_flight, make_key, normalize_question
+from warmup import sample_cache
+from matviews import view_manager
+from question_index import question_index
+from result_store import ResultEvictedException
+from viz_store import get_viz_store
+from figure_cache import figure_cache
+from export import export_query
+from sketches import ResultProfiler
 from langchain_openai import ChatOpenAI
+from llm_client import ResilientLLM
+from token_accounting import token_accountant
 from io import StringIO
+from functools import lru_cache
 import os
-from datetime import datetime
+import json
+import asyncio
 
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+## Cheap "All good"-style critique steps go to a smaller model by default. Override with LLM_STEP_MODELS, a JSON
+## object of step -> model, e.g. {"correct_query": "gpt4all:/models/mistral-7b.Q4_K_M.gguf"}; {} disables tiering.
+DEFAULT_STEP_MODELS = {
+    'correct_query': 'gpt-4o-mini',
+    'summary_reflect': 'gpt-4o-mini',
+    'viz_reflect': 'gpt-4o-mini',
+}
+
+def make_chat_model(spec: str):
+    ## CASSETTE_MODE=record/replay (cassette.py) puts a recording layer under ResilientLLM; replay needs no client
+    if cassette is not None:
+        return CassetteLLM(None if cassette.mode == 'replay' else _make_chat_model(spec), cassette, spec)
+    return _make_chat_model(spec)
+
+def _make_chat_model(spec: str):
+    if spec.startswith('gpt4all:'):
+        from langchain_community.llms import GPT4All
+        return GPT4All(model=spec[len('gpt4all:'):], device="cpu", max_tokens=2048)
+    return ChatOpenAI(
+        model=spec,
+        temperature=0,
+        max_tokens=None,
+        timeout=120,
+        max_retries=0
+    )
+
+@lru_cache(maxsize=None)
+def build_llm():
+    ## One client per process so latency history (for hedging), breaker state and metrics survive
+    ## the per-rerun workflow objects in main.py.
+    ## Retries, per-step timeouts, hedging and the circuit breaker live in ResilientLLM, so the client itself
+    ## gets no retries of its own; ResilientLLM sets each request's timeout to its step's.
+    step_models = json.loads(os.getenv('LLM_STEP_MODELS', json.dumps(DEFAULT_STEP_MODELS)))
+    clients = {spec: make_chat_model(spec) for spec in set(step_models.values())}
+    return ResilientLLM(
+        make_chat_model(os.getenv('LLM_MODEL', 'gpt-4o')),
+        max_retries=2,
+        hedge=os.getenv('LLM_HEDGING', 'false').lower() == 'true',
+        step_models={step: clients[spec] for step, spec in step_models.items()},
+        ## Replayed calls never reach the provider, so they are not rate limited
+        admission=None if cassette is not None and cassette.mode == 'replay' else admission_controller,
+    )
+
+## Process-wide structures that grow with use; sized on demand in memory reports
+memory_accountant.observe('token_accounting', lambda: (token_accountant.templates, token_accountant.requests))
+memory_accountant.observe('question_index', lambda: question_index)
+memory_accountant.observe('llm_latency_history', lambda: build_llm().shared['latencies'])
+
 class DataAnalyticsWorkflow:
-    def __init__(self):
+    def __init__(self, profile: bool = None):
+        ## profile=True (or WORKFLOW_PROFILE=true) runs each run_workflow under a sampling profiler, see profiling.py
+        self.profile = os.getenv('WORKFLOW_PROFILE', 'false').lower() == 'true' if profile is None else profile
+        ## Paths of the last run's profile ({'speedscope', 'html', 'seconds'}), None when not profiled
+        self.last_profile = None
         self.db_loader = DBLoader()
         self.db = self.db_loader.load_db()
-        self.llm = ChatOpenAI(
-            model="gpt-4o",
-            temperature=0,
-            max_tokens=None,
-            timeout=None,
-            max_retries=2
-        )
-        self.sql_coder = SQLCoder(self.db)
+        self.llm = build_llm()
+        self.sql_coder = SQLCoder(self.db, view_manager if os.getenv('AUTO_MATVIEWS', 'false').lower() == 'true' else None)
         self.response_summarizer = ResponseSummarizer(self.llm)
         self.visualization_agent = VisualizationAgent(self.llm)
         self.analyst_agent = AnalystAgent(self.llm)
+        ## Results with at least this many rows are described to the analyst agent from sketches (sketches.py)
+        self.sketch_rows = int(os.getenv('ANALYST_SKETCH_ROWS', 100000))
         self.query_generator = SQLExpert(self.llm)
         self.hist = init_history()
+        ## Identical concurrent requests (same question, history and data) share one in-flight computation per stage
+        self.single_flight = single_flight
+        ## Pre-computed answers for the sample questions, filled by warmup.SampleQueryWarmer
+        self.sample_cache = sample_cache
+        ## Paraphrase-tolerant index of (question, SQL) pairs that executed successfully
+        self.question_index = question_index
+        self._questions_by_sql = {}
+        ## Catalog of past charts; a chart for the same question over the same data is reused without LLM calls
+        self.viz_store = get_viz_store()
+        ## Created on first async call (arun_batch / aexecute_sql_query), bound to that call's event loop
+        self._async_sql_coder = None
+        self._async_loop = None
 
-    def generate_sql_query(self, user_query):
-        prev_queries = '; '.join([f"Question {idx+1}: {query}" for idx, query in enumerate(self.hist)])
-        sql_query = self.query_generator.generate_query(
-            user_query,
-            self.db.dialect,
-            get_table_definitions(self.db),
-            prev_queries
-        )
-        return clean_sql_query(sql_query)
-
-    def execute_sql_query(self, sql_query):
-        if "CREATE" in sql_query or "DELETE" in sql_query or "UPDATE" in sql_query or "ALTER" in sql_query:
+    @memory_accountant.tracked_stage('generate_sql')
+    def generate_sql_query(self, user_query, hist=None, refresh=False):
+        ## hist lets callers that serve many users (e.g. service.py) pass their own question history.
+        ## refresh=True (the sample warm-up) always asks the LLM: no warm answer and no SQL reused from the index.
+        hist = self.hist if hist is None else hist
+        ## Warm answers were computed without history, so they only apply to a fresh conversation
+        if not hist and not refresh:
+            entry = self.sample_cache.get(user_query)
+            if entry is not None:
+                return parse_sql(entry['sql_query'])
+        prev_queries = '; '.join([f"Question {idx+1}: {query}" for idx, query in enumerate(hist)])
+        key = make_key('sql', normalize_question(user_query), [normalize_question(query) for query in hist], self.db.dialect, refresh)
+        return self.single_flight.do(key, self._generate_sql_query, user_query, prev_queries, not refresh)
+
+    def _generate_sql_query(self, user_query, prev_queries, reuse=True):
+        ## Stored SQL is only reused outright when there is no history that could change the meaning
+        indexed_sql, examples = self.question_index.lookup(user_query, reuse=reuse and not prev_queries)
+        if indexed_sql is not None:
+            sql_query = parse_sql(indexed_sql)
+        else:
+            sql_query = clean_sql_query(self.query_generator.generate_query(
+                user_query,
+                self.db.dialect,
+                get_table_definitions(self.db),
+                prev_queries,
+                examples
+            ))
+        self._questions_by_sql[sql_query.canonical] = user_query
+        return sql_query
+
+    @memory_accountant.tracked_stage('execute_sql')
+    def execute_sql_query(self, sql_query, refresh=False):
+        ## Parsed once here (a no-op for SQL from generate_sql_query); later stages reuse the same object.
+        ## refresh=True always runs the query instead of answering from the warm sample cache.
+        sql_query = parse_sql(sql_query)
+        if not sql_query.is_read_only:
             raise DDLCommandException
-        return self.sql_coder.execute_query(sql_query)
+        entry = None if refresh else self.sample_cache.get_by_sql(sql_query)
+        if entry is not None:
+            try:
+                return entry['data'].to_pandas()
+            except ResultEvictedException:
+                pass
+        key = make_key('execute', sql_query.canonical)
+        res = self.single_flight.do(key, self.sql_coder.execute_query, sql_query)
+        if sql_query.canonical in self._questions_by_sql:
+            self.question_index.add(self._questions_by_sql.pop(sql_query.canonical), str(sql_query))
+        return res
 
-    def summarize_results(self, user_query, res):
+    def export_results(self, sql_query, fmt='csv', path=None, progress=None):
+        ## Streams the full result to a file (export.py) instead of the in-memory DataFrame
+        return export_query(self.db, sql_query, fmt, path, batch_rows=int(os.getenv('EXPORT_BATCH_ROWS', 10000)), progress=progress)
+
+    @memory_accountant.tracked_stage('summarize')
+    def summarize_results(self, user_query, res, refresh=False):
         if isinstance(res, str):
             return "Cannot generate summary for invalid data. Please try again."
-        return self.response_summarizer.summarize(user_query, res)
+        entry = None if refresh else self.sample_cache.get(user_query)
+        if entry is not None and entry['summary'] is not None and entry['data_hash'] == hash_dataframe(res):
+            return entry['summary']
+        key = make_key('summary', normalize_question(user_query), hash_dataframe(res))
+        return self.single_flight.do(key, self.response_summarizer.summarize, user_query, res)
 
+    @memory_accountant.tracked_stage('visualize')
     def generate_visualization(self, user_query, res):
         if isinstance(res, str):
             return "Cannot generate visualization for invalid data. Please try again."
+        data_hash = hash_dataframe(res)
+        past_chart = self.viz_store.find(user_query, data_hash)
+        if past_chart is not None and past_chart['viz_code']:
+            return past_chart['viz_code']
+        key = make_key('viz', normalize_question(user_query), data_hash)
+        return self.single_flight.do(key, self._generate_visualization, user_query, res)
+
+    def _generate_visualization(self, user_query, res):
         head = res.head().to_dict()
-        buffer = StringIO()
-        res.info(buf=buffer)
-        info = buffer.getvalue()
-        data_desc = res.describe().to_string()
+        if len(res) >= self.sketch_rows:
+            ## One pass over the result in chunks instead of info() + describe(); approximate (sketches.py)
+            profile = ResultProfiler.from_dataframe(res)
+            info = profile.info()
+            data_desc = profile.describe().to_string()
+        else:
+            buffer = StringIO()
+            res.info(buf=buffer)
+            info = buffer.getvalue()
+            data_desc = res.describe().to_string()
 
         viz_desc = self.analyst_agent.generate_viz_description(user_query, head, info, data_desc)
         viz_code = self.visualization_agent.generate_viz_code(viz_desc, res)
         return viz_code
 
-    def save_visualization(self, viz_code, res):
+    @memory_accountant.tracked_stage('save_visualization')
+    def save_visualization(self, viz_code, res, user_query=None, sql_query=None):
         try:
-            fig = execute_viz_code(viz_code, res)
-            directory = "Viz History"
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-            filename = datetime.now().strftime("%Y%m%d_%H%M%S") + ".html"
-            filepath = os.path.join(directory, filename)
-            fig.write_html(filepath)
-            logger.info("Visualization saved as %s", filepath)
+            data_hash = hash_dataframe(res)
+            figure_json = figure_cache.render(viz_code, res, data_hash)
+            chart_id = self.viz_store.save(figure_json, user_query, sql_query, data_hash, viz_code)
+            logger.info("Visualization saved to history as chart %s", chart_id)
         except Exception as e:
             logger.error("Error generating visualization: %s", e)
 
+    def _get_async_sql_coder(self):
+        ## One async engine per event loop: pooled asyncpg connections cannot move between loops
+        loop = asyncio.get_running_loop()
+        if self._async_sql_coder is not None and self._async_loop is not loop:
+            ## Left over from an earlier loop (usually closed by now): drop its pool without awaiting anything on
+            ## it; the connections are closed as they are garbage collected
+            self._async_sql_coder.engine.sync_engine.dispose(close=False)
+            self._async_sql_coder = None
+        if self._async_sql_coder is None:
+            self._async_sql_coder = AsyncSQLCoder(self.db_loader.async_postgresql_uri, self.sql_coder.view_manager, self.db)
+            self._async_loop = loop
+        return self._async_sql_coder
+
+    async def adispose(self):
+        ## Closes the async engine's connections; call on the loop that used it, before the loop ends
+        if self._async_sql_coder is not None and self._async_loop is asyncio.get_running_loop():
+            await self._async_sql_coder.dispose()
+            self._async_sql_coder = None
+
+    async def aexecute_sql_query(self, sql_query):
+        ## Async counterpart of execute_sql_query: the DB round-trip does not hold a thread.
+        ## Not coalesced through single_flight, which blocks threads while it waits.
+        sql_query = parse_sql(sql_query)
+        if not sql_query.is_read_only:
+            raise DDLCommandException
+        entry = self.sample_cache.get_by_sql(sql_query)
+        if entry is not None:
+            try:
+                return entry['data'].to_pandas()
+            except ResultEvictedException:
+                pass
+        res = await self._get_async_sql_coder().execute_query(sql_query)
+        if sql_query.canonical in self._questions_by_sql:
+            self.question_index.add(self._questions_by_sql.pop(sql_query.canonical), str(sql_query))
+        return res
+
+    async def arun_question(self, user_query, hist=None, need_summary=True, need_viz=True) -> dict:
+        ## LLM stages run in worker threads, the query on the async engine; summary and chart code overlap
+        with token_accountant.request():
+            sql_query = await asyncio.to_thread(self.generate_sql_query, user_query, [] if hist is None else hist)
+            res = await self.aexecute_sql_query(sql_query)
+            summary, viz_code = await asyncio.gather(
+                asyncio.to_thread(self.summarize_results, user_query, res) if need_summary else asyncio.sleep(0),
+                asyncio.to_thread(self.generate_visualization, user_query, res) if need_viz else asyncio.sleep(0),
+            )
+        return {'question': user_query, 'sql_query': str(sql_query), 'data': res, 'summary': summary, 'viz_code': viz_code}
+
+    async def arun_batch(self, questions: list, concurrency: int = 8, need_summary=True, need_viz=True) -> list:
+        ## Many independent questions on one event loop; a failed question yields {'question', 'error'}
+        ## The async engine lives as long as the batch, since the loop usually ends with it
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_one(question):
+            async with semaphore:
+                try:
+                    return await self.arun_question(question, [], need_summary, need_viz)
+                except Exception as e:
+                    logger.error("Batch question failed: %s: %s", question, e)
+                    return {'question': question, 'error': str(e)}
+
+        ## Their LLM calls queue behind interactive ones for admission (the tasks copy this context)
+        with admission_controller.context(priority='batch'):
+            try:
+                return await asyncio.gather(*(run_one(question) for question in questions))
+            finally:
+                await self.adispose()
+
     def run_workflow(self, user_query):
+        with token_accountant.request(), profile_block(self.profile, "workflow") as capture:
+            self._run_workflow(user_query)
+        self.last_profile = capture
+        if capture:
+            logger.info("Profile written to %s", capture['speedscope'])
+
+    def _run_workflow(self, user_query):
         try:
             sql_query = self.generate_sql_query(user_query)
             logger.info("Generated SQL Query:\n%s", sql_query)
@@ -86,7 +294,7 @@ class DataAnalyticsWorkflow:
             viz_code = self.generate_visualization(user_query, res)
             logger.info("Visualization Code:\n%s", viz_code)
 
-            self.save_visualization(viz_code, res)
+            self.save_visualization(viz_code, res, user_query, sql_query)
             self.hist.append(user_query)
 
         except DDLCommandException: